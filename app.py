@@ -2,57 +2,160 @@ from flask import Flask, request
 import threading
 import time
 import cv2
-from collections import deque
+from collections import deque, OrderedDict
 import os
 from b2sdk.v2 import *
-from datetime import datetime
+from b2sdk.v2.exception import B2ConnectionError, B2RequestTimeout, FileNotPresent
+from datetime import datetime, timedelta
 import requests
 import ffmpeg
 import subprocess
 import configparser
 import socket
+from urllib.parse import urlparse
 import platform
 try:
     import psutil
     PSUTIL_AVAILABLE = True
 except ImportError:
     PSUTIL_AVAILABLE = False
-    print("⚠️ psutil não instalado. Monitoramento de recursos desabilitado.")
 import json
 import shutil
 import signal
+import atexit
 import sys
 import logging
+import logging.handlers
+import gzip
 from pathlib import Path
-from queue import Queue, Empty
+from queue import Queue, PriorityQueue, Empty, Full
 import sqlite3
 import hashlib
+import uuid
+import errno
+import io
+import math
+import itertools
+import bisect
+import mmap
+import struct
+from array import array
+import numpy as np
+import hmac
+import functools
+import traceback
+import cProfile
+import pstats
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
 try:
     from zeroconf import ServiceInfo, Zeroconf
     ZEROCONF_AVAILABLE = True
 except ImportError:
     ZEROCONF_AVAILABLE = False
-    print("⚠️ Zeroconf não instalado. Instale com: pip install zeroconf")
 
-# === CONFIGURAÇÃO DE LOGGING ROBUSTO ===
-# Nota: LOG_PATH será definido após detecção de plataforma
-# Por enquanto, usa fallback local
-temp_log_path = 'penareia.log'
-try:
-    os.makedirs(os.path.dirname(temp_log_path) if os.path.dirname(temp_log_path) else '.', exist_ok=True)
-except:
-    pass
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(temp_log_path, encoding='utf-8'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+# === CONFIGURAÇÃO DE LOGGING ASSÍNCRONO ===
+# As threads (captura, Flask, workers) só enfileiram o registro; o QueueListener, iniciado
+# depois da detecção de plataforma (setup_log_file), escreve no console e no arquivo com rotação
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_QUEUE_SIZE = 10000
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler que nunca bloqueia: com a fila cheia descarta e conta"""
+    
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+class RepeatFilter(logging.Filter):
+    """Limita avisos/erros repetidos do mesmo ponto do código: `burst` por janela, o resto vira contagem"""
+    
+    def __init__(self, window=60, burst=5):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self.sites = {}
+        self.suppressed_total = 0
+        self.lock = threading.Lock()
+    
+    def filter(self, record):
+        if not self.window or not logging.WARNING <= record.levelno < logging.CRITICAL:
+            return True
+        key = (record.pathname, record.lineno)
+        with self.lock:
+            site = self.sites.get(key)
+            if site is None or record.created - site[0] >= self.window:
+                suppressed = site[2] if site else 0
+                self.sites[key] = [record.created, 1, 0]
+                if suppressed:
+                    record.msg = f"{record.getMessage()} (+{suppressed} repetição(ões) suprimida(s) em {self.window}s)"
+                    record.args = None
+                return True
+            site[1] += 1
+            if site[1] <= self.burst:
+                return True
+            site[2] += 1
+            self.suppressed_total += 1
+            return False
+
+class CompressedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Rotaciona por tamanho e à meia-noite; os backups viram .gz na thread do QueueListener"""
+    
+    def __init__(self, filename, max_bytes, backup_count, daily=True, compress=True):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=max(backup_count, 1),
+                         encoding='utf-8', delay=True)
+        self.daily = daily
+        if compress:
+            self.namer = lambda name: name + '.gz'
+            self.rotator = self._gzip_rotator
+        # Arquivo de outro dia (reinício depois da meia-noite) rotaciona na primeira escrita
+        started = os.path.getmtime(filename) if os.path.exists(filename) else time.time()
+        self.rollover_at = self._next_midnight(started)
+    
+    def _next_midnight(self, timestamp):
+        if not self.daily:
+            return float('inf')
+        tomorrow = datetime.fromtimestamp(timestamp).date() + timedelta(days=1)
+        return datetime.combine(tomorrow, datetime.min.time()).timestamp()
+    
+    def shouldRollover(self, record):
+        if record.created >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+    
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = self._next_midnight(time.time())
+    
+    @staticmethod
+    def _gzip_rotator(source, dest):
+        with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+log_queue = Queue(maxsize=LOG_QUEUE_SIZE)
+log_console_handler = logging.StreamHandler(sys.stdout)
+log_console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+log_queue_handler = DroppingQueueHandler(log_queue)
+# Só a mensagem: data e nível são formatados pelos handlers do listener
+log_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+log_repeat_filter = RepeatFilter()
+log_queue_handler.addFilter(log_repeat_filter)
+logging.basicConfig(level=logging.INFO, handlers=[log_queue_handler], force=True)
+log_listener = None
 logger = logging.getLogger(__name__)
 
+if not PSUTIL_AVAILABLE:
+    logger.warning("⚠️ psutil não instalado. Monitoramento de recursos desabilitado.")
+if not ZEROCONF_AVAILABLE:
+    logger.warning("⚠️ Zeroconf não instalado. Instale com: pip install zeroconf")
+
 app = Flask(__name__)
 
 # === CARREGAMENTO DAS CONFIGURAÇÕES ===
@@ -69,6 +172,9 @@ except ValueError:
 
 BUFFER_SECONDS = config.getint('VIDEO', 'BUFFER_SECONDS')
 SAVE_SECONDS = config.getint('VIDEO', 'SAVE_SECONDS')
+# Buffer de frames num arquivo mapeado em memória: sobrevive a crash/restart do processo
+FRAME_RING_ENABLED = config.getboolean('VIDEO', 'FRAME_RING', fallback=False)
+FRAME_RING_PATH = config.get('VIDEO', 'FRAME_RING_PATH', fallback='/dev/shm/penareia_frames.ring')
 
 # === CONFIGURAÇÕES ESPECÍFICAS DO RASPBERRY PI ===
 FORCE_FPS = config.getint('VIDEO', 'FORCE_FPS', fallback=24)
@@ -79,19 +185,120 @@ MAX_HEIGHT = config.getint('VIDEO', 'MAX_HEIGHT', fallback=720)
 ENABLE_MDNS = config.getboolean('SERVER', 'ENABLE_MDNS', fallback=True)
 SERVICE_NAME = config.get('SERVER', 'SERVICE_NAME', fallback='PenAreia-Camera')
 USE_THREADS = config.getboolean('SERVER', 'THREADS', fallback=True)
+# Endpoints /debug/profile, /debug/memory e /debug/threads (vazio = desativados)
+DEBUG_TOKEN = config.get('SERVER', 'DEBUG_TOKEN', fallback='').strip()
+PROFILE_MAX_SECONDS = config.getint('SERVER', 'PROFILE_MAX_SECONDS', fallback=60)
+# Teto do texto devolvido pelos endpoints de depuração
+DEBUG_MAX_OUTPUT_KB = config.getint('SERVER', 'DEBUG_MAX_OUTPUT_KB', fallback=256)
 
 # === CONFIGURAÇÕES DE CODIFICAÇÃO OTIMIZADAS ===
 ENCODING_TUNE = config.get('VIDEO_ENCODING', 'TUNE', fallback='zerolatency')
 ENCODING_THREADS = config.getint('VIDEO_ENCODING', 'THREADS', fallback=4)
 USE_GPU = config.getboolean('VIDEO_ENCODING', 'USE_GPU', fallback=False)
 
+# === CONFIGURAÇÕES DE CODIFICAÇÃO PARALELA POR SEGMENTOS ===
+# auto = decide pelo número de núcleos e duração do clipe; true/false força o modo
+PARALLEL_ENCODING = config.get('VIDEO_ENCODING', 'PARALLEL_ENCODING', fallback='auto').strip().lower()
+PARALLEL_MIN_SEGMENT_SECONDS = config.getint('VIDEO_ENCODING', 'MIN_SEGMENT_SECONDS', fallback=4)
+CPU_COUNT = os.cpu_count() or 1
+CLK_TCK = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+# === CONFIGURAÇÕES DO CACHE DE SEGMENTOS PRÉ-CODIFICADOS ===
+SEGMENT_CACHE_ENABLED = config.getboolean('VIDEO_ENCODING', 'SEGMENT_CACHE', fallback=False)
+SEGMENT_CACHE_SECONDS = config.getint('VIDEO_ENCODING', 'SEGMENT_CACHE_SECONDS', fallback=2)
+SEGMENT_CACHE_DIR = config.get(
+    'VIDEO_ENCODING', 'SEGMENT_CACHE_DIR',
+    fallback='/dev/shm/penareia_segments' if os.path.isdir('/dev/shm') else 'videos/temp/segment_cache'
+)
+
+# === CONFIGURAÇÕES DO TETO DE BITRATE PELO UPLINK ===
+# Tempo alvo de upload de um clipe de SAVE_SECONDS (0 = só CRF, sem teto)
+TARGET_UPLOAD_SECONDS = config.getfloat('VIDEO_ENCODING', 'TARGET_UPLOAD_SECONDS', fallback=0)
+# Estimativa inicial do uplink, usada até o primeiro upload medido
+UPLINK_KBPS = config.getint('VIDEO_ENCODING', 'UPLINK_KBPS', fallback=2000)
+MIN_VIDEO_KBPS = config.getint('VIDEO_ENCODING', 'MIN_VIDEO_KBPS', fallback=300)
+MAX_VIDEO_KBPS = config.getint('VIDEO_ENCODING', 'MAX_VIDEO_KBPS', fallback=0)
+
+# === CONFIGURAÇÕES DO CLIPE PROXY (BAIXA RESOLUÇÃO, ENVIADO ANTES DO CLIPE FINAL) ===
+PROXY_CLIP_ENABLED = config.getboolean('VIDEO_ENCODING', 'PROXY_CLIP', fallback=False)
+PROXY_HEIGHT = config.getint('VIDEO_ENCODING', 'PROXY_HEIGHT', fallback=360)
+PROXY_CRF = config.getint('VIDEO_ENCODING', 'PROXY_CRF', fallback=32)
+PROXY_PRESET = config.get('VIDEO_ENCODING', 'PROXY_PRESET', fallback='ultrafast')
+
+# === CONFIGURAÇÕES DE EMPACOTAMENTO (POSTER E HLS GERADOS NA MESMA DECODIFICAÇÃO) ===
+POSTER_ENABLED = config.getboolean('VIDEO_ENCODING', 'POSTER', fallback=False)
+# Alturas das renditions HLS separadas por vírgula (vazio = sem HLS), ex.: 360,720
+HLS_RENDITIONS = sorted({int(h) for h in config.get('VIDEO_ENCODING', 'HLS_RENDITIONS', fallback='').split(',')
+                         if h.strip().isdigit()})
+HLS_SEGMENT_SECONDS = config.getint('VIDEO_ENCODING', 'HLS_SEGMENT_SECONDS', fallback=2)
+
 # === CONFIGURAÇÃO DO WEBHOOK ===
 WEBHOOK_URL = config.get('WEBHOOK', 'URL')
+# Webhooks pendentes ficam no banco até serem entregues; acima desta idade são descartados
+WEBHOOK_MAX_AGE_HOURS = config.getfloat('WEBHOOK', 'MAX_AGE_HOURS', fallback=24)
 
 # === CONFIGURAÇÕES DO BACKBLAZE B2 ===
 B2_KEY_ID = config.get('BACKBLAZE_B2', 'KEY_ID')
 B2_APPLICATION_KEY = config.get('BACKBLAZE_B2', 'APPLICATION_KEY')
 B2_BUCKET_NAME = config.get('BACKBLAZE_B2', 'BUCKET_NAME')
+# Realm do b2sdk ('production') ou URL de um emulador local (ex.: http://127.0.0.1:8600)
+B2_REALM = config.get('BACKBLAZE_B2', 'REALM', fallback='production')
+# Base das URLs públicas; vazio = a downloadUrl devolvida na autorização
+B2_DOWNLOAD_URL = config.get('BACKBLAZE_B2', 'DOWNLOAD_URL', fallback='').rstrip('/')
+# Upload em streaming (MP4 fragmentado enviado em partes durante a codificação)
+STREAMING_UPLOAD_ENABLED = config.getboolean('BACKBLAZE_B2', 'STREAMING_UPLOAD', fallback=False)
+# O B2 exige partes de no mínimo 5 MB (exceto a última)
+B2_PART_SIZE = max(config.getint('BACKBLAZE_B2', 'PART_SIZE_MB', fallback=5), 5) * 1024 * 1024
+# Arquivos acima deste tamanho são enviados em partes retomáveis (precisa de pelo menos duas partes)
+B2_MULTIPART_THRESHOLD = max(
+    config.getint('BACKBLAZE_B2', 'MULTIPART_THRESHOLD_MB', fallback=10) * 1024 * 1024,
+    B2_PART_SIZE + 1
+)
+
+# === CONFIGURAÇÕES DE LIMITE DE BANDA DOS UPLOADS ===
+# Teto em kbit/s (0 = sem teto); o modo adaptativo reduz a banda quando a captura sofre
+UPLOAD_MAX_RATE_KBPS = config.getint('UPLOAD', 'MAX_RATE_KBPS', fallback=0)
+UPLOAD_MIN_RATE_KBPS = config.getint('UPLOAD', 'MIN_RATE_KBPS', fallback=256)
+UPLOAD_ADAPTIVE_RATE = config.getboolean('UPLOAD', 'ADAPTIVE_RATE', fallback=True)
+
+# === CONFIGURAÇÕES DA QUEUE DE UPLOADS ===
+# Tamanho da janela em memória sobre a queue persistente no SQLite
+UPLOAD_PREFETCH = config.getint('UPLOAD', 'PREFETCH', fallback=4)
+# Espera antes de tentar de novo um upload que falhou
+UPLOAD_RETRY_DELAY = config.getint('UPLOAD', 'RETRY_DELAY', fallback=30)
+
+# === CONFIGURAÇÕES DOS CIRCUIT BREAKERS ===
+# Falhas de conectividade seguidas até abrir o circuito e limites do backoff das sondas
+CIRCUIT_FAILURE_THRESHOLD = config.getint('UPLOAD', 'CIRCUIT_FAILURE_THRESHOLD', fallback=3)
+CIRCUIT_BASE_BACKOFF = config.getint('UPLOAD', 'CIRCUIT_BASE_BACKOFF', fallback=5)
+CIRCUIT_MAX_BACKOFF = config.getint('UPLOAD', 'CIRCUIT_MAX_BACKOFF', fallback=300)
+
+# === CONFIGURAÇÕES DE IDEMPOTÊNCIA E DEBOUNCE DO TRIGGER ===
+# Triggers dentro desta janela (de qualquer dispositivo) se juntam ao trigger em andamento
+TRIGGER_DEBOUNCE_SECONDS = config.getfloat('TRIGGER', 'DEBOUNCE_SECONDS', fallback=5)
+# Tempo que uma chave de idempotência fica registrada
+TRIGGER_IDEMPOTENCY_TTL = config.getint('TRIGGER', 'IDEMPOTENCY_TTL', fallback=300)
+# Quanto uma requisição duplicada espera pelo resultado do trigger original
+TRIGGER_DUPLICATE_WAIT = config.getint('TRIGGER', 'DUPLICATE_WAIT', fallback=25)
+# Agrupamento de triggers com janelas sobrepostas: off, merge (um clipe com a união) ou
+# trim (codifica a união uma vez e recorta um clipe por trigger sem recodificar)
+TRIGGER_COALESCE = config.get('TRIGGER', 'COALESCE', fallback='off').strip().lower()
+# Tempo que um job espera por triggers sobrepostos antes de codificar
+TRIGGER_COALESCE_WAIT = config.getfloat('TRIGGER', 'COALESCE_WAIT', fallback=10)
+# Duração máxima de um clipe agrupado
+TRIGGER_COALESCE_MAX_SECONDS = config.getint('TRIGGER', 'COALESCE_MAX_SECONDS', fallback=60)
+# Threads que codificam os jobs (no Pi, uma por vez já ocupa todos os núcleos)
+ENCODE_WORKERS = max(config.getint('TRIGGER', 'ENCODE_WORKERS', fallback=1), 1)
+# Frames do job gravados em disco e job registrado no banco antes de responder ao trigger:
+# um crash no meio da codificação não perde o clipe (a recuperação roda na inicialização)
+DURABLE_ENCODE_JOBS = config.getboolean('TRIGGER', 'DURABLE_JOBS', fallback=True)
+# Snapshots no staging em RAM: poupa o cartão SD, mas só sobrevive a crash do processo (não a reboot)
+DURABLE_SNAPSHOTS_IN_RAM = config.getboolean('TRIGGER', 'SNAPSHOTS_IN_RAM', fallback=False)
+# Tentativas de um job durável (contando as recuperações) antes de desistir
+ENCODE_JOB_MAX_ATTEMPTS = max(config.getint('TRIGGER', 'JOB_MAX_ATTEMPTS', fallback=3), 1)
+# Listener UDP de baixa latência (0 = desativado); datagramas assinados com HMAC-SHA256
+TRIGGER_UDP_PORT = config.getint('TRIGGER', 'UDP_PORT', fallback=0)
+TRIGGER_UDP_SECRET = config.get('TRIGGER', 'UDP_SECRET', fallback='')
 
 # === CONFIGURAÇÕES DO SERVIDOR ===
 SERVER_HOST = config.get('SERVER', 'HOST')
@@ -105,13 +312,62 @@ ENCODING_PRESET = config.get('VIDEO_ENCODING', 'PRESET')
 ENCODING_CRF = config.getint('VIDEO_ENCODING', 'CRF')
 PIXEL_FORMAT = config.get('VIDEO_ENCODING', 'PIXEL_FORMAT')
 
+# === CONFIGURAÇÕES DO GOVERNADOR DE CODIFICAÇÃO (TEMPERATURA, CARGA E FILA) ===
+GOVERNOR_ENABLED = config.getboolean('GOVERNOR', 'ENABLED', fallback=False)
+# Níveis de degradação após o nível 0 (PRESET/THREADS configurados), separados por vírgula:
+# preset:threads:altura[:proxy] (altura 0 = resolução da câmera; proxy = só o clipe PROXY_HEIGHT)
+GOVERNOR_LEVELS = config.get(
+    'GOVERNOR', 'LEVELS',
+    fallback=f'veryfast:{ENCODING_THREADS}:0, ultrafast:{ENCODING_THREADS}:0, '
+             f'ultrafast:{max(ENCODING_THREADS // 2, 1)}:540, ultrafast:1:0:proxy'
+)
+# Acima de WARM_TEMP desce proporcionalmente; em HOT_TEMP vai direto ao último nível
+GOVERNOR_WARM_TEMP = config.getfloat('GOVERNOR', 'WARM_TEMP', fallback=65)
+GOVERNOR_HOT_TEMP = config.getfloat('GOVERNOR', 'HOT_TEMP', fallback=78)
+# Fração da CPU ocupada por outros processos (sem o app e seus FFmpeg) que conta como saturada
+GOVERNOR_LOAD_HIGH = config.getfloat('GOVERNOR', 'LOAD_HIGH', fallback=0.8)
+# Jobs esperando codificação que contam como fila atrasada
+GOVERNOR_QUEUE_HIGH = config.getint('GOVERNOR', 'QUEUE_HIGH', fallback=2)
+# Tempo mínimo num nível antes de subir a qualidade de novo (histerese)
+GOVERNOR_RECOVER_SECONDS = config.getint('GOVERNOR', 'RECOVER_SECONDS', fallback=60)
+
+# === CONFIGURAÇÕES DE ARMAZENAMENTO LOCAL ===
+# Orçamento de disco para os arquivos locais (clipes, proxies, posters, HLS, temporários)
+STORAGE_BUDGET_BYTES = int(config.getfloat('STORAGE', 'DISK_BUDGET_GB', fallback=4) * 1024**3)
+# Espaço livre mínimo no disco: abaixo disso despeja e, sem o que despejar, recusa triggers
+# (o orçamento só comanda o despejo: uploads pendentes acima dele não bloqueiam a gravação)
+STORAGE_MIN_FREE_BYTES = int(config.getfloat('STORAGE', 'MIN_FREE_GB', fallback=1) * 1024**3)
+# Mantém os clipes já enviados como cache local até o orçamento pedir espaço
+KEEP_UPLOADED_CLIPS = config.getboolean('STORAGE', 'KEEP_UPLOADED', fallback=True)
+# Temporários de codificação esquecidos por um crash são removidos depois disso
+STORAGE_STALE_HOURS = config.getfloat('STORAGE', 'STALE_HOURS', fallback=24)
+
+# Staging dos intermediários em RAM (vazio = sempre em videos/temp)
+STAGING_DIR = config.get('STORAGE', 'STAGING_DIR',
+                         fallback='/dev/shm/penareia' if os.path.isdir('/dev/shm') else '')
+STAGING_MAX_BYTES = int(config.getfloat('STORAGE', 'STAGING_MAX_MB', fallback=512) * 1024**2)
+# RAM que precisa sobrar depois de reservar o intermediário; senão vai para o disco
+STAGING_MIN_FREE_RAM = int(config.getfloat('STORAGE', 'STAGING_MIN_FREE_RAM_MB', fallback=256) * 1024**2)
+
+# === CONFIGURAÇÕES DE LOG ===
+# Rotação por tamanho (MB) e, com DAILY, também à meia-noite
+LOG_MAX_BYTES = int(config.getfloat('LOGGING', 'MAX_MB', fallback=10) * 1024 * 1024)
+LOG_BACKUP_COUNT = config.getint('LOGGING', 'BACKUP_COUNT', fallback=7)
+LOG_DAILY = config.getboolean('LOGGING', 'DAILY', fallback=True)
+LOG_COMPRESS = config.getboolean('LOGGING', 'COMPRESS', fallback=True)
+# Sem console o log vai só para o arquivo (evita duplicar tudo no journald)
+LOG_CONSOLE = config.getboolean('LOGGING', 'CONSOLE', fallback=True)
+# Avisos/erros repetidos do mesmo ponto: até REPEAT_BURST por janela de REPEAT_WINDOW s
+log_repeat_filter.window = config.getint('LOGGING', 'REPEAT_WINDOW', fallback=60)
+log_repeat_filter.burst = config.getint('LOGGING', 'REPEAT_BURST', fallback=5)
+
 # === DETECÇÃO DE PLATAFORMA ===
 IS_RASPBERRY_PI = 'arm' in platform.machine().lower() or 'aarch64' in platform.machine().lower()
 IS_ARM = 'arm' in platform.processor().lower() or 'aarch64' in platform.processor().lower()
 
-print(f"🔍 Plataforma detectada: {platform.system()} {platform.machine()}")
+logger.info(f"🔍 Plataforma detectada: {platform.system()} {platform.machine()}")
 if IS_RASPBERRY_PI or IS_ARM:
-    print("🍓 Raspberry Pi/ARM detectado - aplicando otimizações")
+    logger.info("🍓 Raspberry Pi/ARM detectado - aplicando otimizações")
 
 # === PATHS ESPECÍFICOS POR PLATAFORMA ===
 if IS_RASPBERRY_PI or IS_ARM:
@@ -130,9 +386,57 @@ else:
         if directory:
             os.makedirs(directory, exist_ok=True)
 
-print(f"💾 Banco de dados: {DB_PATH}")
-print(f"📝 Log: {LOG_PATH}")
-print(f"🎬 FFmpeg: {FFMPEG_CMD}")
+# === ARQUIVO DE LOG COM ROTAÇÃO ===
+def setup_log_file():
+    """Troca os handlers do QueueListener: arquivo com rotação em LOG_PATH (+ console)"""
+    global log_listener
+    handlers = [log_console_handler] if LOG_CONSOLE else []
+    error = None
+    try:
+        log_dir = os.path.dirname(LOG_PATH)
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+        file_handler = CompressedRotatingFileHandler(LOG_PATH, LOG_MAX_BYTES, LOG_BACKUP_COUNT,
+                                                     daily=LOG_DAILY, compress=LOG_COMPRESS)
+        file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        # Abre já aqui para falhar cedo (permissão em /var/log) em vez de a cada registro
+        file_handler.stream = file_handler._open()
+        handlers.append(file_handler)
+    except OSError as e:
+        error = e
+        if not LOG_CONSOLE:
+            handlers.append(log_console_handler)
+    
+    # stop() esvazia a fila nos handlers antigos antes da troca
+    if log_listener:
+        log_listener.stop()
+    log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    log_listener.start()
+    if error:
+        logger.warning(f"⚠️ Não foi possível abrir {LOG_PATH} ({error}), log só no console")
+
+def stop_logging():
+    """Esvazia a fila de log no encerramento"""
+    if log_listener:
+        log_listener.stop()
+
+def get_logging_status():
+    """Estado do pipeline de log para o /status"""
+    return {
+        "file": LOG_PATH,
+        "queued": log_queue.qsize(),
+        "dropped": log_queue_handler.dropped,
+        "suppressed_repeats": log_repeat_filter.suppressed_total
+    }
+
+setup_log_file()
+atexit.register(stop_logging)
+
+logger.info(f"💾 Banco de dados: {DB_PATH}")
+logger.info(f"📝 Log: {LOG_PATH} (rotação {LOG_MAX_BYTES // (1024 * 1024)} MB"
+            f"{' + diária' if LOG_DAILY else ''}, {LOG_BACKUP_COUNT} backups"
+            f"{' .gz' if LOG_COMPRESS else ''})")
+logger.info(f"🎬 FFmpeg: {FFMPEG_CMD}")
 
 # === VARIÁVEIS GLOBAIS PARA PROPRIEDADES DETECTADAS ===
 # Força 24 FPS em todas as plataformas para reduzir uso de CPU
@@ -143,15 +447,207 @@ frame_height = 480
 # === BUFFER CIRCULAR ===
 frame_buffer = None
 buffer_lock = threading.Lock()
+# Total de frames já capturados; o frame mais novo do buffer tem sequência frames_captured - 1
+frames_captured = 0
+# Instante (time.monotonic) de leitura de cada frame do buffer, na mesma ordem
+frame_timestamps = None
 
 # === SISTEMA DE FAILOVER E QUEUE ===
-upload_queue = Queue(maxsize=100)
+# A queue em memória é só uma janela de prefetch: a fonte da verdade é a tabela upload_queue.
+# Itens entram como (-prioridade, id, item) para proxies passarem na frente dos clipes finais.
+upload_queue = PriorityQueue()
+# Prioridades persistidas na coluna priority
+UPLOAD_PRIORITY_NORMAL = 0
+UPLOAD_PRIORITY_CLIP = 1
+UPLOAD_PRIORITY_PROXY = 2
+upload_window_ids = set()
+# Uploads desistidos nesta execução: a janela não os busca de novo nem se o UPDATE falhar
+upload_failed_ids = set()
+# Serializa a decisão de quem envia o webhook do MP4 (ele ou o último poster/HLS a terminar)
+clip_assets_lock = threading.Lock()
+upload_queue_event = threading.Event()
+# Avisa a thread do webhook que há entrada nova na tabela webhook_outbox
+webhook_event = threading.Event()
+# Índice local de pares (remote_path, sha1) já enviados, reconstruído do banco na inicialização
+uploaded_index = set()
+uploaded_index_lock = threading.Lock()
+# Itens criados antes desta execução podem já estar no B2 (crash antes de marcar concluído)
+upload_recovery_max_id = 0
 failed_uploads = []
 upload_thread_running = True
 watchdog_enabled = True
 last_heartbeat = time.time()
 system_healthy = True
 
+# === IDEMPOTÊNCIA DOS TRIGGERS ===
+# Chave de idempotência -> execução do trigger; várias chaves podem apontar para a mesma execução
+trigger_runs = {}
+trigger_runs_lock = threading.Lock()
+last_trigger_run = None
+
+# === RELÓGIOS DOS DISPOSITIVOS DO TRIGGER UDP ===
+# device_id -> amostras de offset, offset estimado e último contador visto
+device_clocks = {}
+device_clocks_lock = threading.Lock()
+
+# === FILA DE JOBS DE CODIFICAÇÃO ===
+# Jobs ainda não iniciados; só eles podem receber triggers sobrepostos
+encode_jobs = []
+encode_jobs_lock = threading.Lock()
+encode_job_event = threading.Event()
+encode_job_ids = itertools.count(1)
+encode_jobs_running = 0
+encode_thread_running = True
+# Jobs duráveis recuperados do banco (ou que falharam): codificados com prioridade baixa
+recovered_jobs = Queue()
+recovery_running = False
+
+# === SESSÃO DE PROFILING SOB DEMANDA ===
+# None quando não há profiling: o caminho do trigger/codificação só testa esta variável
+profile_session = None
+profile_lock = threading.Lock()
+# Snapshot de referência do tracemalloc (um só, para o próprio diagnóstico não crescer)
+tracemalloc_baseline = None
+
+# === ESTADO DO GOVERNADOR DE CODIFICAÇÃO ===
+governor_level = 0
+governor_level_since = time.time()
+governor_last_reading = None
+governor_lock = threading.Lock()
+# Amostra anterior de /proc/stat e da CPU do próprio app, em ticks (carga de terceiros)
+cpu_load_sample = None
+# Parâmetros escolhidos para o job da thread atual (as funções de codificação leem daqui)
+encode_context = threading.local()
+
+# === ESTIMATIVA DO UPLINK (ATUALIZADA PELOS UPLOADS) ===
+uplink_estimate_bps = UPLINK_KBPS * 1000
+uplink_samples = 0
+uplink_lock = threading.Lock()
+# Uploads menores que isso são dominados pela latência e não medem a banda
+UPLINK_MIN_SAMPLE_BYTES = 256 * 1024
+
+# === ESTATÍSTICAS DA ÚLTIMA CODIFICAÇÃO PARALELA ===
+last_parallel_encode = None
+
+# === CACHE DE SEGMENTOS PRÉ-CODIFICADOS ===
+segment_cache = deque()
+segment_cache_lock = threading.Lock()
+segment_cache_running = True
+
+# === MÉTRICAS EM MEMÓRIA (FORMATO TEXTO DO PROMETHEUS) ===
+# De 100 µs (espera de lock) a 2 min (upload de um clipe longo)
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 20, 30, 60, 120)
+
+class MetricsRegistry:
+    """Contadores, gauges e histogramas em memória, exportados no /metrics"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.definitions = {}   # nome -> (tipo, ajuda, buckets)
+        self.callbacks = {}     # gauges lidos só no momento do scrape
+        self.samples = {}       # (nome, labels) -> valor; histograma: [contagem por bucket, soma]
+        self.lock = threading.Lock()
+
+    def counter(self, name, help_text):
+        self.definitions[name] = ('counter', help_text, None)
+
+    def gauge(self, name, help_text, callback=None):
+        self.definitions[name] = ('gauge', help_text, None)
+        if callback:
+            self.callbacks[name] = callback
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.definitions[name] = ('histogram', help_text, buckets)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.samples[key] = self.samples.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.samples[key] = value
+
+    def observe(self, name, value, **labels):
+        buckets = self.definitions[name][2]
+        # Bucket calculado fora do lock; o último índice é o +Inf
+        index = bisect.bisect_left(buckets, value)
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            sample = self.samples.get(key)
+            if sample is None:
+                sample = self.samples[key] = [[0] * (len(buckets) + 1), 0.0]
+            sample[0][index] += 1
+            sample[1] += value
+
+    @staticmethod
+    def _labels(labels, extra=None):
+        pairs = list(labels) + ([extra] if extra else [])
+        if not pairs:
+            return ''
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+    def render(self):
+        """Texto no formato de exposição do Prometheus (version 0.0.4)"""
+        with self.lock:
+            samples = {key: [list(value[0]), value[1]] if isinstance(value, list) else value
+                       for key, value in self.samples.items()}
+        # Callbacks fora do lock: podem consultar o banco
+        for name, callback in self.callbacks.items():
+            try:
+                samples[(name, ())] = callback()
+            except Exception:
+                pass
+
+        lines = []
+        for name, (kind, help_text, buckets) in sorted(self.definitions.items()):
+            full_name = f'{self.prefix}_{name}'
+            lines.append(f'# HELP {full_name} {help_text}')
+            lines.append(f'# TYPE {full_name} {kind}')
+            for (sample_name, labels), value in sorted(samples.items(), key=lambda item: item[0]):
+                if sample_name != name or value is None:
+                    continue
+                if kind != 'histogram':
+                    lines.append(f'{full_name}{self._labels(labels)} {value}')
+                    continue
+                counts, total = value
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ['+Inf'], counts):
+                    cumulative += count
+                    lines.append(f'{full_name}_bucket{self._labels(labels, ("le", bound))} {cumulative}')
+                lines.append(f'{full_name}_sum{self._labels(labels)} {total}')
+                lines.append(f'{full_name}_count{self._labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry('penareia')
+metrics.counter('triggers_total', 'Triggers recebidos por origem (http, udp)')
+metrics.histogram('stage_seconds', 'Duração de cada etapa do caminho trigger -> upload -> webhook')
+metrics.histogram('buffer_lock_wait_seconds', 'Espera para adquirir o buffer_lock')
+metrics.histogram('capture_read_seconds', 'Duração de cada cap.read()')
+metrics.gauge('capture_fps', 'FPS medido na captura (janela de ~1 s)')
+metrics.counter('frames_captured_total', 'Frames lidos e guardados no buffer')
+metrics.counter('frames_dropped_total', 'Leituras de frame que falharam')
+metrics.counter('encodes_total', 'Clipes codificados por caminho de codificação')
+metrics.counter('uploads_total', 'Uploads por resultado (ok, dedup, retry, failed)')
+metrics.counter('webhooks_total', 'Webhooks por resultado (ok, error)')
+metrics.counter('storage_bytes_written_total', 'Bytes escritos por camada de armazenamento (tmpfs, disk)')
+metrics.gauge('upload_queue_depth', 'Uploads pendentes no banco', lambda: get_upload_backlog())
+metrics.gauge('encode_queue_depth', 'Jobs esperando codificação', lambda: len(encode_jobs))
+metrics.gauge('encode_jobs_running', 'Jobs em codificação', lambda: encode_jobs_running)
+metrics.gauge('encode_governor_level', 'Nível atual do governador de codificação', lambda: governor_level)
+metrics.gauge('uplink_estimate_kbps', 'Estimativa do uplink usada no teto de bitrate',
+              lambda: round(uplink_estimate_bps / 1000))
+
+# === FUNÇÃO PARA MIGRAR COLUNAS DO BANCO ===
+def ensure_column(cursor, table, column, definition):
+    """Adiciona uma coluna à tabela se ela ainda não existir"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
 # === FUNÇÃO PARA INICIALIZAR BANCO DE DADOS ===
 def init_database():
     """Inicializa o banco de dados SQLite para queue persistente"""
@@ -183,6 +679,87 @@ def init_database():
         )
         ''')
         
+        # Migrações de colunas adicionadas depois da criação da tabela
+        ensure_column(cursor, 'upload_queue', 'large_file_id', 'TEXT')
+        ensure_column(cursor, 'upload_queue', 'next_attempt_at', 'REAL DEFAULT 0')
+        ensure_column(cursor, 'upload_queue', 'file_sha1', 'TEXT')
+        ensure_column(cursor, 'upload_queue', 'webhook_entries', 'TEXT')
+        ensure_column(cursor, 'upload_queue', 'clip_name', 'TEXT')
+        ensure_column(cursor, 'upload_queue', 'kind', "TEXT DEFAULT 'full'")
+        ensure_column(cursor, 'upload_queue', 'priority', 'INTEGER DEFAULT 0')
+        ensure_column(cursor, 'upload_queue', 'encode_level', 'INTEGER')
+        
+        # Índices usados pelo refill da janela de uploads
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_upload_queue_pending
+        ON upload_queue (status, next_attempt_at, id)
+        ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_upload_queue_priority
+        ON upload_queue (status, priority, id)
+        ''')
+        
+        # Tabela de partes confirmadas de uploads multipart (large files do B2)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS upload_parts (
+            upload_id INTEGER NOT NULL,
+            part_number INTEGER NOT NULL,
+            sha1 TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (upload_id, part_number)
+        )
+        ''')
+        
+        # Índice dos arquivos locais (ClipStore): tamanho, estado e último acesso
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS local_files (
+            path TEXT PRIMARY KEY,
+            clip_name TEXT,
+            size INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            last_access REAL NOT NULL,
+            created_at REAL NOT NULL
+        )
+        ''')
+        
+        # Jobs de codificação duráveis: snapshots em disco, parâmetros e estágio
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS encode_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            params TEXT NOT NULL,
+            snapshots TEXT NOT NULL,
+            attempts INTEGER DEFAULT 0,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        ''')
+        
+        # Último contador de trigger UDP aceito por dispositivo: o replay não volta depois de um restart
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS udp_devices (
+            device_id TEXT PRIMARY KEY,
+            last_counter INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        ''')
+        
+        # Webhooks ainda não entregues: sobrevivem a um restart e reenviam a mesma chave
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS webhook_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idempotency_key TEXT NOT NULL UNIQUE,
+            arquivo TEXT NOT NULL,
+            url TEXT NOT NULL,
+            data_hora TEXT NOT NULL,
+            extra TEXT,
+            attempts INTEGER DEFAULT 0,
+            created_at REAL NOT NULL
+        )
+        ''')
+        
         # Tabela de status do sistema
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS system_status (
@@ -293,14 +870,9 @@ def watchdog_monitor():
             else:
                 logger.debug(f"📊 Heartbeat: {time_since_heartbeat:.0f}s atrás (psutil não disponível)")
             
-            # Limpeza periódica de vídeos antigos (a cada hora)
-            current_time = time.time()
-            if hasattr(watchdog_monitor, 'last_cleanup'):
-                if current_time - watchdog_monitor.last_cleanup > 3600:  # 1 hora
-                    cleanup_old_videos(max_age_hours=24)
-                    watchdog_monitor.last_cleanup = current_time
-            else:
-                watchdog_monitor.last_cleanup = current_time
+            # Armazenamento local: reamostra o disco e despeja pelo orçamento (só enviados)
+            clip_store.maintain()
+            staging.expire()
             
             # Aguarda próxima verificação
             time.sleep(30)
@@ -317,7 +889,7 @@ def optimize_camera_for_pi(cap):
     if not (IS_RASPBERRY_PI or IS_ARM):
         return cap
         
-    print("🍓 Aplicando otimizações para Raspberry Pi...")
+    logger.info("🍓 Aplicando otimizações para Raspberry Pi...")
     
     # Configurações específicas do Raspberry Pi
     cap.set(cv2.CAP_PROP_FPS, FORCE_FPS)
@@ -337,7 +909,7 @@ def check_ffmpeg():
         # Tenta usar o path global detectado
         cmd = FFMPEG_CMD
         subprocess.run([cmd, '-version'], capture_output=True, check=True)
-        print(f"✅ FFmpeg encontrado: {cmd}")
+        logger.info(f"✅ FFmpeg encontrado: {cmd}")
         return True, cmd
     except (subprocess.CalledProcessError, FileNotFoundError):
         # Tenta encontrar no PATH como fallback
@@ -345,23 +917,23 @@ def check_ffmpeg():
         if ffmpeg_path:
             try:
                 subprocess.run([ffmpeg_path, '-version'], capture_output=True, check=True)
-                print(f"✅ FFmpeg encontrado: {ffmpeg_path}")
+                logger.info(f"✅ FFmpeg encontrado: {ffmpeg_path}")
                 return True, ffmpeg_path
             except:
                 pass
         
-        print("❌ FFmpeg não encontrado! Instale o FFmpeg para continuar.")
+        logger.error("❌ FFmpeg não encontrado! Instale o FFmpeg para continuar.")
         if IS_RASPBERRY_PI or IS_ARM:
-            print("📝 Para Raspberry Pi: sudo apt update && sudo apt install ffmpeg")
+            logger.info("📝 Para Raspberry Pi: sudo apt update && sudo apt install ffmpeg")
         else:
-            print("📝 Para Windows: Baixe em https://ffmpeg.org/download.html")
+            logger.info("📝 Para Windows: Baixe em https://ffmpeg.org/download.html")
         return False, None
 
 # === FUNÇÃO PARA CONVERTER VÍDEO COM FFMPEG ===
-def convert_video_with_ffmpeg(input_path, output_path):
+def convert_video_with_ffmpeg(input_path, output_path, duration=None):
     """Converte vídeo para formato compatível com navegadores usando FFmpeg"""
     try:
-        print(f"Convertendo vídeo com FFmpeg: {input_path} -> {output_path}")
+        logger.info(f"Convertendo vídeo com FFmpeg: {input_path} -> {output_path}")
         
         # Configuração do FFmpeg otimizada para Raspberry Pi
         stream = ffmpeg.input(input_path)
@@ -370,20 +942,25 @@ def convert_video_with_ffmpeg(input_path, output_path):
         output_options = {
             'vcodec': VIDEO_CODEC,
             'acodec': AUDIO_CODEC, 
-            'preset': ENCODING_PRESET,
+            'preset': encode_preset(),
             'crf': ENCODING_CRF,
             'pix_fmt': PIXEL_FORMAT,
             'movflags': 'faststart',
             'r': detected_fps,
-            's': f'{frame_width}x{frame_height}',
+            's': output_size(),
             'f': 'mp4'
         }
         
+        # Teto de bitrate (VBV) para o clipe caber no tempo de upload alvo
+        cap_kbps = video_bitrate_cap_kbps(duration)
+        if cap_kbps:
+            output_options.update({'maxrate': f'{cap_kbps}k', 'bufsize': f'{cap_kbps * 2}k'})
+        
         # Otimizações específicas para ARM/Raspberry Pi
         if IS_RASPBERRY_PI or IS_ARM:
             output_options.update({
                 'tune': ENCODING_TUNE,
-                'threads': ENCODING_THREADS,
+                'threads': encode_threads(),
                 'g': detected_fps * 2,  # Keyframe interval
                 'sc_threshold': '0',     # Disable scene change detection
                 'profile:v': 'baseline', # Perfil mais leve
@@ -401,20 +978,20 @@ def convert_video_with_ffmpeg(input_path, output_path):
         
         # Executa a conversão
         ffmpeg.run(stream, overwrite_output=True, quiet=True)
-        print(f"✅ Conversão concluída: {output_path}")
+        logger.info(f"✅ Conversão concluída: {output_path}")
         return True, "Conversão bem-sucedida"
         
     except ffmpeg.Error as e:
         error_msg = f"Erro no FFmpeg: {e}"
-        print(f"❌ {error_msg}")
+        logger.error(f"❌ {error_msg}")
         return False, error_msg
     except Exception as e:
         error_msg = f"Erro inesperado na conversão: {e}"
-        print(f"❌ {error_msg}")
+        logger.error(f"❌ {error_msg}")
         return False, error_msg
 
 # === FUNÇÃO ALTERNATIVA COM SUBPROCESS ===
-def convert_video_subprocess(input_path, output_path):
+def convert_video_subprocess(input_path, output_path, duration=None):
     """Converte vídeo usando subprocess (alternativa se ffmpeg-python falhar)"""
     
     # Lista de codecs para tentar em ordem de preferência
@@ -437,7 +1014,7 @@ def convert_video_subprocess(input_path, output_path):
     
     for codec, codec_desc in codec_attempts:
         try:
-            print(f"🔄 Tentando codec: {codec} ({codec_desc})")
+            logger.info(f"🔄 Tentando codec: {codec} ({codec_desc})")
             
             # Usa comando FFmpeg global detectado
             ffmpeg_cmd = FFMPEG_CMD
@@ -446,7 +1023,7 @@ def convert_video_subprocess(input_path, output_path):
                 ffmpeg_cmd,
                 '-i', input_path,
                 '-c:v', codec,
-                '-preset', ENCODING_PRESET if codec == 'libx264' else 'medium',
+                '-preset', encode_preset() if codec == 'libx264' else 'medium',
                 '-crf', str(ENCODING_CRF) if codec == 'libx264' else '23',
                 '-c:a', AUDIO_CODEC,
                 '-pix_fmt', PIXEL_FORMAT,
@@ -460,11 +1037,12 @@ def convert_video_subprocess(input_path, output_path):
                     '-profile:v', 'baseline',
                     '-level', '3.1'
                 ])
+                cmd.extend(bitrate_cap_args(duration))
                 
                 if IS_RASPBERRY_PI or IS_ARM:
                     cmd.extend([
                         '-tune', ENCODING_TUNE,
-                        '-threads', str(ENCODING_THREADS),
+                        '-threads', str(encode_threads()),
                         '-g', str(detected_fps * 2),
                         '-sc_threshold', '0'
                     ])
@@ -475,736 +1053,4393 @@ def convert_video_subprocess(input_path, output_path):
             result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
             
             if result.returncode == 0:
-                print(f"✅ Conversão subprocess concluída com {codec}: {output_path}")
+                logger.info(f"✅ Conversão subprocess concluída com {codec}: {output_path}")
                 return True, f"Conversão bem-sucedida com {codec}"
             else:
                 last_error = result.stderr
-                print(f"⚠️ Codec {codec} falhou, tentando próximo...")
+                logger.warning(f"⚠️ Codec {codec} falhou, tentando próximo...")
                 continue
                 
         except subprocess.TimeoutExpired:
             last_error = f"Timeout na conversão com {codec}"
-            print(f"⚠️ {last_error}, tentando próximo codec...")
+            logger.warning(f"⚠️ {last_error}, tentando próximo codec...")
             continue
         except Exception as e:
             last_error = str(e)
-            print(f"⚠️ Erro com codec {codec}: {e}, tentando próximo...")
+            logger.warning(f"⚠️ Erro com codec {codec}: {e}, tentando próximo...")
             continue
     
     # Se chegou aqui, todos os codecs falharam
     error_msg = f"Todos os codecs falharam. Último erro: {last_error}"
-    print(f"❌ {error_msg}")
+    logger.error(f"❌ {error_msg}")
     return False, error_msg
 
-# === FUNÇÃO PARA ENVIAR DADOS PARA O WEBHOOK ASSÍNCRONO ===
-def send_to_webhook_async(arquivo, url, data_hora):
-    """Envia dados para webhook em thread separada"""
-    def _send():
+# === TETO DE BITRATE PELO ORÇAMENTO DE UPLOAD ===
+def record_uplink_sample(byte_count, seconds):
+    """Atualiza a estimativa do uplink com a vazão de um upload concluído"""
+    global uplink_estimate_bps, uplink_samples
+    if byte_count < UPLINK_MIN_SAMPLE_BYTES or seconds <= 0:
+        return
+    sample = byte_count * 8 / seconds
+    with uplink_lock:
+        # A primeira medição substitui o valor configurado; depois EWMA
+        uplink_estimate_bps = sample if uplink_samples == 0 else 0.7 * uplink_estimate_bps + 0.3 * sample
+        uplink_samples += 1
+
+def video_bitrate_cap_kbps(duration=None):
+    """Maxrate (kbit/s) para um clipe de `duration` segundos (padrão SAVE_SECONDS) subir em
+    TARGET_UPLOAD_SECONDS; None = só CRF"""
+    if TARGET_UPLOAD_SECONDS <= 0:
+        return None
+    # 85%: folga para o container e para a variação do link
+    cap = int(uplink_estimate_bps * TARGET_UPLOAD_SECONDS / max(duration or SAVE_SECONDS, 1) * 0.85 / 1000)
+    cap = max(cap, MIN_VIDEO_KBPS)
+    if MAX_VIDEO_KBPS:
+        cap = min(cap, MAX_VIDEO_KBPS)
+    return cap
+
+def bitrate_cap_args(duration=None):
+    """Argumentos VBV do libx264 (CRF com teto); lista vazia quando o teto está desligado"""
+    cap_kbps = video_bitrate_cap_kbps(duration)
+    if not cap_kbps:
+        return []
+    return ['-maxrate', f'{cap_kbps}k', '-bufsize', f'{cap_kbps * 2}k']
+
+def get_bitrate_cap_status():
+    """Estado do teto de bitrate para o /status"""
+    return {
+        "target_upload_seconds": TARGET_UPLOAD_SECONDS,
+        "uplink_kbps": round(uplink_estimate_bps / 1000),
+        "uplink_samples": uplink_samples,
+        "maxrate_kbps": video_bitrate_cap_kbps()
+    }
+
+# === GOVERNADOR DE CODIFICAÇÃO (TEMPERATURA, CARGA E FILA) ===
+def parse_governor_levels():
+    """Monta a escada de níveis: nível 0 = configuração normal, seguido dos níveis de [GOVERNOR] LEVELS"""
+    levels = [{'level': 0, 'preset': ENCODING_PRESET, 'threads': ENCODING_THREADS, 'height': 0, 'proxy': False}]
+    for spec in GOVERNOR_LEVELS.split(','):
+        parts = [part.strip() for part in spec.split(':')]
+        if not parts[0]:
+            continue
         try:
-            success, result = send_to_webhook(arquivo, url, data_hora)
-            if success:
-                logger.info(f"✅ Webhook enviado: {arquivo}")
-            else:
-                logger.error(f"❌ Falha no webhook: {result}")
-        except Exception as e:
-            logger.error(f"❌ Erro no webhook assíncrono: {e}")
-    
-    thread = threading.Thread(target=_send, daemon=True)
-    thread.start()
+            levels.append({
+                'level': len(levels),
+                'preset': parts[0],
+                'threads': max(int(parts[1]), 1) if len(parts) > 1 and parts[1] else ENCODING_THREADS,
+                'height': int(parts[2]) if len(parts) > 2 and parts[2] else 0,
+                'proxy': len(parts) > 3 and parts[3].lower() == 'proxy'
+            })
+        except ValueError:
+            logger.warning(f"⚠️ Nível inválido ignorado em [GOVERNOR] LEVELS: {spec.strip()}")
+    return levels
 
-def send_to_webhook(arquivo, url, data_hora):
-    """Envia os dados do vídeo para o webhook do site"""
-    try:
-        # Dados em formato form-data (como esperado pelo webhook PHP)
-        data = {
-            'arquivo': arquivo,
-            'url': url,
-            'data_hora': data_hora
-        }
-        
-        # Headers para simular uma requisição de navegador
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': 'application/json, text/plain, */*',
-            'Accept-Language': 'pt-BR,pt;q=0.9,en;q=0.8',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Connection': 'keep-alive',
-            'Cache-Control': 'no-cache'
-        }
-        
-        print(f"Enviando dados para webhook: {data}")
-        
-        # Envia a requisição POST
-        response = requests.post(
-            WEBHOOK_URL, 
-            data=data,  # Usando data= para form-data
-            headers=headers,
-            timeout=30
-        )
-        
-        if response.status_code == 200:
-            try:
-                result = response.json()
-                print(f"Webhook respondeu com sucesso: {result}")
-                return True, result
-            except:
-                print(f"Webhook respondeu com sucesso: {response.text}")
-                return True, response.text
-        else:
-            print(f"Webhook retornou erro {response.status_code}: {response.text}")
-            return False, f"Erro HTTP {response.status_code}"
-            
-    except requests.exceptions.Timeout:
-        print("Timeout ao enviar para webhook")
-        return False, "Timeout na requisição"
-    except requests.exceptions.ConnectionError:
-        print("Erro de conexão ao enviar para webhook")
-        return False, "Erro de conexão"
-    except requests.exceptions.RequestException as e:
-        print(f"Erro ao enviar para webhook: {e}")
-        return False, str(e)
-    except Exception as e:
-        print(f"Erro inesperado no webhook: {e}")
-        return False, str(e)
+ENCODE_LEVELS = parse_governor_levels()
 
-# === FUNÇÃO PARA VERIFICAR ESPAÇO EM DISCO ===
-def check_disk_space(min_gb=2):
-    """Verifica se há espaço suficiente em disco"""
+def read_own_cpu_ticks():
+    """Ticks de CPU do app: o processo, os FFmpeg já encerrados e os que ainda estão rodando"""
+    times = os.times()
+    ticks = (times.user + times.system + times.children_user + times.children_system) * CLK_TCK
     try:
-        # Detecta path correto para verificação
-        if IS_RASPBERRY_PI or IS_ARM:
-            check_path = '/var/lib/penareia' if os.path.exists('/var/lib/penareia') else '/'
-        else:
-            check_path = '.'
-        
-        stat = shutil.disk_usage(check_path)
-        free_gb = stat.free / (1024**3)
-        
-        if free_gb < min_gb:
-            logger.error(f"⚠️ Pouco espaço em disco: {free_gb:.2f} GB disponíveis (mínimo: {min_gb} GB)")
-            return False
-            
-        logger.debug(f"💾 Espaço em disco: {free_gb:.2f} GB disponíveis")
-        return True
-        
-    except Exception as e:
-        logger.warning(f"⚠️ Não foi possível verificar espaço em disco: {e}")
-        return True  # Assume OK se não conseguir verificar
+        tasks = os.listdir('/proc/self/task')
+    except OSError:
+        return ticks
+    for task in tasks:
+        try:
+            with open(f'/proc/self/task/{task}/children') as f:
+                children = f.read().split()
+        except OSError:
+            continue
+        for pid in children:
+            try:
+                with open(f'/proc/{pid}/stat') as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                ticks += int(fields[11]) + int(fields[12])  # utime + stime
+            except (OSError, IndexError, ValueError):
+                pass  # Já encerrou: entra em children_* na próxima amostra
+    return ticks
 
-# === FUNÇÃO PARA LIMPEZA DE VÍDEOS ANTIGOS ===
-def cleanup_old_videos(max_age_hours=24, force=False):
-    """Remove vídeos locais com mais de X horas"""
-    try:
-        removed_count = 0
-        freed_space = 0
-        
-        for folder in ['videos/temp', 'videos/final']:
-            if not os.path.exists(folder):
-                continue
-                
-            for filename in os.listdir(folder):
-                filepath = os.path.join(folder, filename)
-                
-                if not os.path.isfile(filepath):
-                    continue
-                
-                # Verifica idade do arquivo
-                age_seconds = time.time() - os.path.getmtime(filepath)
-                age_hours = age_seconds / 3600
-                
-                should_remove = force or (age_hours > max_age_hours)
-                
-                if should_remove:
-                    try:
-                        file_size = os.path.getsize(filepath)
-                        os.remove(filepath)
-                        removed_count += 1
-                        freed_space += file_size
-                        logger.info(f"🗑️ Vídeo removido: {filename} (idade: {age_hours:.1f}h)")
-                    except Exception as e:
-                        logger.warning(f"⚠️ Não foi possível remover {filename}: {e}")
-        
-        if removed_count > 0:
-            freed_mb = freed_space / (1024**2)
-            logger.info(f"✅ Limpeza concluída: {removed_count} arquivo(s), {freed_mb:.2f} MB liberados")
-        
-        return removed_count
-        
-    except Exception as e:
-        logger.error(f"❌ Erro na limpeza de vídeos: {e}")
-        return 0
+def read_cpu_load():
+    """Fração da CPU usada por outros processos desde a última leitura; None se indisponível
 
-# === INICIALIZAÇÃO DO BACKBLAZE B2 ===
-def init_b2():
-    """Inicializa a conexão com o Backblaze B2"""
+    O load average incluiria o próprio FFmpeg e o governador desceria de nível por causa
+    da própria codificação; aqui a CPU do app e dos filhos sai da conta.
+    """
+    global cpu_load_sample
     try:
-        info = InMemoryAccountInfo()
-        b2_api = B2Api(info)
-        b2_api.authorize_account("production", B2_KEY_ID, B2_APPLICATION_KEY)
-        bucket = b2_api.get_bucket_by_name(B2_BUCKET_NAME)
-        print("Conectado ao Backblaze B2 com sucesso!")
-        return bucket
-    except Exception as e:
-        print(f"Erro ao conectar no Backblaze B2: {e}")
+        with open('/proc/stat') as f:
+            jiffies = [int(value) for value in f.readline().split()[1:9]]
+    except (OSError, ValueError):
+        # Sem /proc: só dá para separar a carga própria quando nenhum job está rodando
+        if PSUTIL_AVAILABLE and not encode_jobs_running:
+            return psutil.cpu_percent(interval=None) / 100
+        return None
+    total = sum(jiffies)
+    busy = total - jiffies[3] - jiffies[4]  # Sem idle e iowait
+    sample = (total, busy, read_own_cpu_ticks())
+    previous, cpu_load_sample = cpu_load_sample, sample
+    if previous is None or total <= previous[0]:
         return None
+    others = (busy - previous[1]) - (sample[2] - previous[2])
+    return min(max(others / (total - previous[0]), 0.0), 1.0)
 
-# === SISTEMA DE QUEUE PARA UPLOADS ===
-def add_to_upload_queue(local_path, remote_name, priority=False):
-    """Adiciona arquivo à queue de upload com retry"""
+def governor_target_level(temp, load, pending_jobs):
+    """Nível pedido pelas leituras atuais, sem histerese"""
+    top = len(ENCODE_LEVELS) - 1
+    steps = 0
+    if temp is not None and temp >= GOVERNOR_WARM_TEMP:
+        if temp >= GOVERNOR_HOT_TEMP:
+            return top
+        # Desce antes do throttling do firmware, proporcional à distância até HOT_TEMP
+        steps += 1 + int((temp - GOVERNOR_WARM_TEMP) / (GOVERNOR_HOT_TEMP - GOVERNOR_WARM_TEMP) * max(top - 1, 0))
+    if load is not None and load >= GOVERNOR_LOAD_HIGH:
+        steps += 1
+    if pending_jobs >= GOVERNOR_QUEUE_HIGH:
+        steps += 1
+    return min(steps, top)
+
+def choose_encode_settings():
+    """Escolhe os parâmetros de codificação do próximo job; piora na hora, melhora um nível por vez"""
+    global governor_level, governor_level_since, governor_last_reading
+    if not GOVERNOR_ENABLED:
+        return dict(ENCODE_LEVELS[0])
+
+    temp = read_cpu_temperature()
+    load = read_cpu_load()
+    with encode_jobs_lock:
+        pending_jobs = len(encode_jobs)
+    target = governor_target_level(temp, load, pending_jobs)
+
+    with governor_lock:
+        now = time.time()
+        if target > governor_level:
+            logger.warning(f"🌡️ Governador: nível {governor_level} -> {target} "
+                           f"(temp={temp}, load={load and round(load, 2)}, fila={pending_jobs})")
+            governor_level, governor_level_since = target, now
+        elif target < governor_level and now - governor_level_since >= GOVERNOR_RECOVER_SECONDS:
+            logger.info(f"🌡️ Governador: nível {governor_level} -> {governor_level - 1}")
+            governor_level, governor_level_since = governor_level - 1, now
+        governor_last_reading = {
+            'temperature': temp,
+            'load_per_cpu': round(load, 2) if load is not None else None,
+            'pending_jobs': pending_jobs,
+            'target_level': target
+        }
+        return dict(ENCODE_LEVELS[governor_level])
+
+def current_encode_settings():
+    """Parâmetros do job em codificação nesta thread (nível 0 fora de um job)"""
+    return getattr(encode_context, 'settings', None) or ENCODE_LEVELS[0]
+
+def encode_preset(settings=None):
+    return (settings or current_encode_settings())['preset']
+
+def encode_threads(settings=None):
+    return (settings or current_encode_settings())['threads']
+
+def output_size(settings=None):
+    """Resolução de saída do nível (nunca maior que a da câmera)"""
+    height = (settings or current_encode_settings())['height']
+    if not height or height >= frame_height:
+        return f'{frame_width}x{frame_height}'
+    return f'{rendition_width(height)}x{height}'
+
+def get_governor_status():
+    """Estado do governador para o /status"""
+    return {
+        "enabled": GOVERNOR_ENABLED,
+        "level": governor_level,
+        "settings": ENCODE_LEVELS[governor_level],
+        "levels": len(ENCODE_LEVELS),
+        "last_reading": governor_last_reading
+    }
+
+# === CODIFICAÇÃO PARALELA POR SEGMENTOS ===
+def choose_parallel_workers(num_frames):
+    """Decide quantos segmentos paralelos usar (1 = codificação sequencial)"""
+    if PARALLEL_ENCODING in ('false', 'off', 'no', '0'):
+        return 1
+    
+    # Encoders de hardware não ganham nada com várias instâncias simultâneas
+    if VIDEO_CODEC != 'libx264':
+        return 1
+    
+    fps = detected_fps or FORCE_FPS
+    clip_seconds = num_frames / fps
+    max_segments = int(clip_seconds // max(PARALLEL_MIN_SEGMENT_SECONDS, 1))
+    
+    if PARALLEL_ENCODING in ('true', 'on', 'yes', '1'):
+        workers = min(max(CPU_COUNT, 2), max_segments)
+    else:
+        workers = min(CPU_COUNT, max_segments)
+    
+    # Nível degradado pelo governador: as threads do nível são o orçamento total de CPU
+    settings = current_encode_settings()
+    if settings['level'] > 0:
+        workers = min(workers, settings['threads'])
+    
+    return workers if workers >= 2 else 1
+
+def split_gop_aligned_segments(num_frames, workers, gop):
+    """Divide os frames em segmentos com início alinhado ao GOP"""
+    total_gops = math.ceil(num_frames / gop)
+    gops_per_segment = math.ceil(total_gops / workers)
+    frames_per_segment = gops_per_segment * gop
+    
+    segments = []
+    start = 0
+    while start < num_frames:
+        count = min(frames_per_segment, num_frames - start)
+        segments.append((start, count))
+        start += count
+    return segments
+
+def encode_segment(input_path, segment_path, start_frame, frame_count, threads, settings=None, duration=None):
+    """Codifica um segmento do vídeo temporário com libx264 (settings: nível do job, as threads do pool não o herdam)
+
+    O teto de bitrate é o do clipe inteiro (`duration`), não o do segmento.
+    """
+    fps = detected_fps or FORCE_FPS
+    gop = int(fps * 2)
+    # Meio frame antes do início garante que o seek preciso inclua o primeiro frame
+    start_time = max((start_frame - 0.5) / fps, 0)
+    
+    cmd = [
+        FFMPEG_CMD,
+        '-hide_banner', '-loglevel', 'error',
+        '-ss', f'{start_time:.6f}',
+        '-i', input_path,
+        '-frames:v', str(frame_count),
+        '-an',
+        '-c:v', 'libx264',
+        '-preset', encode_preset(settings),
+        '-crf', str(ENCODING_CRF),
+        *bitrate_cap_args(duration),
+        '-pix_fmt', PIXEL_FORMAT,
+        '-profile:v', 'baseline',
+        '-level', '3.1',
+        '-tune', ENCODING_TUNE,
+        '-threads', str(threads),
+        '-g', str(gop),
+        '-keyint_min', str(gop),
+        '-sc_threshold', '0',
+        '-r', str(fps),
+        '-s', output_size(settings),
+        '-y', segment_path
+    ]
+    
+    started = time.time()
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+    elapsed = time.time() - started
+    
+    if result.returncode != 0:
+        raise RuntimeError(f"Segmento {os.path.basename(segment_path)} falhou: {result.stderr.strip()}")
+    
+    return elapsed
+
+def concat_segments(segment_paths, output_path, list_path=None):
+    """Junta segmentos H.264 com o concat demuxer sem recodificar"""
+    list_path = list_path or os.path.join(os.path.dirname(segment_paths[0]), 'concat.txt')
+    with open(list_path, 'w', encoding='utf-8') as f:
+        for path in segment_paths:
+            f.write(f"file '{os.path.abspath(path)}'\n")
+    
+    cmd = [
+        FFMPEG_CMD,
+        '-hide_banner', '-loglevel', 'error',
+        '-f', 'concat', '-safe', '0',
+        '-i', list_path,
+        '-c', 'copy',
+        '-movflags', 'faststart',
+        '-y', output_path
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+    if result.returncode != 0:
+        raise RuntimeError(f"Concat falhou: {result.stderr.strip()}")
+
+def convert_video_parallel(input_path, output_path, num_frames, workers):
+    """Codifica o vídeo em segmentos paralelos (um FFmpeg por núcleo) e junta com stream copy"""
+    global last_parallel_encode
+    
+    fps = detected_fps or FORCE_FPS
+    gop = int(fps * 2)
+    segments = split_gop_aligned_segments(num_frames, workers, gop)
+    settings = current_encode_settings()
+    threads_per_segment = max(settings['threads'] // len(segments), 1)
+    
+    segment_dir = os.path.splitext(input_path)[0] + '_segments'
+    os.makedirs(segment_dir, exist_ok=True)
+    segment_paths = [os.path.join(segment_dir, f'seg_{i:03d}.mp4') for i in range(len(segments))]
+    
     try:
-        # Calcula hash do arquivo para verificação de integridade
-        file_hash = hashlib.md5()
-        with open(local_path, 'rb') as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                file_hash.update(chunk)
+        logger.info(f"⚡ Codificação paralela: {len(segments)} segmentos, {threads_per_segment} thread(s) cada")
+        started = time.time()
         
-        upload_item = {
-            'filename': os.path.basename(local_path),
-            'local_path': local_path,
-            'remote_path': remote_name,
-            'timestamp': datetime.now(),
-            'attempts': 0,
-            'max_attempts': 5,
-            'file_hash': file_hash.hexdigest(),
-            'priority': priority
-        }
+        # Cada worker só dispara e aguarda um processo FFmpeg, então threads bastam
+        with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+            futures = [
+                executor.submit(encode_segment, input_path, path, start, count, threads_per_segment, settings,
+                                num_frames / fps)
+                for path, (start, count) in zip(segment_paths, segments)
+            ]
+            segment_times = [future.result() for future in futures]
         
-        # Adiciona ao banco de dados
-        conn = sqlite3.connect(DB_PATH, timeout=10.0)
-        cursor = conn.cursor()
-        cursor.execute('''
-        INSERT INTO upload_queue (filename, local_path, remote_path, timestamp, file_hash)
-        VALUES (?, ?, ?, ?, ?)
-        ''', (upload_item['filename'], upload_item['local_path'], 
-              upload_item['remote_path'], upload_item['timestamp'], 
-              upload_item['file_hash']))
-        conn.commit()
-        conn.close()
+        encode_elapsed = time.time() - started
+        for path in segment_paths:
+            staging.record_write(path)
+        concat_segments(segment_paths, output_path)
+        total_elapsed = time.time() - started
         
-        # Adiciona à queue em memória
-        if priority:
-            # Para uploads prioritários, adiciona no início
-            upload_queue.put(upload_item)
-        else:
-            upload_queue.put(upload_item)
+        last_parallel_encode = {
+            'timestamp': datetime.now().isoformat(),
+            'workers': len(segments),
+            'threads_per_segment': threads_per_segment,
+            'segments': [
+                {'index': i, 'start_frame': start, 'frames': count, 'seconds': round(seconds, 3)}
+                for i, ((start, count), seconds) in enumerate(zip(segments, segment_times))
+            ],
+            'encode_seconds': round(encode_elapsed, 3),
+            'concat_seconds': round(total_elapsed - encode_elapsed, 3),
+            'total_seconds': round(total_elapsed, 3)
+        }
         
-        logger.info(f"📋 Arquivo adicionado à queue: {remote_name}")
-        return True
+        timings = ', '.join(f"{t:.2f}s" for t in segment_times)
+        logger.info(f"⚡ Codificação paralela concluída em {total_elapsed:.2f}s (segmentos: {timings})")
+        return True, f"Conversão paralela bem-sucedida ({len(segments)} segmentos)"
         
     except Exception as e:
-        logger.error(f"❌ Erro ao adicionar à queue: {e}")
-        return False
-
-# === FUNÇÃO PARA MARCAR UPLOAD COMO CONCLUÍDO ===
-def mark_upload_completed(upload_item, url):
-    """Marca upload como concluído no banco de dados"""
-    try:
-        conn = sqlite3.connect(DB_PATH, timeout=10.0)
-        cursor = conn.cursor()
-        cursor.execute('''
-        UPDATE upload_queue 
-        SET status = 'completed', updated_at = ?, error_message = ?
-        WHERE filename = ? AND local_path = ?
-        ''', (datetime.now(), url, upload_item['filename'], upload_item['local_path']))
-        
-        # Atualiza estatísticas
-        cursor.execute('UPDATE system_status SET uploads_success = uploads_success + 1 WHERE id = 1')
-        
-        conn.commit()
-        conn.close()
-        logger.info(f"✅ Upload marcado como concluído: {upload_item['filename']}")
+        error_msg = f"Erro na conversão paralela: {e}"
+        logger.warning(f"⚠️ {error_msg}")
+        return False, error_msg
         
-    except Exception as e:
-        logger.error(f"❌ Erro ao marcar upload como concluído: {e}")
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)
 
-# === FUNÇÃO PARA MARCAR UPLOAD COMO FALHADO ===
-def mark_upload_failed(upload_item, error_message):
-    """Marca upload como falhado no banco de dados"""
+# === CACHE DE SEGMENTOS PRÉ-CODIFICADOS ===
+def encode_frames_to_segment(frames, output_path, threads=1, low_priority=False):
+    """Codifica frames brutos (BGR) em um segmento H.264 via pipe para o FFmpeg"""
+    fps = detected_fps or FORCE_FPS
+    height, width = frames[0].shape[:2]
+    gop = int(fps * 2)
+    
+    cmd = [
+        FFMPEG_CMD,
+        '-hide_banner', '-loglevel', 'error',
+        '-f', 'rawvideo',
+        '-pix_fmt', 'bgr24',
+        '-s', f'{width}x{height}',
+        '-r', str(fps),
+        '-i', '-',
+        '-an',
+        '-c:v', 'libx264',
+        '-preset', ENCODING_PRESET,
+        '-crf', str(ENCODING_CRF),
+        *bitrate_cap_args(),
+        '-pix_fmt', PIXEL_FORMAT,
+        '-profile:v', 'baseline',
+        '-level', '3.1',
+        '-tune', ENCODING_TUNE,
+        '-threads', str(threads),
+        '-g', str(gop),
+        '-keyint_min', str(gop),
+        '-sc_threshold', '0',
+        '-s', f'{frame_width}x{frame_height}',
+        '-y', output_path
+    ]
+    
+    # Prioridade baixa para o encoder de fundo não competir com a captura
+    preexec = (lambda: os.nice(10)) if low_priority and hasattr(os, 'nice') else None
+    
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, preexec_fn=preexec)
     try:
-        conn = sqlite3.connect(DB_PATH, timeout=10.0)
-        cursor = conn.cursor()
-        cursor.execute('''
-        UPDATE upload_queue 
-        SET status = 'failed', updated_at = ?, error_message = ?
-        WHERE filename = ? AND local_path = ?
-        ''', (datetime.now(), error_message, upload_item['filename'], upload_item['local_path']))
-        
-        # Atualiza estatísticas
-        cursor.execute('UPDATE system_status SET uploads_failed = uploads_failed + 1 WHERE id = 1')
-        
-        conn.commit()
-        conn.close()
-        logger.warning(f"⚠️ Upload marcado como falhado: {upload_item['filename']} - {error_message}")
-        
-    except Exception as e:
-        logger.error(f"❌ Erro ao marcar upload como falhado: {e}")
+        for frame in frames:
+            proc.stdin.write(frame.data)
+        proc.stdin.close()
+        stderr = proc.stderr.read().decode('utf-8', errors='replace')
+        proc.wait(timeout=60)
+    except Exception:
+        proc.kill()
+        proc.wait()
+        raise
+    
+    if proc.returncode != 0:
+        raise RuntimeError(f"Segmento {os.path.basename(output_path)} falhou: {stderr.strip()}")
+    staging.record_write(output_path)
 
-# === FUNÇÃO PARA UPLOAD COM RETRY AUTOMÁTICO ===
-def upload_to_b2_with_retry(upload_item):
-    """Faz upload para B2 com retry automático e exponential backoff"""
-    max_retries = 3
-    base_delay = 2  # segundos
+def clear_segment_cache():
+    """Remove todos os segmentos do cache"""
+    with segment_cache_lock:
+        segments = list(segment_cache)
+        segment_cache.clear()
     
-    for attempt in range(max_retries):
+    for segment in segments:
         try:
-            # Tenta fazer upload
-            bucket = init_b2()
-            if not bucket:
-                raise Exception("Não foi possível conectar ao Backblaze B2")
-            
-            # Faz upload do arquivo
-            uploaded_file = bucket.upload_local_file(
-                local_file=upload_item['local_path'],
-                file_name=upload_item['remote_path']
-            )
-            
-            # Gera URL pública
-            file_url = f"https://f005.backblazeb2.com/file/{B2_BUCKET_NAME}/{upload_item['remote_path']}"
-            
-            logger.info(f"✅ Upload B2 concluído (tentativa {attempt + 1}): {file_url}")
-            return True, file_url
-            
-        except Exception as e:
-            logger.warning(f"⚠️ Tentativa {attempt + 1}/{max_retries} falhou: {e}")
-            
-            if attempt < max_retries - 1:
-                # Exponential backoff
-                delay = base_delay * (2 ** attempt)
-                logger.info(f"🔄 Aguardando {delay}s antes de nova tentativa...")
-                time.sleep(delay)
-            else:
-                # Última tentativa falhou
-                error_message = f"Falha após {max_retries} tentativas: {str(e)}"
-                logger.error(f"❌ {error_message}")
-                return False, error_message
-    
-    return False, "Número máximo de tentativas excedido"
+            os.remove(segment['path'])
+        except OSError:
+            pass
 
-def process_upload_queue():
-    """Thread para processar queue de uploads com retry automático"""
-    global upload_thread_running
+def segment_cache_worker():
+    """Mantém o buffer ao vivo codificado em segmentos curtos de tamanho fixo"""
+    logger.info(f"🧩 Cache de segmentos iniciado: {SEGMENT_CACHE_SECONDS}s por segmento em {SEGMENT_CACHE_DIR}")
+    os.makedirs(SEGMENT_CACHE_DIR, exist_ok=True)
     
-    # Recupera itens pendentes do banco na inicialização
-    recover_pending_uploads()
+    next_seq = None
+    current_buffer = None
     
-    while upload_thread_running:
+    while segment_cache_running:
         try:
-            # Pega próximo item da queue (timeout 5s)
-            upload_item = upload_queue.get(timeout=5)
+            fps = detected_fps or FORCE_FPS
+            segment_frames = int(fps * SEGMENT_CACHE_SECONDS)
             
-            logger.info(f"🔄 Processando upload: {upload_item['filename']}")
+            with buffer_lock:
+                buffer = frame_buffer
+                total = frames_captured
+                available = len(buffer) if buffer else 0
             
-            # Verifica se arquivo ainda existe
-            if not os.path.exists(upload_item['local_path']):
-                logger.warning(f"⚠️ Arquivo não encontrado: {upload_item['local_path']}")
-                mark_upload_failed(upload_item, "Arquivo não encontrado")
+            if not buffer:
+                time.sleep(0.5)
                 continue
             
-            # Verifica integridade do arquivo
-            current_hash = hashlib.md5()
-            with open(upload_item['local_path'], 'rb') as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    current_hash.update(chunk)
+            # Reconexão cria um novo buffer: segmentos antigos não são contíguos
+            if buffer is not current_buffer:
+                clear_segment_cache()
+                current_buffer = buffer
+                next_seq = total
             
-            if current_hash.hexdigest() != upload_item['file_hash']:
-                logger.error(f"❌ Integridade comprometida: {upload_item['filename']}")
-                mark_upload_failed(upload_item, "Integridade comprometida")
+            oldest_seq = total - available
+            if next_seq < oldest_seq:
+                logger.warning("⚠️ Cache de segmentos atrasado, descartando frames não codificados")
+                clear_segment_cache()
+                next_seq = total
+            
+            if total - next_seq < segment_frames:
+                time.sleep(0.2)
                 continue
             
-            # Tenta fazer upload
-            success, result = upload_to_b2_with_retry(upload_item)
+            with buffer_lock:
+                ring = frame_buffer if isinstance(frame_buffer, FrameRing) else None
+                if ring is None:
+                    offset = next_seq - (frames_captured - len(frame_buffer))
+                    frames = list(itertools.islice(frame_buffer, offset, offset + segment_frames))
+            if ring is not None:
+                # Slots do anel são reescritos pela captura: cópia fora do lock
+                frames = ring.copy_seqs(next_seq, next_seq + segment_frames)
+                if len(frames) < segment_frames:
+                    logger.warning("⚠️ Cache de segmentos atrasado, descartando frames não codificados")
+                    clear_segment_cache()
+                    next_seq = ring.count
+                    continue
             
-            if success:
-                logger.info(f"✅ Upload concluído: {upload_item['filename']}")
-                # Remove arquivo local após upload bem-sucedido
-                try:
-                    os.remove(upload_item['local_path'])
-                    logger.info(f"🗑️ Arquivo local removido: {upload_item['local_path']}")
-                except:
-                    pass
-                
-                # Marca como concluído no banco
-                mark_upload_completed(upload_item, result)
-                
-                # Envia para webhook
-                send_to_webhook_async(upload_item['filename'], result, 
-                                    upload_item['timestamp'].strftime('%Y-%m-%d %H:%M:%S'))
-            else:
-                logger.error(f"❌ Falha no upload: {upload_item['filename']} - {result}")
-                
-                # Incrementa tentativas
-                upload_item['attempts'] += 1
-                
-                if upload_item['attempts'] >= upload_item['max_attempts']:
-                    logger.error(f"🚫 Máximo de tentativas excedido: {upload_item['filename']}")
-                    mark_upload_failed(upload_item, result)
-                else:
-                    # Recoloca na queue para nova tentativa (com delay)
-                    logger.info(f"🔄 Reagendando upload ({upload_item['attempts']}/{upload_item['max_attempts']}): {upload_item['filename']}")
-                    time.sleep(30)  # Aguarda 30s antes de tentar novamente
-                    upload_queue.put(upload_item)
+            segment_path = os.path.join(SEGMENT_CACHE_DIR, f'seg_{next_seq:010d}.mp4')
+            started = time.time()
+            encode_frames_to_segment(frames, segment_path, threads=1, low_priority=True)
             
-            update_heartbeat()
+            with segment_cache_lock:
+                segment_cache.append({
+                    'start_seq': next_seq,
+                    'frames': len(frames),
+                    'path': segment_path,
+                    'dimensions': (frame_width, frame_height),
+                    'encode_seconds': time.time() - started
+                })
+            next_seq += len(frames)
             
-        except Empty:
-            # Timeout normal, continua loop
-            continue
+            # Descarta segmentos mais antigos que BUFFER_SECONDS
+            min_seq = frames_captured - int(BUFFER_SECONDS * fps)
+            expired = []
+            with segment_cache_lock:
+                while segment_cache and segment_cache[0]['start_seq'] + segment_cache[0]['frames'] <= min_seq:
+                    expired.append(segment_cache.popleft())
+            for segment in expired:
+                try:
+                    os.remove(segment['path'])
+                except OSError:
+                    pass
+                    
         except Exception as e:
-            logger.error(f"❌ Erro no processamento da queue: {e}")
-            time.sleep(5)
+            logger.error(f"❌ Erro no cache de segmentos: {e}")
+            time.sleep(2)
+    
+    clear_segment_cache()
+    logger.info("🧩 Cache de segmentos encerrado")
 
-def recover_pending_uploads():
-    """Recupera uploads pendentes do banco na inicialização"""
+def get_segment_cache_status():
+    """Resumo do cache de segmentos para o /status"""
+    with segment_cache_lock:
+        segments = len(segment_cache)
+        frames = sum(seg['frames'] for seg in segment_cache)
+    
+    return {
+        "enabled": SEGMENT_CACHE_ENABLED,
+        "segment_seconds": SEGMENT_CACHE_SECONDS,
+        "segments": segments,
+        "cached_seconds": round(frames / (detected_fps or FORCE_FPS), 1),
+        "directory": SEGMENT_CACHE_DIR
+    }
+
+def assemble_from_segment_cache(frames_to_save, end_seq, output_path):
+    """Monta o clipe juntando segmentos prontos e codificando só o começo e a cauda parciais"""
+    start_seq = end_seq - len(frames_to_save)
+    
+    with segment_cache_lock:
+        cached = [seg for seg in segment_cache
+                  if seg['start_seq'] + seg['frames'] > start_seq
+                  and seg['dimensions'] == (frame_width, frame_height)]
+    
+    if not cached or cached[0]['start_seq'] > start_seq + int((detected_fps or FORCE_FPS) * SEGMENT_CACHE_SECONDS):
+        return False, "Cache de segmentos não cobre o início do clipe"
+    
+    # Exige segmentos contíguos; o restante vira a cauda codificada agora
+    segments = [cached[0]]
+    for seg in cached[1:]:
+        if seg['start_seq'] != segments[-1]['start_seq'] + segments[-1]['frames']:
+            break
+        segments.append(seg)
+    
+    cached_end = segments[-1]['start_seq'] + segments[-1]['frames']
+    if cached_end > end_seq:
+        return False, "Cache de segmentos à frente do snapshot"
+    
+    work_dir = os.path.join(SEGMENT_CACHE_DIR, 'assembly_' + os.path.splitext(os.path.basename(output_path))[0])
+    os.makedirs(work_dir, exist_ok=True)
+    
     try:
-        conn = sqlite3.connect(DB_PATH, timeout=10.0)
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM upload_queue WHERE status = 'pending'")
-        pending = cursor.fetchall()
-        conn.close()
+        started = time.time()
+        # Hard links protegem os segmentos caso o worker os expire durante a montagem
+        segment_paths = []
+        # Frames antes do primeiro segmento do cache (até SEGMENT_CACHE_SECONDS) viram a cabeça
+        head_frames = frames_to_save[:max(segments[0]['start_seq'] - start_seq, 0)]
+        if head_frames:
+            head_path = os.path.join(work_dir, 'head.mp4')
+            encode_frames_to_segment(head_frames, head_path, threads=1)
+            segment_paths.append(head_path)
+        for i, seg in enumerate(segments):
+            path = os.path.join(work_dir, f'cached_{i:03d}.mp4')
+            try:
+                os.link(seg['path'], path)
+            except OSError:
+                shutil.copyfile(seg['path'], path)
+            segment_paths.append(path)
+        
+        tail_frames = frames_to_save[cached_end - start_seq:]
+        if tail_frames:
+            tail_path = os.path.join(work_dir, 'tail.mp4')
+            encode_frames_to_segment(tail_frames, tail_path, threads=1)
+            segment_paths.append(tail_path)
+        
+        concat_segments(segment_paths, output_path)
+        elapsed = time.time() - started
+        
+        logger.info(f"🧩 Clipe montado do cache em {elapsed:.2f}s "
+                    f"({len(head_frames)} frames de cabeça + {len(segments)} segmentos + "
+                    f"{len(tail_frames)} frames de cauda)")
+        return True, f"Montagem do cache bem-sucedida ({len(segments)} segmentos)"
         
-        for row in pending:
-            upload_item = {
-                'id': row[0],
-                'filename': row[1],
-                'local_path': row[2], 
-                'remote_path': row[3],
-                'timestamp': datetime.fromisoformat(row[4]),
-                'attempts': row[5],
-                'max_attempts': row[6],
-                'file_hash': row[9]
-            }
-            
-            if os.path.exists(upload_item['local_path']):
-                upload_queue.put(upload_item)
-                logger.info(f"📋 Recuperado upload pendente: {upload_item['filename']}")
-            else:
-                mark_upload_failed(upload_item, "Arquivo não encontrado na recuperação")
-                
     except Exception as e:
-        logger.error(f"❌ Erro ao recuperar uploads pendentes: {e}")
+        error_msg = f"Erro na montagem do cache de segmentos: {e}"
+        logger.warning(f"⚠️ {error_msg}")
+        return False, error_msg
+        
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
 
-def mark_upload_completed(upload_item, url):
-    """Marca upload como concluído no banco"""
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('''
-        UPDATE upload_queue SET status = 'completed', error_message = ?
-        WHERE filename = ? AND local_path = ?
-        ''', (url, upload_item['filename'], upload_item['local_path']))
+# === CIRCUIT BREAKER PARA SERVIÇOS REMOTOS ===
+class CircuitBreaker:
+    """Circuit breaker (closed/open/half_open) com sonda barata e backoff exponencial"""
+    
+    def __init__(self, name, probe, failure_threshold=3, base_backoff=5, max_backoff=300):
+        self.name = name
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.state = 'closed'
+        self.failures = 0
+        self.backoff = base_backoff
+        self.next_probe_at = 0.0
+        self.probing = False
+        self.opened_at = None
+        self.cond = threading.Condition()
+    
+    def record_success(self):
+        with self.cond:
+            if self.state != 'closed':
+                logger.info(f"🟢 Circuito {self.name} fechado: serviço acessível novamente")
+            self.state = 'closed'
+            self.failures = 0
+            self.backoff = self.base_backoff
+            self.opened_at = None
+            self.cond.notify_all()
+    
+    def record_failure(self):
+        with self.cond:
+            self.failures += 1
+            if self.state == 'half_open':
+                # Sonda passou mas a requisição real falhou: reabre com backoff maior
+                self.backoff = min(self.backoff * 2, self.max_backoff)
+                self._open()
+            elif self.state == 'closed' and self.failures >= self.failure_threshold:
+                self._open()
+    
+    def _open(self):
+        if self.state != 'open':
+            logger.warning(f"🔴 Circuito {self.name} aberto após {self.failures} falha(s); "
+                           f"próxima sonda em {self.backoff}s")
+        self.state = 'open'
+        self.opened_at = self.opened_at or time.time()
+        self.next_probe_at = time.monotonic() + self.backoff
+    
+    def is_open(self):
+        return self.state == 'open'
+    
+    def wait_until_available(self, timeout=None):
+        """Bloqueia enquanto o circuito estiver aberto; uma única thread envia a sonda"""
+        deadline = time.monotonic() + timeout if timeout else None
         
-        cursor.execute('UPDATE system_status SET total_uploads = total_uploads + 1 WHERE id = 1')
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        logger.error(f"❌ Erro ao marcar upload como concluído: {e}")
+        while True:
+            with self.cond:
+                if self.state != 'open':
+                    return True
+                if deadline and time.monotonic() >= deadline:
+                    return False
+                
+                run_probe = not self.probing and time.monotonic() >= self.next_probe_at
+                if run_probe:
+                    self.probing = True
+                else:
+                    self.cond.wait(timeout=max(min(self.next_probe_at - time.monotonic(), 5), 0.1))
+                    continue
+            
+            try:
+                probe_ok = self.probe()
+            except Exception:
+                probe_ok = False
+            
+            with self.cond:
+                self.probing = False
+                if probe_ok:
+                    logger.info(f"🟡 Sonda do circuito {self.name} respondeu, liberando tráfego")
+                    self.state = 'half_open'
+                else:
+                    self.backoff = min(self.backoff * 2, self.max_backoff)
+                    self.next_probe_at = time.monotonic() + self.backoff
+                    logger.debug(f"Sonda do circuito {self.name} falhou, próxima em {self.backoff}s")
+                self.cond.notify_all()
+    
+    def get_status(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "backoff_seconds": self.backoff,
+            "opened_at": datetime.fromtimestamp(self.opened_at).isoformat() if self.opened_at else None
+        }
 
-def mark_upload_failed(upload_item, error_msg):
-    """Marca upload como falhou no banco"""
+def tcp_probe(host, port, timeout=5):
+    """Sonda barata: só abre e fecha uma conexão TCP"""
+    def _probe():
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    return _probe
+
+def _webhook_probe_target():
+    parsed = urlparse(WEBHOOK_URL)
+    return parsed.hostname or 'localhost', parsed.port or (443 if parsed.scheme == 'https' else 80)
+
+def _b2_probe_target():
+    # Realm nomeado usa a API pública; URL (emulador) é sondada no próprio host
+    if '://' not in B2_REALM:
+        return 'api.backblazeb2.com', 443
+    parsed = urlparse(B2_REALM)
+    return parsed.hostname or 'localhost', parsed.port or (443 if parsed.scheme == 'https' else 80)
+
+b2_auth_breaker = CircuitBreaker('b2_auth', tcp_probe(*_b2_probe_target()),
+                                 CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_BASE_BACKOFF, CIRCUIT_MAX_BACKOFF)
+b2_upload_breaker = CircuitBreaker('b2_upload', tcp_probe(*_b2_probe_target()),
+                                   CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_BASE_BACKOFF, CIRCUIT_MAX_BACKOFF)
+webhook_breaker = CircuitBreaker('webhook', tcp_probe(*_webhook_probe_target()),
+                                 CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_BASE_BACKOFF, CIRCUIT_MAX_BACKOFF)
+
+# === FILA PERSISTIDA DO WEBHOOK ===
+def send_to_webhook_async(arquivo, url, data_hora, extra=None, idempotency_key=None):
+    """Grava o webhook na tabela webhook_outbox; a thread do webhook entrega em ordem
+    
+    A chave vai junto em cada tentativa: um POST que estourou o timeout mas chegou ao site
+    é reenviado com a mesma chave e o site descarta a duplicata.
+    """
+    key = idempotency_key or uuid.uuid4().hex
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('''
-        UPDATE upload_queue SET status = 'failed', error_message = ?
-        WHERE filename = ? AND local_path = ?
-        ''', (error_msg, upload_item['filename'], upload_item['local_path']))
-        
-        cursor.execute('UPDATE system_status SET failed_uploads = failed_uploads + 1 WHERE id = 1')
+        conn = sqlite3.connect(DB_PATH, timeout=10.0)
+        conn.execute('''
+        INSERT OR IGNORE INTO webhook_outbox (idempotency_key, arquivo, url, data_hora, extra, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', (key, arquivo, url, data_hora, json.dumps(extra) if extra else None, time.time()))
         conn.commit()
         conn.close()
     except Exception as e:
-        logger.error(f"❌ Erro ao marcar upload como falhado: {e}")
+        logger.error(f"❌ Erro ao gravar webhook de {arquivo} no banco: {e}")
+        return
+    webhook_event.set()
 
-# === FUNÇÃO DE UPLOAD PARA B2 COM RETRY ===
-def upload_to_b2_with_retry(upload_item):
-    """Faz upload com retry automático"""
-    for attempt in range(3):  # 3 tentativas imediatas
+def next_webhook():
+    """Entrada mais antiga da tabela webhook_outbox, ou None"""
+    conn = sqlite3.connect(DB_PATH, timeout=10.0)
+    row = conn.execute('''
+    SELECT id, idempotency_key, arquivo, url, data_hora, extra, attempts, created_at
+    FROM webhook_outbox ORDER BY id LIMIT 1
+    ''').fetchone()
+    conn.close()
+    return row
+
+def finish_webhook(outbox_id, retry=False):
+    """Tira a entrada da tabela (entregue ou desistida) ou conta mais uma tentativa"""
+    conn = sqlite3.connect(DB_PATH, timeout=10.0)
+    if retry:
+        conn.execute('UPDATE webhook_outbox SET attempts = attempts + 1 WHERE id = ?', (outbox_id,))
+    else:
+        conn.execute('DELETE FROM webhook_outbox WHERE id = ?', (outbox_id,))
+    conn.commit()
+    conn.close()
+
+def webhook_worker():
+    """Thread que entrega os webhooks da tabela webhook_outbox, um por vez e em ordem"""
+    while upload_thread_running:
+        webhook_event.clear()
         try:
-            bucket = init_b2()
-            if not bucket:
-                if attempt == 2:  # Última tentativa
-                    return False, "Falha na conexão com B2 após 3 tentativas"
-                time.sleep(5)
+            row = next_webhook()
+        except Exception as e:
+            logger.error(f"❌ Erro ao ler webhooks pendentes: {e}")
+            time.sleep(CIRCUIT_BASE_BACKOFF)
+            continue
+        if not row:
+            webhook_event.wait(timeout=5)
+            continue
+        
+        outbox_id, key, arquivo, url, data_hora, extra, attempts, created_at = row
+        try:
+            if time.time() - created_at > WEBHOOK_MAX_AGE_HOURS * 3600:
+                logger.error(f"❌ Webhook descartado após {WEBHOOK_MAX_AGE_HOURS:g}h sem entrega "
+                             f"({attempts} tentativa(s)): {arquivo}")
+                finish_webhook(outbox_id)
                 continue
             
-            logger.info(f"🔄 Upload tentativa {attempt + 1}: {upload_item['filename']}")
-            
-            bucket.upload_local_file(
-                local_file=upload_item['local_path'],
-                file_name=upload_item['remote_path']
-            )
-            
-            # Gera URL público do arquivo
-            file_url = f"https://f005.backblazeb2.com/file/{B2_BUCKET_NAME}/{upload_item['remote_path']}"
-            return True, file_url
+            # Com o host fora do ar, aguarda o circuito fechar em vez de falhar
+            if not webhook_breaker.wait_until_available(timeout=60):
+                continue
             
+            extra = json.loads(extra) if extra else {}
+            extra['chave_idempotencia'] = key
+            success, result = send_to_webhook(arquivo, url, data_hora, extra)
+            if success:
+                logger.info(f"✅ Webhook enviado: {arquivo}")
+                finish_webhook(outbox_id)
+            elif result in ("Timeout na requisição", "Erro de conexão"):
+                # O site pode ter recebido: a nova tentativa leva a mesma chave
+                finish_webhook(outbox_id, retry=True)
+                time.sleep(CIRCUIT_BASE_BACKOFF)
+            else:
+                logger.error(f"❌ Falha no webhook: {result}")
+                finish_webhook(outbox_id)
         except Exception as e:
-            logger.warning(f"⚠️ Tentativa {attempt + 1} falhou: {e}")
-            if attempt == 2:  # Última tentativa
-                return False, str(e)
-            time.sleep(5)  # Aguarda 5s entre tentativas
-    
-    return False, "Todas as tentativas falharam"
+            logger.error(f"❌ Erro na thread do webhook: {e}")
+            time.sleep(CIRCUIT_BASE_BACKOFF)
+
+def send_to_webhook(arquivo, url, data_hora, extra=None):
+    """Envia os dados do vídeo para o webhook do site"""
+    try:
+        # Dados em formato form-data (como esperado pelo webhook PHP)
+        data = {
+            'arquivo': arquivo,
+            'url': url,
+            'data_hora': data_hora
+        }
+        # Campos adicionais (ex.: início e duração do trigger dentro de um clipe agrupado)
+        if extra:
+            data.update(extra)
+        
+        # Headers para simular uma requisição de navegador
+        headers = {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+            'Accept': 'application/json, text/plain, */*',
+            'Accept-Language': 'pt-BR,pt;q=0.9,en;q=0.8',
+            'Accept-Encoding': 'gzip, deflate, br',
+            'Connection': 'keep-alive',
+            'Cache-Control': 'no-cache'
+        }
+        # Mesma chave nas retentativas: o site deduplica pelo campo ou pelo header
+        if data.get('chave_idempotencia'):
+            headers['Idempotency-Key'] = str(data['chave_idempotencia'])
+        
+        logger.info(f"Enviando dados para webhook: {data}")
+        
+        # Envia a requisição POST
+        request_started = time.monotonic()
+        response = requests.post(
+            WEBHOOK_URL, 
+            data=data,  # Usando data= para form-data
+            headers=headers,
+            timeout=30
+        )
+        metrics.observe('stage_seconds', time.monotonic() - request_started, stage='webhook')
+        metrics.inc('webhooks_total', result='ok' if response.status_code == 200 else 'error')
+        # Qualquer resposta HTTP prova que o host está acessível
+        webhook_breaker.record_success()
+        
+        if response.status_code == 200:
+            try:
+                result = response.json()
+                logger.info(f"Webhook respondeu com sucesso: {result}")
+                return True, result
+            except:
+                logger.info(f"Webhook respondeu com sucesso: {response.text}")
+                return True, response.text
+        else:
+            logger.warning(f"Webhook retornou erro {response.status_code}: {response.text}")
+            return False, f"Erro HTTP {response.status_code}"
+            
+    except requests.exceptions.Timeout:
+        logger.error("Timeout ao enviar para webhook")
+        metrics.inc('webhooks_total', result='error')
+        webhook_breaker.record_failure()
+        return False, "Timeout na requisição"
+    except requests.exceptions.ConnectionError:
+        logger.error("Erro de conexão ao enviar para webhook")
+        metrics.inc('webhooks_total', result='error')
+        webhook_breaker.record_failure()
+        return False, "Erro de conexão"
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Erro ao enviar para webhook: {e}")
+        return False, str(e)
+    except Exception as e:
+        logger.error(f"Erro inesperado no webhook: {e}")
+        return False, str(e)
+
+# === ÍNDICE LOCAL DE CLIPES ===
+class ClipStore:
+    """Índice dos arquivos locais (persistido no SQLite) com contabilidade de bytes O(1)
+
+    Estados: 'encoding' (temporário em escrita), 'pending' (na fila de upload), 'uploaded'
+    (já no B2, mantido como cache local) e 'failed' (upload desistiu). O despejo por
+    orçamento remove primeiro os 'uploaded' em ordem LRU, depois os 'failed'; pendentes e
+    em codificação nunca são removidos. Snapshots de jobs duráveis ficam fixados (pinned):
+    não expiram mesmo que o aparelho passe dias desligado antes da recuperação.
+    """
+    
+    EVICTABLE = ('uploaded', 'failed')
+    
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.entries = {}
+        self.lru = {state: OrderedDict() for state in self.EVICTABLE}
+        self.bytes_by_state = {}
+        self.count_by_state = {}
+        self.total_bytes = 0
+        self.free_bytes = None
+        self.written_since_sample = 0
+        self.avg_clip_bytes = 0
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        self.pinned = set()
+    
+    # --- Contabilidade em memória (chamar com self.lock) ---
+    def _account(self, entry, sign):
+        state = entry['state']
+        self.bytes_by_state[state] = self.bytes_by_state.get(state, 0) + sign * entry['size']
+        self.count_by_state[state] = self.count_by_state.get(state, 0) + sign
+        self.total_bytes += sign * entry['size']
+        if state in self.lru:
+            if sign > 0:
+                self.lru[state][entry['path']] = entry
+            else:
+                self.lru[state].pop(entry['path'], None)
+    
+    def _persist(self, entry):
+        try:
+            conn = sqlite3.connect(DB_PATH, timeout=10.0)
+            conn.execute('''
+            INSERT OR REPLACE INTO local_files (path, clip_name, size, state, last_access, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''', (entry['path'], entry['clip'], entry['size'], entry['state'],
+                  entry['last_access'], entry['created_at']))
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao salvar índice local ({entry['path']}): {e}")
+    
+    def _delete_row(self, path):
+        try:
+            conn = sqlite3.connect(DB_PATH, timeout=10.0)
+            conn.execute('DELETE FROM local_files WHERE path = ?', (path,))
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.warning(f"⚠️ Erro ao remover do índice local ({path}): {e}")
+    
+    # --- Registro de arquivos ---
+    def track(self, path, state, clip=None, last_access=None):
+        """Registra (ou atualiza) um arquivo recém-escrito; um getsize por arquivo"""
+        path = os.path.normpath(path)
+        if staging.is_staged(path):
+            return  # O orçamento é do disco; intermediários em RAM ficam com o StagingArea
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        now = last_access or time.time()
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry:
+                self._account(entry, -1)
+                self.written_since_sample += max(size - entry['size'], 0)
+                entry.update(size=size, state=state, last_access=now, clip=clip or entry['clip'])
+            else:
+                self.written_since_sample += size
+                entry = {'path': path, 'clip': clip, 'size': size, 'state': state,
+                         'last_access': now, 'created_at': now}
+                self.entries[path] = entry
+            self._account(entry, +1)
+            # Média móvel do tamanho dos clipes: estimativa de espaço para o próximo trigger
+            if state == 'pending' and path.endswith('.mp4'):
+                self.avg_clip_bytes = size if not self.avg_clip_bytes else int(0.8 * self.avg_clip_bytes + 0.2 * size)
+        self._persist(entry)
+    
+    def set_state(self, path, state):
+        path = os.path.normpath(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if not entry:
+                return self.track(path, state)
+            self._account(entry, -1)
+            entry['state'] = state
+            entry['last_access'] = time.time()
+            self._account(entry, +1)
+        self._persist(entry)
+    
+    def touch(self, path):
+        """Marca acesso: o arquivo vai para o fim da fila LRU do seu estado"""
+        path = os.path.normpath(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if not entry:
+                return
+            entry['last_access'] = time.time()
+            if entry['state'] in self.lru:
+                self.lru[entry['state']].move_to_end(path)
+        self._persist(entry)
+    
+    def pin(self, path):
+        """Snapshot de job durável: fica em 'encoding' até o job terminar, sem expirar"""
+        with self.lock:
+            self.pinned.add(os.path.normpath(path))
+    
+    def forget(self, path):
+        """Tira do índice um arquivo que o próprio app removeu"""
+        path = os.path.normpath(path)
+        with self.lock:
+            self.pinned.discard(path)
+            entry = self.entries.pop(path, None)
+            if entry:
+                self._account(entry, -1)
+        if entry:
+            self._delete_row(path)
+    
+    def remove(self, path):
+        """Apaga o arquivo do disco e do índice; retorna os bytes liberados"""
+        path = os.path.normpath(path)
+        with self.lock:
+            entry = self.entries.get(path)
+        size = entry['size'] if entry else 0
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"⚠️ Não foi possível remover {path}: {e}")
+            return 0
+        self.forget(path)
+        # Pasta HLS fica vazia quando o último segmento sai
+        parent = os.path.dirname(path)
+        if parent.endswith('_hls'):
+            try:
+                os.rmdir(parent)
+            except OSError:
+                pass
+        with self.lock:
+            self.free_bytes = self.free_bytes + size if self.free_bytes is not None else None
+        return size
+    
+    # --- Espaço ---
+    def sample_free(self):
+        """Atualiza a amostra de espaço livre (shutil.disk_usage) fora do caminho do trigger"""
+        try:
+            free = shutil.disk_usage('videos' if os.path.isdir('videos') else '.').free
+        except OSError as e:
+            logger.warning(f"⚠️ Não foi possível verificar espaço em disco: {e}")
+            return
+        with self.lock:
+            self.free_bytes = free
+            self.written_since_sample = 0
+    
+    def estimated_free(self):
+        with self.lock:
+            if self.free_bytes is None:
+                return None
+            return self.free_bytes - self.written_since_sample
+    
+    def needed_bytes(self):
+        # Temporário + final de um clipe médio (50 MB enquanto não há histórico)
+        return 2 * (self.avg_clip_bytes or 50 * 1024 * 1024)
+    
+    def has_room(self, needed=0):
+        """Checagem O(1) só com os contadores em memória (orçamento e piso de espaço livre)"""
+        with self.lock:
+            if self.total_bytes + needed > STORAGE_BUDGET_BYTES:
+                return False
+            return self.has_free_space(needed)
+    
+    def has_free_space(self, needed=0):
+        """Só o espaço físico: o que decide se um trigger pode gravar"""
+        with self.lock:
+            free = self.estimated_free()
+            return free is None or free - needed >= STORAGE_MIN_FREE_BYTES
+    
+    def evict(self, needed=0):
+        """Remove 'uploaded' (LRU) e depois 'failed' até caber no orçamento e no piso de espaço livre"""
+        removed = 0
+        freed = 0
+        while not self.has_room(needed):
+            with self.lock:
+                victim = next((next(iter(self.lru[state])) for state in self.EVICTABLE if self.lru[state]), None)
+            if victim is None:
+                break
+            size = self.remove(victim)
+            if not size and os.path.exists(victim):
+                break  # Não conseguiu apagar: evita laço infinito
+            removed += 1
+            freed += size
+        if removed:
+            with self.lock:
+                self.evicted_files += removed
+                self.evicted_bytes += freed
+            logger.info(f"🧹 Despejo local: {removed} arquivo(s), {freed / (1024**2):.1f} MB liberados")
+        return freed
+    
+    def ensure_room(self, needed=None):
+        """Caminho do trigger: em memória; só despeja e reamostra o disco se faltar espaço
+
+        Acima do orçamento despeja o que puder, mas só recusa (False) quando falta espaço
+        físico: numa queda do uplink os pendentes passam do orçamento e a gravação continua.
+        """
+        needed = self.needed_bytes() if needed is None else needed
+        if self.has_room(needed):
+            return True
+        self.evict(needed)
+        self.sample_free()
+        return self.has_free_space(needed)
+    
+    def expire_stale(self):
+        """Remove temporários 'encoding' esquecidos por um crash (mais velhos que STALE_HOURS)"""
+        limit = time.time() - STORAGE_STALE_HOURS * 3600
+        with self.lock:
+            stale = [path for path, entry in self.entries.items()
+                     if entry['state'] == 'encoding' and entry['last_access'] < limit
+                     and path not in self.pinned]
+        for path in stale:
+            self.remove(path)
+            logger.info(f"🗑️ Temporário abandonado removido: {path}")
+    
+    def maintain(self):
+        """Rodado pelo watchdog: reamostra o disco, expira temporários e despeja se preciso"""
+        self.sample_free()
+        self.expire_stale()
+        self.evict()
+    
+    # --- Inicialização ---
+    def load(self):
+        """Carrega o índice do banco e reconcilia com o disco (arquivos sumidos ou não indexados)"""
+        try:
+            conn = sqlite3.connect(DB_PATH, timeout=10.0)
+            rows = conn.execute('SELECT path, clip_name, size, state, last_access, created_at FROM local_files').fetchall()
+            queue_states = dict(conn.execute(
+                'SELECT local_path, status FROM upload_queue ORDER BY id').fetchall())
+            conn.close()
+        except Exception as e:
+            logger.error(f"❌ Erro ao carregar índice local: {e}")
+            return
+        
+        status_to_state = {'pending': 'pending', 'uploading': 'pending', 'completed': 'uploaded', 'failed': 'failed'}
+        missing = []
+        with self.lock:
+            for path, clip, size, state, last_access, created_at in rows:
+                if not os.path.exists(path):
+                    missing.append(path)
+                    continue
+                # A queue manda: um crash entre os dois UPDATEs não deixa um pendente despejável
+                if status_to_state.get(queue_states.get(path)) == 'pending':
+                    state = 'pending'
+                entry = {'path': path, 'clip': clip, 'size': os.path.getsize(path), 'state': state,
+                         'last_access': last_access, 'created_at': created_at}
+                self.entries[path] = entry
+            # Ordem LRU reconstruída pelo último acesso
+            for entry in sorted(self.entries.values(), key=lambda e: e['last_access']):
+                self._account(entry, +1)
+        for path in missing:
+            self._delete_row(path)
+        
+        # Arquivos de versões anteriores (ou de um crash antes do registro)
+        adopted = 0
+        for folder in ('videos/final', 'videos/temp'):
+            for root, _, files in os.walk(folder):
+                if 'segment_cache' in root:
+                    continue
+                for filename in files:
+                    path = os.path.normpath(os.path.join(root, filename))
+                    if path in self.entries:
+                        continue
+                    state = status_to_state.get(queue_states.get(path), 'encoding')
+                    self.track(path, state, last_access=os.path.getmtime(path))
+                    adopted += 1
+        
+        self.sample_free()
+        summary = self.summary()
+        logger.info(f"🗂️ Índice local: {sum(summary['files'].values())} arquivo(s), "
+                    f"{summary['total_mb']:.1f} MB de {summary['budget_mb']:.0f} MB"
+                    f"{f', {adopted} adotado(s) do disco' if adopted else ''}"
+                    f"{f', {len(missing)} sumido(s)' if missing else ''}")
+        self.maintain()
+    
+    def summary(self):
+        with self.lock:
+            free = self.estimated_free()
+            return {
+                "files": {state: count for state, count in self.count_by_state.items() if count},
+                "mb_by_state": {state: round(size / (1024**2), 1)
+                                for state, size in self.bytes_by_state.items() if size},
+                "total_mb": round(self.total_bytes / (1024**2), 1),
+                "budget_mb": round(STORAGE_BUDGET_BYTES / (1024**2), 1),
+                "free_mb_estimated": round(free / (1024**2), 1) if free is not None else None,
+                "min_free_mb": round(STORAGE_MIN_FREE_BYTES / (1024**2), 1),
+                "evicted_files": self.evicted_files,
+                "evicted_mb": round(self.evicted_bytes / (1024**2), 1)
+            }
+
+clip_store = ClipStore()
+
+# === ÁREA DE STAGING EM RAM (TMPFS) ===
+class StagingArea:
+    """Intermediários (temporário do OpenCV, união do modo trim, segmentos) num tmpfs
+
+    Só usa a RAM se couber no limite do staging, no espaço do tmpfs e ainda sobrar
+    STAGING_MIN_FREE_RAM; senão cai para videos/temp. Conta os bytes escritos por camada
+    (tmpfs x disco) para medir o desgaste do cartão SD.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reserved = {}
+        self.bytes_written = {'tmpfs': 0, 'disk': 0}
+        self.bytes_per_frame = 0
+        self.fallbacks = 0
+        self.mounts = None
+    
+    def enabled(self):
+        return bool(STAGING_DIR) and os.path.isdir(STAGING_DIR)
+    
+    def tier(self, path):
+        """'tmpfs' se o arquivo está num sistema de arquivos em RAM, senão 'disk'"""
+        if self.mounts is None:
+            try:
+                with open('/proc/mounts') as f:
+                    self.mounts = sorted(((line.split()[1], line.split()[2]) for line in f),
+                                         key=lambda mount: len(mount[0]), reverse=True)
+            except OSError:
+                self.mounts = []
+        real = os.path.realpath(path)
+        for mount_point, fstype in self.mounts:
+            if real == mount_point or real.startswith(mount_point.rstrip('/') + '/'):
+                return 'tmpfs' if fstype in ('tmpfs', 'ramfs') else 'disk'
+        return 'disk'
+    
+    def available_ram(self):
+        if PSUTIL_AVAILABLE:
+            return psutil.virtual_memory().available
+        try:
+            with open('/proc/meminfo') as f:
+                for line in f:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+    
+    def estimate(self, num_frames):
+        # Tamanho esperado do temporário (x2: segmentos da codificação paralela ao lado)
+        per_frame = self.bytes_per_frame or frame_width * frame_height * 3 // 20
+        return 2 * num_frames * per_frame
+    
+    def path_for(self, filename, expected_bytes):
+        """Caminho para um intermediário: no tmpfs se couber, senão em videos/temp"""
+        disk_path = os.path.join('videos', 'temp', filename)
+        if not self.enabled():
+            return disk_path
+        reason = None
+        with self.lock:
+            in_use = sum(self.reserved.values())
+            if in_use + expected_bytes > STAGING_MAX_BYTES:
+                reason = f"limite do staging ({in_use / (1024**2):.0f} MB em uso)"
+        if not reason:
+            try:
+                tmpfs_free = shutil.disk_usage(STAGING_DIR).free
+            except OSError:
+                tmpfs_free = 0
+            ram = self.available_ram()
+            if expected_bytes > tmpfs_free:
+                reason = f"tmpfs com {tmpfs_free / (1024**2):.0f} MB livres"
+            elif ram is not None and ram - expected_bytes < STAGING_MIN_FREE_RAM:
+                reason = f"RAM disponível {ram / (1024**2):.0f} MB"
+        if reason:
+            with self.lock:
+                self.fallbacks += 1
+            logger.info(f"💽 Staging em disco para {filename}: {reason}")
+            return disk_path
+        path = os.path.join(STAGING_DIR, filename)
+        with self.lock:
+            self.reserved[path] = expected_bytes
+        return path
+    
+    def is_staged(self, path):
+        return bool(STAGING_DIR) and os.path.abspath(path).startswith(os.path.abspath(STAGING_DIR) + os.sep)
+    
+    def record_write(self, path, num_frames=None):
+        """Soma o tamanho de um arquivo recém-escrito na camada onde ele está"""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return 0
+        tier = self.tier(path)
+        with self.lock:
+            self.bytes_written[tier] += size
+            if path in self.reserved:
+                self.reserved[path] = size
+            if num_frames:
+                per_frame = size // max(num_frames, 1)
+                self.bytes_per_frame = per_frame if not self.bytes_per_frame else (self.bytes_per_frame * 4 + per_frame) // 5
+        metrics.inc('storage_bytes_written_total', size, tier=tier)
+        return size
+    
+    def release(self, path):
+        with self.lock:
+            self.reserved.pop(path, None)
+    
+    def adopt(self, path):
+        """Snapshot que sobreviveu a um crash: volta a contar no limite do staging"""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self.lock:
+            self.reserved[path] = size
+    
+    @staticmethod
+    def is_frame_ring(path):
+        """O anel de frames pode morar no staging, mas não é intermediário"""
+        return FRAME_RING_ENABLED and os.path.abspath(path).startswith(os.path.abspath(FRAME_RING_PATH))
+    
+    def clear(self):
+        """Na inicialização: nenhum job está rodando, tudo no staging é sobra (menos os snapshots fixados)"""
+        if not self.enabled():
+            if STAGING_DIR:
+                try:
+                    os.makedirs(STAGING_DIR, exist_ok=True)
+                except OSError as e:
+                    logger.warning(f"⚠️ Staging indisponível em {STAGING_DIR}: {e}")
+                    return
+            else:
+                return
+        removed = 0
+        for entry in os.scandir(STAGING_DIR):
+            if self.is_frame_ring(entry.path) or os.path.normpath(entry.path) in clip_store.pinned:
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.remove(entry.path)
+                removed += 1
+            except OSError:
+                pass
+        logger.info(f"💨 Staging em RAM: {STAGING_DIR} ({self.tier(STAGING_DIR)}, limite "
+                    f"{STAGING_MAX_BYTES // (1024**2)} MB){f', {removed} sobra(s) removida(s)' if removed else ''}")
+    
+    def expire(self, max_age=3600):
+        """Remove intermediários esquecidos (job que falhou no meio) para não prender RAM"""
+        if not self.enabled():
+            return
+        limit = time.time() - max_age
+        for entry in os.scandir(STAGING_DIR):
+            if self.is_frame_ring(entry.path) or os.path.normpath(entry.path) in clip_store.pinned:
+                continue
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime >= limit:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.remove(entry.path)
+                self.release(entry.path)
+                logger.info(f"🗑️ Intermediário abandonado removido do staging: {entry.name}")
+            except OSError:
+                pass
+    
+    def summary(self):
+        with self.lock:
+            return {
+                "dir": STAGING_DIR or None,
+                "enabled": self.enabled(),
+                "in_use_mb": round(sum(self.reserved.values()) / (1024**2), 1),
+                "max_mb": round(STAGING_MAX_BYTES / (1024**2), 1),
+                "disk_fallbacks": self.fallbacks,
+                "written_mb": {tier: round(size / (1024**2), 1) for tier, size in self.bytes_written.items()}
+            }
+
+staging = StagingArea()
+
+# === INICIALIZAÇÃO DO BACKBLAZE B2 ===
+b2_bucket_cache = None
+b2_bucket_lock = threading.Lock()
+b2_download_url = B2_DOWNLOAD_URL or 'https://f005.backblazeb2.com'
+
+def init_b2():
+    """Inicializa a conexão com o Backblaze B2 (autoriza uma vez e reutiliza o bucket)"""
+    global b2_bucket_cache, b2_download_url
+    
+    with b2_bucket_lock:
+        if b2_bucket_cache is not None:
+            return b2_bucket_cache
+        
+        # Sem conectividade não adianta tentar autorizar de novo
+        if b2_auth_breaker.is_open():
+            return None
+        
+        try:
+            info = InMemoryAccountInfo()
+            b2_api = B2Api(info)
+            b2_api.authorize_account(B2_REALM, B2_KEY_ID, B2_APPLICATION_KEY)
+            bucket = b2_api.get_bucket_by_name(B2_BUCKET_NAME)
+            if not B2_DOWNLOAD_URL:
+                b2_download_url = info.get_download_url().rstrip('/')
+            logger.info("Conectado ao Backblaze B2 com sucesso!")
+            b2_auth_breaker.record_success()
+            b2_bucket_cache = bucket
+            return bucket
+        except Exception as e:
+            logger.error(f"Erro ao conectar no Backblaze B2: {e}")
+            b2_auth_breaker.record_failure()
+            return None
+
+def reset_b2_connection():
+    """Descarta o bucket autorizado para forçar nova autorização"""
+    global b2_bucket_cache
+    with b2_bucket_lock:
+        b2_bucket_cache = None
+
+def wait_for_b2_circuits():
+    """Pausa o worker enquanto algum circuito do B2 estiver aberto"""
+    b2_auth_breaker.wait_until_available()
+    b2_upload_breaker.wait_until_available()
+
+# === URL PÚBLICA DE UM ARQUIVO NO B2 ===
+def build_b2_url(remote_path):
+    """Gera a URL pública de download de um arquivo no bucket"""
+    return f"{b2_download_url}/file/{B2_BUCKET_NAME}/{remote_path}"
+
+# === UPLOAD DE UMA PARTE DE LARGE FILE NO B2 ===
+def b2_upload_part(bucket, file_id, part_number, data, max_retries=3):
+    """Envia uma parte de um large file com retry e retorna o SHA1 da parte"""
+    sha1 = hashlib.sha1(data).hexdigest()
+    
+    for attempt in range(max_retries):
+        try:
+            bucket.api.session.upload_part(file_id, part_number, len(data), sha1,
+                                           ThrottledReader(io.BytesIO(data)))
+            return sha1
+        except Exception as e:
+            if attempt == max_retries - 1:
+                raise
+            logger.warning(f"⚠️ Parte {part_number} falhou (tentativa {attempt + 1}): {e}")
+            time.sleep(2 * (2 ** attempt))
+
+# === UPLOAD EM STREAMING PARA O B2 DURANTE A CODIFICAÇÃO ===
+class StreamingB2Upload:
+    """Envia partes de um arquivo para o B2 (API de large files) à medida que são produzidas"""
+    
+    def __init__(self, remote_path):
+        self.remote_path = remote_path
+        self.bucket = None
+        self.file_id = None
+        self.part_sha1s = []
+        self.error = None
+        self.parts = Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def add_part(self, data):
+        self.parts.put(data)
+    
+    def _run(self):
+        while True:
+            data = self.parts.get()
+            if data is None:
+                return
+            if self.error:
+                continue  # Upload já falhou, apenas esvazia a fila
+            
+            try:
+                if self.file_id is None:
+                    self.bucket = init_b2()
+                    if not self.bucket:
+                        raise Exception("Não foi possível conectar ao Backblaze B2")
+                    response = self.bucket.api.session.start_large_file(
+                        self.bucket.id_, self.remote_path, 'video/mp4', {})
+                    self.file_id = response['fileId']
+                
+                part_number = len(self.part_sha1s) + 1
+                started = time.time()
+                self.part_sha1s.append(b2_upload_part(self.bucket, self.file_id, part_number, data))
+                logger.info(f"📤 Parte {part_number} enviada ({len(data) / (1024**2):.1f} MB em {time.time() - started:.2f}s)")
+                
+            except Exception as e:
+                self.error = str(e)
+                logger.warning(f"⚠️ Upload em streaming interrompido: {e}")
+    
+    def finish(self):
+        """Aguarda as partes pendentes e conclui o large file"""
+        self.parts.put(None)
+        self.thread.join()
+        
+        if self.error:
+            self.cancel()
+            return False, self.error
+        
+        try:
+            self.bucket.api.session.finish_large_file(self.file_id, self.part_sha1s)
+            return True, build_b2_url(self.remote_path)
+        except Exception as e:
+            self.cancel()
+            return False, str(e)
+    
+    def abort(self):
+        """Interrompe o envio e descarta as partes já enviadas"""
+        self.error = self.error or "Abortado"
+        self.parts.put(None)
+        self.thread.join()
+        self.cancel()
+    
+    def cancel(self):
+        if self.file_id:
+            try:
+                self.bucket.api.session.cancel_large_file(self.file_id)
+            except Exception as e:
+                logger.debug(f"Erro ao cancelar large file: {e}")
+
+def encode_with_streaming_upload(input_path, output_path, remote_filename, duration=None):
+    """Codifica em MP4 fragmentado e envia as partes ao B2 enquanto o FFmpeg ainda roda
+    
+    Retorna (conversão_ok, upload, mensagem). `upload` traz url e hash quando o
+    arquivo já foi enviado; None quando o upload deve seguir pela queue normal.
+    """
+    cmd = [
+        FFMPEG_CMD,
+        '-hide_banner', '-loglevel', 'error',
+        '-i', input_path,
+        '-an',
+        '-c:v', 'libx264',
+        '-preset', encode_preset(),
+        '-crf', str(ENCODING_CRF),
+        *bitrate_cap_args(duration),
+        '-pix_fmt', PIXEL_FORMAT,
+        '-profile:v', 'baseline',
+        '-level', '3.1',
+        '-tune', ENCODING_TUNE,
+        '-threads', str(encode_threads()),
+        '-g', str(int((detected_fps or FORCE_FPS) * 2)),
+        '-sc_threshold', '0',
+        '-r', str(detected_fps),
+        '-s', output_size(),
+        # MP4 fragmentado: os bytes nunca são reescritos, ao contrário do faststart
+        '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+        '-f', 'mp4',
+        'pipe:1'
+    ]
+    uploader = None
+    try:
+        logger.info(f"📡 Codificando com upload em streaming: {output_path}")
+        started = time.time()
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        
+        file_hash = hashlib.md5()
+        file_sha1 = hashlib.sha1()
+        pending = bytearray()
+        with open(output_path, 'wb') as out:
+            for chunk in iter(lambda: proc.stdout.read(65536), b""):
+                out.write(chunk)
+                file_hash.update(chunk)
+                file_sha1.update(chunk)
+                pending += chunk
+                
+                # Mantém sempre algum byte para a última parte: o large file precisa de duas partes
+                if len(pending) > B2_PART_SIZE:
+                    if uploader is None:
+                        uploader = StreamingB2Upload(remote_filename)
+                    uploader.add_part(bytes(pending[:B2_PART_SIZE]))
+                    del pending[:B2_PART_SIZE]
+        
+        stderr = proc.stderr.read().decode('utf-8', errors='replace')
+        proc.wait(timeout=60)
+        encode_elapsed = time.time() - started
+        
+        if proc.returncode != 0:
+            if uploader:
+                uploader.abort()
+            return False, None, f"Erro no FFmpeg: {stderr.strip()}"
+        
+        if uploader is None:
+            # Arquivo menor que uma parte: o upload simples pela queue é o caminho certo
+            logger.info(f"✅ Conversão concluída em {encode_elapsed:.2f}s (arquivo pequeno, upload pela queue)")
+            return True, None, "Conversão bem-sucedida (MP4 fragmentado)"
+        
+        uploader.add_part(bytes(pending))
+        success, result = uploader.finish()
+        total_elapsed = time.time() - started
+        
+        if not success:
+            logger.warning(f"⚠️ Upload em streaming falhou, usando queue normal: {result}")
+            return True, None, "Conversão bem-sucedida (MP4 fragmentado)"
+        
+        logger.info(f"📡 Codificação {encode_elapsed:.2f}s, upload concluído {total_elapsed - encode_elapsed:.2f}s após o encoder "
+                    f"({len(uploader.part_sha1s)} partes)")
+        return True, {'url': result, 'file_hash': file_hash.hexdigest(), 'file_sha1': file_sha1.hexdigest()}, \
+            "Conversão e upload em streaming bem-sucedidos"
+        
+    except Exception as e:
+        if uploader:
+            uploader.abort()
+        error_msg = f"Erro na conversão com upload em streaming: {e}"
+        logger.error(f"❌ {error_msg}")
+        return False, None, error_msg
+
+# === LIMITADOR DE BANDA ADAPTATIVO PARA UPLOADS ===
+class AdaptiveTokenBucket:
+    """Token bucket de bytes de upload com teto ajustado pela saúde da captura"""
+    
+    def __init__(self, max_rate, min_rate, adaptive=True):
+        self.ceiling = max_rate or None     # bytes/s; None = sem teto configurado
+        self.min_rate = min_rate
+        self.adaptive = adaptive
+        self.rate = self.ceiling            # None = sem limite no momento
+        self.tokens = 0.0
+        self.last_refill = time.monotonic()
+        self.healthy_ticks = 0
+        self.throughput = 0.0               # Estimativa (EWMA) da vazão real de upload
+        self.window_bytes = 0
+        self.window_start = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def consume(self, byte_count):
+        """Bloqueia o chamador até haver orçamento para enviar byte_count bytes"""
+        with self.lock:
+            now = time.monotonic()
+            self._track_throughput(byte_count, now)
+            
+            if not self.rate:
+                return
+            
+            # Permite rajada de até 1s; déficit vira espera proporcional
+            self.tokens = min(self.tokens + (now - self.last_refill) * self.rate, self.rate)
+            self.last_refill = now
+            self.tokens -= byte_count
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        
+        if wait > 0:
+            time.sleep(wait)
+    
+    def _track_throughput(self, byte_count, now):
+        self.window_bytes += byte_count
+        elapsed = now - self.window_start
+        if elapsed >= 2:
+            sample = self.window_bytes / elapsed
+            self.throughput = sample if not self.throughput else 0.7 * self.throughput + 0.3 * sample
+            self.window_bytes = 0
+            self.window_start = now
+    
+    def on_capture_trouble(self):
+        """Captura com problemas: corta a banda pela metade (até o mínimo)"""
+        if not self.adaptive:
+            return
+        with self.lock:
+            base = self.rate or self.throughput or self.ceiling or self.min_rate * 4
+            new_rate = max(self.min_rate, base * 0.5)
+            if new_rate != self.rate:
+                logger.info(f"🐢 Captura instável: upload limitado a {new_rate * 8 / 1000:.0f} kbit/s")
+            self.rate = new_rate
+            self.tokens = min(self.tokens, 0.0)
+            self.healthy_ticks = 0
+    
+    def on_capture_healthy(self):
+        """Captura saudável: devolve a banda aos poucos (25% a cada 10 amostras)"""
+        if not self.adaptive or self.rate == self.ceiling:
+            return
+        with self.lock:
+            self.healthy_ticks += 1
+            if self.healthy_ticks < 10:
+                return
+            self.healthy_ticks = 0
+            self.rate = self.rate * 1.25
+            
+            if self.ceiling and self.rate >= self.ceiling:
+                self.rate = self.ceiling
+            elif not self.ceiling and self.throughput and self.rate >= self.throughput * 2:
+                self.rate = None  # Voltou a sobrar banda: remove o limite
+            
+            if self.rate == self.ceiling:
+                logger.info("🚀 Captura estável: limite de upload restaurado")
+    
+    def get_status(self):
+        return {
+            "ceiling_kbps": round(self.ceiling * 8 / 1000) if self.ceiling else None,
+            "current_kbps": round(self.rate * 8 / 1000) if self.rate else None,
+            "throughput_kbps": round(self.throughput * 8 / 1000),
+            "adaptive": self.adaptive
+        }
+
+upload_limiter = AdaptiveTokenBucket(
+    UPLOAD_MAX_RATE_KBPS * 1000 / 8,
+    UPLOAD_MIN_RATE_KBPS * 1000 / 8,
+    adaptive=UPLOAD_ADAPTIVE_RATE
+)
+
+class ThrottledReader:
+    """Stream de leitura que consome tokens do limitador de upload"""
+    
+    def __init__(self, stream):
+        self.stream = stream
+    
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if data:
+            upload_limiter.consume(len(data))
+        return data
+    
+    def seek(self, *args):
+        return self.stream.seek(*args)
+    
+    def tell(self):
+        return self.stream.tell()
+
+class ThrottlingProgressListener(AbstractProgressListener):
+    """Progress listener do b2sdk que limita a banda de upload_local_file"""
+    
+    def __init__(self):
+        super().__init__()
+        self.last_bytes = 0
+        self.bytes_sent = 0  # Bytes que saíram de fato (inclui os reenviados): amostra do uplink
+    
+    def set_total_bytes(self, total_byte_count):
+        pass
+    
+    def bytes_completed(self, byte_count):
+        # O b2sdk recomeça a contagem quando refaz a requisição
+        delta = byte_count - self.last_bytes if byte_count >= self.last_bytes else byte_count
+        self.last_bytes = byte_count
+        if delta > 0:
+            self.bytes_sent += delta
+            upload_limiter.consume(delta)
+
+# === SISTEMA DE QUEUE PARA UPLOADS ===
+def add_to_upload_queue(local_path, remote_name, priority=False, webhook_entries=None,
+                        kind='full', clip_name=None):
+    """Adiciona arquivo à queue de upload com retry
+
+    priority: True/False ou uma das constantes UPLOAD_PRIORITY_*; kind: 'full' ou 'proxy';
+    clip_name: nome lógico do clipe quando o arquivo é uma versão dele (ex.: proxy).
+    O nível do governador do job em andamento nesta thread fica registrado em encode_level.
+    """
+    job_settings = getattr(encode_context, 'settings', None)
+    try:
+        # Calcula hashes do arquivo: MD5 para integridade local, SHA1 para deduplicação no B2
+        hash_started = time.monotonic()
+        file_hash = hashlib.md5()
+        file_sha1 = hashlib.sha1()
+        with open(local_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                file_hash.update(chunk)
+                file_sha1.update(chunk)
+        metrics.observe('stage_seconds', time.monotonic() - hash_started, stage='hash')
+        
+        upload_item = {
+            'filename': os.path.basename(local_path),
+            'local_path': local_path,
+            'remote_path': remote_name,
+            'timestamp': datetime.now(),
+            'attempts': 0,
+            'max_attempts': 5,
+            'file_hash': file_hash.hexdigest(),
+            'file_sha1': file_sha1.hexdigest(),
+            'priority': int(priority),
+            'webhook_entries': webhook_entries,
+            'kind': kind,
+            'clip_name': clip_name or remote_name
+        }
+        
+        # Adiciona ao banco de dados
+        conn = sqlite3.connect(DB_PATH, timeout=10.0)
+        cursor = conn.cursor()
+        cursor.execute('''
+        INSERT INTO upload_queue (filename, local_path, remote_path, timestamp, file_hash, file_sha1,
+                                  webhook_entries, clip_name, kind, priority, encode_level)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (upload_item['filename'], upload_item['local_path'], 
+              upload_item['remote_path'], upload_item['timestamp'], 
+              upload_item['file_hash'], upload_item['file_sha1'],
+              json.dumps(webhook_entries) if webhook_entries else None,
+              upload_item['clip_name'], kind, upload_item['priority'],
+              job_settings['level'] if job_settings else None))
+        upload_item['id'] = cursor.lastrowid
+        conn.commit()
+        conn.close()
+        
+        staging.record_write(local_path)
+        clip_store.track(local_path, 'pending', upload_item['clip_name'])
+        
+        # Nunca bloqueia: o worker busca o item no banco ao reabastecer a janela
+        upload_queue_event.set()
+        
+        logger.info(f"📋 Arquivo adicionado à queue: {remote_name}")
+        return True
+        
+    except Exception as e:
+        logger.error(f"❌ Erro ao adicionar à queue: {e}")
+        return False
+
+# === FUNÇÃO PARA MARCAR UPLOAD COMO CONCLUÍDO ===
+def mark_upload_completed(upload_item, url):
+    """Marca upload como concluído no banco de dados"""
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=10.0)
+        cursor = conn.cursor()
+        cursor.execute('''
+        UPDATE upload_queue 
+        SET status = 'completed', updated_at = ?, error_message = ?
+        WHERE filename = ? AND local_path = ?
+        ''', (datetime.now(), url, upload_item['filename'], upload_item['local_path']))
+        
+        # Atualiza estatísticas
+        cursor.execute('UPDATE system_status SET uploads_success = uploads_success + 1 WHERE id = 1')
+        
+        conn.commit()
+        conn.close()
+        logger.info(f"✅ Upload marcado como concluído: {upload_item['filename']}")
+        
+    except Exception as e:
+        logger.error(f"❌ Erro ao marcar upload como concluído: {e}")
+
+# === FUNÇÃO PARA MARCAR UPLOAD COMO FALHADO ===
+def mark_upload_failed(upload_item, error_message):
+    """Marca upload como falhado no banco de dados"""
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=10.0)
+        cursor = conn.cursor()
+        cursor.execute('''
+        UPDATE upload_queue 
+        SET status = 'failed', updated_at = ?, error_message = ?
+        WHERE filename = ? AND local_path = ?
+        ''', (datetime.now(), error_message, upload_item['filename'], upload_item['local_path']))
+        
+        # Atualiza estatísticas
+        cursor.execute('UPDATE system_status SET uploads_failed = uploads_failed + 1 WHERE id = 1')
+        
+        conn.commit()
+        conn.close()
+        logger.warning(f"⚠️ Upload marcado como falhado: {upload_item['filename']} - {error_message}")
+        
+    except Exception as e:
+        logger.error(f"❌ Erro ao marcar upload como falhado: {e}")
+
+# === FUNÇÃO PARA UPLOAD COM RETRY AUTOMÁTICO ===
+def upload_to_b2_with_retry(upload_item):
+    """Faz upload para B2 com retry automático e exponential backoff"""
+    max_retries = 3
+    base_delay = 2  # segundos
+    
+    for attempt in range(max_retries):
+        try:
+            # Tenta fazer upload
+            bucket = init_b2()
+            if not bucket:
+                raise Exception("Não foi possível conectar ao Backblaze B2")
+            
+            # Faz upload do arquivo
+            uploaded_file = bucket.upload_local_file(
+                local_file=upload_item['local_path'],
+                file_name=upload_item['remote_path']
+            )
+            
+            # Gera URL pública
+            file_url = build_b2_url(upload_item['remote_path'])
+            
+            logger.info(f"✅ Upload B2 concluído (tentativa {attempt + 1}): {file_url}")
+            return True, file_url
+            
+        except Exception as e:
+            logger.warning(f"⚠️ Tentativa {attempt + 1}/{max_retries} falhou: {e}")
+            
+            if attempt < max_retries - 1:
+                # Exponential backoff
+                delay = base_delay * (2 ** attempt)
+                logger.info(f"🔄 Aguardando {delay}s antes de nova tentativa...")
+                time.sleep(delay)
+            else:
+                # Última tentativa falhou
+                error_message = f"Falha após {max_retries} tentativas: {str(e)}"
+                logger.error(f"❌ {error_message}")
+                return False, error_message
+    
+    return False, "Número máximo de tentativas excedido"
+
+# === DEDUPLICAÇÃO DE UPLOADS JÁ PRESENTES NO B2 ===
+def build_uploaded_index():
+    """Reconstrói do banco o índice de (remote_path, sha1) já enviados"""
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=10.0)
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT remote_path, file_sha1 FROM upload_queue
+        WHERE status = 'completed' AND file_sha1 IS NOT NULL
+        ''')
+        rows = cursor.fetchall()
+        conn.close()
+        
+        with uploaded_index_lock:
+            uploaded_index.clear()
+            uploaded_index.update(rows)
+        logger.info(f"♻️ Índice de uploads concluídos: {len(rows)} arquivo(s)")
+    except Exception as e:
+        logger.error(f"❌ Erro ao reconstruir índice de uploads: {e}")
+
+def find_existing_upload(upload_item):
+    """Retorna a URL se o B2 já tem o arquivo com o mesmo SHA1, senão None"""
+    key = (upload_item['remote_path'], upload_item['file_sha1'])
+    with uploaded_index_lock:
+        if key in uploaded_index:
+            return build_b2_url(upload_item['remote_path'])
+    
+    # Só itens que podem ter sido enviados antes (execução anterior ou tentativa já feita)
+    # justificam a consulta ao B2; clipes novos nunca estão lá
+    if upload_item.get('id', 0) > upload_recovery_max_id and upload_item.get('attempts', 0) == 0:
+        return None
+    
+    try:
+        bucket = init_b2()
+        if not bucket:
+            return None
+        info = bucket.get_file_info_by_name(upload_item['remote_path'])
+        remote_sha1 = info.content_sha1
+        if not remote_sha1 or remote_sha1 == 'none':
+            remote_sha1 = (info.file_info or {}).get('large_file_sha1')
+        
+        if remote_sha1 == upload_item['file_sha1']:
+            return build_b2_url(upload_item['remote_path'])
+    except FileNotPresent:
+        pass
+    except Exception as e:
+        logger.debug(f"Consulta de arquivo no B2 falhou ({upload_item['remote_path']}): {e}")
+    
+    return None
+
+def complete_upload(upload_item, url):
+    """Finaliza um upload: marca no banco, atualiza o índice, remove o local e avisa o webhook"""
+    # Marca antes de remover o arquivo: um crash aqui não gera reenvio nem item perdido
+    mark_upload_completed(upload_item, url)
+    
+    if upload_item.get('file_sha1'):
+        with uploaded_index_lock:
+            uploaded_index.add((upload_item['remote_path'], upload_item['file_sha1']))
+    
+    # A cópia local vira cache despejável (LRU) ou sai na hora
+    if KEEP_UPLOADED_CLIPS:
+        clip_store.set_state(upload_item['local_path'], 'uploaded')
+    elif clip_store.remove(upload_item['local_path']):
+        logger.info(f"🗑️ Arquivo local removido: {upload_item['local_path']}")
+    
+    # Poster e arquivos HLS vão no webhook do MP4, não em webhooks próprios
+    if upload_item.get('kind') == 'asset':
+        resolve_clip_assets(upload_item.get('clip_name'))
+        return
+    
+    webhook_entries = upload_item.get('webhook_entries')
+    if webhook_entries and any('poster' in entry or 'hls' in entry for entry in webhook_entries):
+        with clip_assets_lock:
+            states = load_clip_asset_states(upload_item['remote_path'])
+            if states is not None and any(status not in ('completed', 'failed') for status in states.values()):
+                # Poster/HLS ainda subindo: o webhook sai quando o último deles terminar
+                logger.info(f"⏳ Webhook de {upload_item['filename']} aguarda poster/HLS")
+                return
+            webhook_entries = filter_asset_urls(webhook_entries, states or {})
+    
+    notify_webhook(upload_item['filename'], url, upload_item['timestamp'], webhook_entries,
+                   upload_id=upload_item.get('id'))
+
+def load_clip_asset_states(clip_name):
+    """Status dos uploads de poster/HLS de um clipe (remote_path -> status); None se erro"""
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=10.0)
+        rows = conn.execute('''
+        SELECT remote_path, status FROM upload_queue WHERE kind = 'asset' AND clip_name = ?
+        ''', (clip_name,)).fetchall()
+        conn.close()
+        return dict(rows)
+    except Exception as e:
+        logger.error(f"❌ Erro ao consultar poster/HLS de {clip_name}: {e}")
+        return None
+
+def filter_asset_urls(webhook_entries, states):
+    """Tira do webhook as URLs de poster/HLS cujo upload não foi concluído (links mortos no site)"""
+    drop = set()
+    for remote_path, status in states.items():
+        if status != 'completed':
+            drop.add('hls' if '/hls/' in remote_path else 'poster')
+    if not drop:
+        return webhook_entries
+    logger.warning(f"⚠️ Webhook sem {', '.join(sorted(drop))}: upload não concluído")
+    return [{k: v for k, v in entry.items() if k not in drop} for entry in webhook_entries]
+
+def resolve_clip_assets(clip_name):
+    """Poster/HLS terminou (enviado ou desistido): envia o webhook do MP4 que estava aguardando"""
+    if not clip_name:
+        return
+    with clip_assets_lock:
+        states = load_clip_asset_states(clip_name)
+        if states is None or any(status not in ('completed', 'failed') for status in states.values()):
+            return
+        try:
+            conn = sqlite3.connect(DB_PATH, timeout=10.0)
+            row = conn.execute('''
+            SELECT filename, error_message, timestamp, webhook_entries, id FROM upload_queue
+            WHERE remote_path = ? AND kind = 'full' AND status = 'completed'
+            ORDER BY id DESC LIMIT 1
+            ''', (clip_name,)).fetchone()
+            conn.close()
+        except Exception as e:
+            logger.error(f"❌ Erro ao consultar o MP4 de {clip_name}: {e}")
+            return
+        if not row or not row[3]:
+            return  # O MP4 ainda não subiu: o webhook sai em complete_upload
+        webhook_entries = filter_asset_urls(json.loads(row[3]), states)
+    notify_webhook(row[0], row[1], datetime.fromisoformat(str(row[2])), webhook_entries, upload_id=row[4])
+
+def notify_webhook(filename, url, timestamp, webhook_entries=None, upload_id=None):
+    """Envia ao webhook uma entrada por trigger (clipes agrupados) ou uma só para o arquivo
+    
+    A chave de idempotência é o id do upload_queue mais a posição da entrada.
+    """
+    def _key(index):
+        return f"upload-{upload_id}-{index}" if upload_id is not None else None
+    
+    if not webhook_entries:
+        send_to_webhook_async(filename, url, timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                              idempotency_key=_key(0))
+        return
+    
+    # Uma entrada pode indicar outro nome de clipe (ex.: proxy anunciado com o nome do clipe final)
+    for index, entry in enumerate(webhook_entries):
+        send_to_webhook_async(entry.get('arquivo', filename), url, entry['data_hora'],
+                              {k: v for k, v in entry.items() if k not in ('data_hora', 'arquivo')},
+                              idempotency_key=_key(index))
+
+def process_upload_queue():
+    """Thread para processar queue de uploads com retry automático"""
+    global upload_thread_running
+    
+    # Recupera itens pendentes do banco na inicialização
+    recover_pending_uploads()
+    
+    while upload_thread_running:
+        upload_item = None
+        try:
+            # Pega próximo item da janela, reabastecendo do banco quando vazia ou quando
+            # chegou item novo (um proxy pode passar na frente do que já está na janela)
+            if upload_queue.empty() or upload_queue_event.is_set():
+                upload_queue_event.clear()
+                refill_upload_window()
+            try:
+                upload_item = upload_queue.get_nowait()[2]
+            except Empty:
+                upload_queue_event.wait(timeout=5)
+                continue
+            
+            logger.info(f"🔄 Processando upload: {upload_item['filename']}")
+            if upload_item['attempts'] == 0:
+                metrics.observe('stage_seconds', (datetime.now() - upload_item['timestamp']).total_seconds(),
+                                stage='queue_wait')
+            
+            # Verifica se arquivo ainda existe
+            if not os.path.exists(upload_item['local_path']):
+                logger.warning(f"⚠️ Arquivo não encontrado: {upload_item['local_path']}")
+                mark_upload_failed(upload_item, "Arquivo não encontrado")
+                continue
+            
+            # Verifica integridade do arquivo
+            current_hash = hashlib.md5()
+            current_sha1 = hashlib.sha1()
+            with open(upload_item['local_path'], 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b""):
+                    current_hash.update(chunk)
+                    current_sha1.update(chunk)
+            
+            if current_hash.hexdigest() != upload_item['file_hash']:
+                logger.error(f"❌ Integridade comprometida: {upload_item['filename']}")
+                mark_upload_failed(upload_item, "Integridade comprometida")
+                continue
+            
+            # Linhas anteriores à coluna file_sha1 recebem o hash agora
+            upload_item['file_sha1'] = current_sha1.hexdigest()
+            
+            # Pula o envio se o B2 já tem exatamente este conteúdo
+            existing_url = find_existing_upload(upload_item)
+            if existing_url:
+                logger.info(f"♻️ Já está no B2, upload ignorado: {upload_item['filename']}")
+                metrics.inc('uploads_total', result='dedup')
+                complete_upload(upload_item, existing_url)
+                continue
+            
+            # Tenta fazer upload; sem conectividade o mesmo item aguarda o circuito fechar,
+            # sem consumir tentativas, para a queue ser drenada em ordem depois
+            while True:
+                wait_for_b2_circuits()
+                success, result = upload_to_b2_with_retry(upload_item)
+                if success or not (b2_auth_breaker.is_open() or b2_upload_breaker.is_open()):
+                    break
+                logger.info(f"⏸️ Uploads pausados até o B2 voltar: {upload_item['filename']}")
+            
+            if success:
+                logger.info(f"✅ Upload concluído: {upload_item['filename']}")
+                metrics.inc('uploads_total', result='ok')
+                complete_upload(upload_item, result)
+            else:
+                logger.error(f"❌ Falha no upload: {upload_item['filename']} - {result}")
+                
+                # Incrementa tentativas
+                upload_item['attempts'] += 1
+                
+                if upload_item['attempts'] >= upload_item['max_attempts']:
+                    logger.error(f"🚫 Máximo de tentativas excedido: {upload_item['filename']}")
+                    metrics.inc('uploads_total', result='failed')
+                    mark_upload_failed(upload_item, result)
+                else:
+                    metrics.inc('uploads_total', result='retry')
+                    # Reagenda no banco; os demais itens seguem sem esperar
+                    logger.info(f"🔄 Reagendando upload ({upload_item['attempts']}/{upload_item['max_attempts']}) "
+                                f"em {UPLOAD_RETRY_DELAY}s: {upload_item['filename']}")
+                    schedule_upload_retry(upload_item, result)
+            
+            update_heartbeat()
+            
+        except Exception as e:
+            logger.error(f"❌ Erro no processamento da queue: {e}")
+            time.sleep(5)
+        finally:
+            if upload_item:
+                upload_window_ids.discard(upload_item.get('id'))
+
+def recover_pending_uploads():
+    """Prepara os uploads pendentes do banco na inicialização"""
+    global upload_recovery_max_id
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=10.0)
+        cursor = conn.cursor()
+        # Esperas de retry da execução anterior não valem mais
+        cursor.execute("UPDATE upload_queue SET next_attempt_at = 0 WHERE status = 'pending'")
+        cursor.execute("SELECT COUNT(*) FROM upload_queue WHERE status = 'pending'")
+        pending_count = cursor.fetchone()[0]
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM upload_queue")
+        upload_recovery_max_id = cursor.fetchone()[0]
+        conn.commit()
+        conn.close()
+        
+        build_uploaded_index()
+        
+        if pending_count:
+            logger.info(f"📋 {pending_count} upload(s) pendente(s) recuperado(s) do banco")
+                
+    except Exception as e:
+        logger.error(f"❌ Erro ao recuperar uploads pendentes: {e}")
+
+def refill_upload_window():
+    """Reabastece a janela em memória com os próximos uploads pendentes do banco
+
+    Proxies entram mesmo com a janela cheia: o clipe rápido não espera os clipes finais.
+    """
+    free_slots = UPLOAD_PREFETCH - upload_queue.qsize()
+    
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=10.0)
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT id, filename, local_path, remote_path, timestamp, attempts, max_attempts, file_hash, file_sha1,
+               webhook_entries, clip_name, kind, priority
+        FROM upload_queue
+        WHERE status = 'pending' AND next_attempt_at <= ? AND attempts < max_attempts
+        ORDER BY priority DESC, id
+        LIMIT ?
+        ''', (time.time(), max(free_slots, 0) + len(upload_window_ids) + UPLOAD_PREFETCH))
+        rows = cursor.fetchall()
+        conn.close()
+    except Exception as e:
+        logger.error(f"❌ Erro ao reabastecer janela de uploads: {e}")
+        return 0
+    
+    added = 0
+    for row in rows:
+        if row[0] in upload_window_ids or row[0] in upload_failed_ids:
+            continue
+        if added >= free_slots and (row[12] or 0) < UPLOAD_PRIORITY_PROXY:
+            break
+        
+        upload_item = {
+            'id': row[0],
+            'filename': row[1],
+            'local_path': row[2],
+            'remote_path': row[3],
+            'timestamp': datetime.fromisoformat(str(row[4])),
+            'attempts': row[5],
+            'max_attempts': row[6],
+            'file_hash': row[7],
+            'file_sha1': row[8],
+            'webhook_entries': json.loads(row[9]) if row[9] else None,
+            'clip_name': row[10] or row[3],
+            'kind': row[11] or 'full',
+            'priority': row[12] or 0
+        }
+        upload_window_ids.add(upload_item['id'])
+        upload_queue.put_nowait((-upload_item['priority'], upload_item['id'], upload_item))
+        added += 1
+    
+    return added
+
+def schedule_upload_retry(upload_item, error_msg):
+    """Agenda nova tentativa no banco sem segurar o worker"""
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=10.0)
+        cursor = conn.cursor()
+        cursor.execute('''
+        UPDATE upload_queue SET attempts = ?, next_attempt_at = ?, error_message = ?, updated_at = ?
+        WHERE id = ?
+        ''', (upload_item['attempts'], time.time() + UPLOAD_RETRY_DELAY, error_msg,
+              datetime.now(), upload_item['id']))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"❌ Erro ao agendar nova tentativa de upload: {e}")
+
+def get_upload_backlog():
+    """Quantidade de uploads pendentes no banco (consulta indexada)"""
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=10.0)
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM upload_queue WHERE status = 'pending'")
+        count = cursor.fetchone()[0]
+        conn.close()
+        return count
+    except Exception:
+        return None
+
+def mark_upload_completed(upload_item, url):
+    """Marca upload como concluído no banco"""
+    try:
+        conn = sqlite3.connect(DB_PATH)
+        cursor = conn.cursor()
+        cursor.execute('''
+        UPDATE upload_queue SET status = 'completed', error_message = ?,
+               file_sha1 = COALESCE(?, file_sha1)
+        WHERE filename = ? AND local_path = ?
+        ''', (url, upload_item.get('file_sha1'), upload_item['filename'], upload_item['local_path']))
+        
+        cursor.execute('UPDATE system_status SET total_uploads = total_uploads + 1 WHERE id = 1')
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"❌ Erro ao marcar upload como concluído: {e}")
+
+def mark_upload_failed(upload_item, error_msg):
+    """Marca upload como falhou no banco (desistência definitiva)"""
+    if upload_item.get('id') is not None:
+        upload_failed_ids.add(upload_item['id'])
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=10.0)
+        cursor = conn.cursor()
+        cursor.execute('''
+        UPDATE upload_queue SET status = 'failed', attempts = ?, error_message = ?, updated_at = ?
+        WHERE filename = ? AND local_path = ?
+        ''', (upload_item['attempts'], error_msg, datetime.now(),
+              upload_item['filename'], upload_item['local_path']))
+        # O status vai sozinho: um erro na estatística não pode devolver o item à fila
+        conn.commit()
+        # Só agora continua no disco como despejável (depois dos já enviados);
+        # se o UPDATE falhar, o arquivo segue 'pending' e fixado
+        clip_store.set_state(upload_item['local_path'], 'failed')
+        
+        cursor.execute('UPDATE system_status SET uploads_failed = uploads_failed + 1 WHERE id = 1')
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"❌ Erro ao marcar upload como falhado: {e}")
+    
+    # Poster/HLS desistido: o webhook do MP4 que esperava por ele sai sem o link
+    if upload_item.get('kind') == 'asset':
+        resolve_clip_assets(upload_item.get('clip_name'))
+
+# === ESTADO DE UPLOADS MULTIPART NO BANCO ===
+def load_multipart_state(upload_id):
+    """Retorna o large file id e as partes já confirmadas de um upload"""
+    conn = sqlite3.connect(DB_PATH, timeout=10.0)
+    cursor = conn.cursor()
+    cursor.execute('SELECT large_file_id FROM upload_queue WHERE id = ?', (upload_id,))
+    row = cursor.fetchone()
+    cursor.execute('SELECT part_number, sha1 FROM upload_parts WHERE upload_id = ?', (upload_id,))
+    parts = dict(cursor.fetchall())
+    conn.close()
+    return (row[0] if row else None), parts
+
+def save_large_file_id(upload_id, file_id):
+    """Registra o large file id de um upload e descarta partes de tentativas anteriores"""
+    conn = sqlite3.connect(DB_PATH, timeout=10.0)
+    cursor = conn.cursor()
+    cursor.execute('UPDATE upload_queue SET large_file_id = ?, updated_at = ? WHERE id = ?',
+                   (file_id, datetime.now(), upload_id))
+    cursor.execute('DELETE FROM upload_parts WHERE upload_id = ?', (upload_id,))
+    conn.commit()
+    conn.close()
+
+def record_uploaded_part(upload_id, part_number, sha1, size):
+    """Registra uma parte confirmada pelo B2"""
+    conn = sqlite3.connect(DB_PATH, timeout=10.0)
+    cursor = conn.cursor()
+    cursor.execute('''
+    INSERT OR REPLACE INTO upload_parts (upload_id, part_number, sha1, size)
+    VALUES (?, ?, ?, ?)
+    ''', (upload_id, part_number, sha1, size))
+    conn.commit()
+    conn.close()
+
+def clear_multipart_state(upload_id):
+    """Remove o estado multipart de um upload finalizado"""
+    conn = sqlite3.connect(DB_PATH, timeout=10.0)
+    cursor = conn.cursor()
+    cursor.execute('UPDATE upload_queue SET large_file_id = NULL WHERE id = ?', (upload_id,))
+    cursor.execute('DELETE FROM upload_parts WHERE upload_id = ?', (upload_id,))
+    conn.commit()
+    conn.close()
+
+def list_remote_parts(bucket, file_id):
+    """Lista as partes que o B2 já tem de um large file não finalizado"""
+    parts = {}
+    start_part = 1
+    while start_part:
+        response = bucket.api.session.list_parts(file_id, start_part, 1000)
+        for part in response.get('parts', []):
+            parts[part['partNumber']] = part['contentSha1']
+        start_part = response.get('nextPartNumber')
+    return parts
+
+# === UPLOAD MULTIPART RETOMÁVEL ===
+def upload_large_file_resumable(bucket, upload_item):
+    """Envia um arquivo grande em partes, retomando da última parte confirmada
+
+    Retorna os bytes enviados nesta execução (só as partes que faltavam).
+    """
+    upload_id = upload_item['id']
+    local_path = upload_item['local_path']
+    file_size = os.path.getsize(local_path)
+    part_count = math.ceil(file_size / B2_PART_SIZE)
+    
+    file_id, done_parts = load_multipart_state(upload_id)
+    
+    if file_id:
+        # O B2 é a referência: só reaproveita partes que ele confirma ter
+        try:
+            remote_parts = list_remote_parts(bucket, file_id)
+            done_parts = {n: sha1 for n, sha1 in done_parts.items() if remote_parts.get(n) == sha1}
+            logger.info(f"🔁 Retomando upload multipart de {upload_item['filename']}: "
+                        f"{len(done_parts)}/{part_count} partes já confirmadas")
+        except (B2ConnectionError, B2RequestTimeout):
+            raise
+        except Exception as e:
+            logger.warning(f"⚠️ Large file {file_id} não pode ser retomado ({e}), reiniciando")
+            file_id = None
+    
+    if not file_id:
+        # large_file_sha1 permite conferir o conteúdo depois (B2 não calcula SHA1 de large files)
+        file_info = {'large_file_sha1': upload_item['file_sha1']} if upload_item.get('file_sha1') else {}
+        response = bucket.api.session.start_large_file(
+            bucket.id_, upload_item['remote_path'], 'video/mp4', file_info)
+        file_id = response['fileId']
+        save_large_file_id(upload_id, file_id)
+        done_parts = {}
+    
+    bytes_sent = 0
+    with open(local_path, 'rb') as f:
+        for part_number in range(1, part_count + 1):
+            if part_number in done_parts:
+                continue
+            
+            f.seek((part_number - 1) * B2_PART_SIZE)
+            data = f.read(B2_PART_SIZE)
+            sha1 = b2_upload_part(bucket, file_id, part_number, data)
+            record_uploaded_part(upload_id, part_number, sha1, len(data))
+            done_parts[part_number] = sha1
+            bytes_sent += len(data)
+    
+    bucket.api.session.finish_large_file(file_id, [done_parts[n] for n in range(1, part_count + 1)])
+    clear_multipart_state(upload_id)
+    
+    logger.info(f"📦 Upload multipart concluído: {upload_item['filename']} "
+                f"({bytes_sent / (1024**2):.1f} de {file_size / (1024**2):.1f} MB enviados nesta execução)")
+    return bytes_sent
+
+# === FUNÇÃO DE UPLOAD PARA B2 COM RETRY ===
+CIRCUIT_OPEN_ERROR = "Circuito aberto: sem conectividade com o B2"
+
+def is_connectivity_error(error):
+    """Identifica falhas de rede (e não de dados ou permissão)"""
+    return isinstance(error, (B2ConnectionError, B2RequestTimeout,
+                              requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                              ConnectionError, socket.timeout))
+
+def upload_to_b2_with_retry(upload_item):
+    """Faz upload com retry automático"""
+    for attempt in range(3):  # 3 tentativas imediatas
+        # Circuito aberto: não gasta tentativas nem sleeps, o worker aguarda a sonda
+        if b2_auth_breaker.is_open() or b2_upload_breaker.is_open():
+            return False, CIRCUIT_OPEN_ERROR
+        
+        try:
+            bucket = init_b2()
+            if not bucket:
+                if attempt == 2:  # Última tentativa
+                    return False, "Falha na conexão com B2 após 3 tentativas"
+                time.sleep(5)
+                continue
+            
+            logger.info(f"🔄 Upload tentativa {attempt + 1}: {upload_item['filename']}")
+            
+            # Arquivos grandes vão em partes retomáveis após falha ou restart
+            file_size = os.path.getsize(upload_item['local_path'])
+            upload_started = time.monotonic()
+            if upload_item.get('id') and file_size >= B2_MULTIPART_THRESHOLD:
+                bytes_sent = upload_large_file_resumable(bucket, upload_item)
+            else:
+                listener = ThrottlingProgressListener()
+                bucket.upload_local_file(
+                    local_file=upload_item['local_path'],
+                    file_name=upload_item['remote_path'],
+                    progress_listener=listener
+                )
+                bytes_sent = listener.bytes_sent or file_size  # Sem progresso reportado: o arquivo inteiro
+            # Só os bytes desta tentativa: um multipart retomado não infla a estimativa do uplink
+            record_uplink_sample(bytes_sent, time.monotonic() - upload_started)
+            metrics.observe('stage_seconds', time.monotonic() - upload_started, stage='upload')
+            
+            # Gera URL público do arquivo
+            file_url = build_b2_url(upload_item['remote_path'])
+            b2_upload_breaker.record_success()
+            return True, file_url
+            
+        except Exception as e:
+            logger.warning(f"⚠️ Tentativa {attempt + 1} falhou: {e}")
+            if is_connectivity_error(e):
+                b2_upload_breaker.record_failure()
+            else:
+                reset_b2_connection()  # Força nova autorização na próxima tentativa
+            if attempt == 2:  # Última tentativa
+                return False, str(e)
+            time.sleep(5)  # Aguarda 5s entre tentativas
+    
+    return False, "Todas as tentativas falharam"
+
+# === REGISTRO DE UPLOAD FEITO EM STREAMING ===
+def register_streamed_upload(local_path, remote_path, url, file_hash, file_sha1=None, webhook_entries=None):
+    """Registra no banco um upload já concluído em streaming e dispara o webhook"""
+    filename = os.path.basename(local_path)
+    timestamp = datetime.now()
+    upload_id = None
+    
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=10.0)
+        cursor = conn.cursor()
+        cursor.execute('''
+        INSERT INTO upload_queue (filename, local_path, remote_path, timestamp, file_hash, file_sha1,
+                                  status, error_message, encode_level)
+        VALUES (?, ?, ?, ?, ?, ?, 'completed', ?, ?)
+        ''', (filename, local_path, remote_path, timestamp, file_hash, file_sha1, url,
+              current_encode_settings()['level']))
+        upload_id = cursor.lastrowid
+        cursor.execute('UPDATE system_status SET total_uploads = total_uploads + 1 WHERE id = 1')
+        conn.commit()
+        conn.close()
+        
+        if file_sha1:
+            with uploaded_index_lock:
+                uploaded_index.add((remote_path, file_sha1))
+    except Exception as e:
+        logger.error(f"❌ Erro ao registrar upload em streaming: {e}")
+    
+    staging.record_write(local_path)
+    if KEEP_UPLOADED_CLIPS:
+        clip_store.track(local_path, 'uploaded')
+    elif clip_store.remove(local_path):
+        logger.info(f"🗑️ Arquivo local removido: {local_path}")
+    
+    notify_webhook(filename, url, timestamp, webhook_entries, upload_id=upload_id)
+
+# === FUNÇÃO LEGADA MANTIDA PARA COMPATIBILIDADE ===
+def upload_to_b2(local_file_path, remote_file_name):
+    """Função legada - agora usa o sistema de queue"""
+    return add_to_upload_queue(local_file_path, remote_file_name, priority=True)
+
+# === SAÚDE DA CAPTURA (LEITURA, INTERVALO ENTRE FRAMES E FALHAS) ===
+# Limites superiores (s) dos histogramas de leitura e de intervalo; o último bucket é o +Inf
+CAPTURE_BUCKETS = (0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.2, 0.5, 1.0, 2.0)
+# Tamanhos das sequências de falhas consecutivas (1, 2, 3-5, 6-10, >10)
+CAPTURE_RUN_BUCKETS = (1, 2, 5, 10)
+
+class CaptureHealth:
+    """Estatísticas da captura em slots de 1 s num ring de 15 min, com arrays pré-alocados
+
+    Só a thread de captura escreve; leitores agregam as janelas de 1/5/15 min sem lock
+    (um slot pode estar meio atualizado, o que não importa para diagnóstico).
+    """
+
+    WINDOWS = (60, 300, 900)
+
+    def __init__(self, seconds=900):
+        self.seconds = seconds
+        self.bucket_count = len(CAPTURE_BUCKETS) + 1
+        self.run_bucket_count = len(CAPTURE_RUN_BUCKETS) + 1
+        self.slot_second = array('q', [-1]) * seconds
+        self.reads = array('L', [0]) * seconds
+        self.failures = array('L', [0]) * seconds
+        self.stored = array('L', [0]) * seconds
+        self.read_sum = array('d', [0.0]) * seconds
+        self.read_max = array('d', [0.0]) * seconds
+        self.intervals = array('L', [0]) * seconds
+        self.interval_sum = array('d', [0.0]) * seconds
+        self.interval_sq_sum = array('d', [0.0]) * seconds
+        self.interval_max = array('d', [0.0]) * seconds
+        # Tempo do loop fora do cap.read() (escrita no buffer, lock, GIL): cresce com CPU sem folga
+        self.gap_sum = array('d', [0.0]) * seconds
+        self.gap_max = array('d', [0.0]) * seconds
+        self.read_hist = array('L', [0]) * (seconds * self.bucket_count)
+        self.interval_hist = array('L', [0]) * (seconds * self.bucket_count)
+        self.run_hist = array('L', [0]) * (seconds * self.run_bucket_count)
+        self.recent_runs = deque(maxlen=32)   # (início, falhas) das últimas sequências de falha
+        self.current_run = 0
+        self.run_started = None
+        self.last_frame_at = None
+        self.last_read_finished = None
+
+    def _slot(self, second):
+        index = second % self.seconds
+        if self.slot_second[index] != second:
+            # Slot de 15 min atrás: zera no lugar, sem alocar
+            self.slot_second[index] = second
+            for values in (self.reads, self.failures, self.stored, self.intervals, self.read_sum,
+                           self.read_max, self.interval_sum, self.interval_sq_sum, self.interval_max,
+                           self.gap_sum, self.gap_max):
+                values[index] = 0
+            for values, width in ((self.read_hist, self.bucket_count), (self.interval_hist, self.bucket_count),
+                                  (self.run_hist, self.run_bucket_count)):
+                for i in range(index * width, (index + 1) * width):
+                    values[i] = 0
+        return index
+
+    def record_read(self, started, finished, ok):
+        """Registra um cap.read() (started/finished em time.monotonic)"""
+        index = self._slot(int(finished))
+        duration = finished - started
+        self.reads[index] += 1
+        self.read_sum[index] += duration
+        if duration > self.read_max[index]:
+            self.read_max[index] = duration
+        self.read_hist[index * self.bucket_count + bisect.bisect_left(CAPTURE_BUCKETS, duration)] += 1
+        if self.last_read_finished is not None:
+            gap = started - self.last_read_finished
+            self.gap_sum[index] += gap
+            if gap > self.gap_max[index]:
+                self.gap_max[index] = gap
+        self.last_read_finished = finished
+
+        if not ok:
+            self.failures[index] += 1
+            if not self.current_run:
+                self.run_started = time.time()
+            self.current_run += 1
+            return
+
+        if self.current_run:
+            self._close_run(index)
+        if self.last_frame_at is not None:
+            interval = finished - self.last_frame_at
+            self.intervals[index] += 1
+            self.interval_sum[index] += interval
+            self.interval_sq_sum[index] += interval * interval
+            if interval > self.interval_max[index]:
+                self.interval_max[index] = interval
+            self.interval_hist[index * self.bucket_count + bisect.bisect_left(CAPTURE_BUCKETS, interval)] += 1
+        self.last_frame_at = finished
+
+    def record_stored(self, finished):
+        self.stored[self._slot(int(finished))] += 1
+
+    def _close_run(self, index):
+        self.run_hist[index * self.run_bucket_count + bisect.bisect_left(CAPTURE_RUN_BUCKETS, self.current_run)] += 1
+        self.recent_runs.append((self.run_started, self.current_run))
+        self.current_run = 0
+
+    def reset_stream(self):
+        """Reconexão: fecha a sequência de falhas e não mede o intervalo através dela"""
+        if self.current_run:
+            self._close_run(self._slot(int(time.monotonic())))
+        self.last_frame_at = None
+        self.last_read_finished = None
+
+    @staticmethod
+    def _percentile(hist, total, fraction):
+        """Limite superior do bucket que contém o percentil (None acima do último limite)"""
+        if not total:
+            return None
+        target = total * fraction
+        cumulative = 0
+        for bound, count in zip(CAPTURE_BUCKETS + (None,), hist):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return None
+
+    def window(self, seconds):
+        """Agrega os últimos `seconds` segundos"""
+        now = int(time.monotonic())
+        reads = failures = stored = intervals = covered = 0
+        read_sum = interval_sum = interval_sq_sum = gap_sum = 0.0
+        read_max = interval_max = gap_max = 0.0
+        read_hist = [0] * self.bucket_count
+        interval_hist = [0] * self.bucket_count
+        run_hist = [0] * self.run_bucket_count
+        for index in range(self.seconds):
+            if self.slot_second[index] <= now - seconds:
+                continue
+            covered += 1
+            reads += self.reads[index]
+            failures += self.failures[index]
+            stored += self.stored[index]
+            intervals += self.intervals[index]
+            read_sum += self.read_sum[index]
+            interval_sum += self.interval_sum[index]
+            interval_sq_sum += self.interval_sq_sum[index]
+            gap_sum += self.gap_sum[index]
+            read_max = max(read_max, self.read_max[index])
+            interval_max = max(interval_max, self.interval_max[index])
+            gap_max = max(gap_max, self.gap_max[index])
+            for i in range(self.bucket_count):
+                read_hist[i] += self.read_hist[index * self.bucket_count + i]
+                interval_hist[i] += self.interval_hist[index * self.bucket_count + i]
+            for i in range(self.run_bucket_count):
+                run_hist[i] += self.run_hist[index * self.run_bucket_count + i]
+
+        interval_mean = interval_sum / intervals if intervals else None
+        jitter = math.sqrt(max(interval_sq_sum / intervals - interval_mean ** 2, 0)) if intervals else None
+        to_ms = lambda value: round(value * 1000, 1) if value is not None else None
+        return {
+            "seconds": seconds,
+            "reads": reads,
+            "grabbed": reads - failures,
+            "stored": stored,
+            "failed": failures,
+            "fps": round(stored / covered, 2) if covered else None,
+            "read_ms": {
+                "mean": to_ms(read_sum / reads) if reads else None,
+                "p50": to_ms(self._percentile(read_hist, reads, 0.5)),
+                "p95": to_ms(self._percentile(read_hist, reads, 0.95)),
+                "p99": to_ms(self._percentile(read_hist, reads, 0.99)),
+                "max": to_ms(read_max)
+            },
+            "interval_ms": {
+                "mean": to_ms(interval_mean),
+                "jitter": to_ms(jitter),
+                "p95": to_ms(self._percentile(interval_hist, intervals, 0.95)),
+                "max": to_ms(interval_max)
+            },
+            "loop_gap_ms": {
+                "mean": to_ms(gap_sum / reads) if reads else None,
+                "max": to_ms(gap_max)
+            },
+            "failure_runs": dict(zip(['1', '2', '3-5', '6-10', '>10'], run_hist)),
+            "diagnosis": self._diagnose(reads, failures, read_hist, gap_sum, gap_max)
+        }
+
+    def _diagnose(self, reads, failures, read_hist, gap_sum, gap_max):
+        """Palpite do gargalo: câmera/stream, rede ou CPU"""
+        if not reads:
+            return "sem_leituras"
+        frame_time = 1.0 / (detected_fps or FORCE_FPS)
+        if failures / reads > 0.05:
+            return "camera_ou_stream"       # cap.read() retornando falha
+        slow_read = self._percentile(read_hist, reads, 0.95)
+        if slow_read is None or slow_read > 2 * frame_time:
+            return "rede_ou_camera_lenta"   # frames chegam atrasados do RTSP/câmera
+        if gap_sum / reads > frame_time / 2 or gap_max > 4 * frame_time:
+            return "cpu_sem_folga"          # o loop demora a voltar ao cap.read()
+        return "ok"
+
+    def summary(self):
+        """Janela de 1 min para o /status"""
+        return self.window(self.WINDOWS[0])
+
+    def get_debug(self):
+        return {
+            "windows": {f"{seconds // 60}m": self.window(seconds) for seconds in self.WINDOWS},
+            "current_failure_run": self.current_run,
+            "recent_failure_runs": [
+                {"started": datetime.fromtimestamp(started).isoformat(), "failures": count}
+                for started, count in self.recent_runs
+            ]
+        }
+
+capture_health = CaptureHealth()
+
+# === ANEL DE FRAMES EM MMAP ===
+class FrameRing:
+    """Buffer circular de frames num arquivo mapeado em memória (normalmente no tmpfs).
+
+    O arquivo sobrevive ao processo: depois de um crash ou restart o app reabre o anel e
+    os frames dos últimos segundos continuam disponíveis. Outros processos podem mapear o
+    mesmo arquivo e ler os frames sem cópia.
+
+    Layout: cabeçalho (HEADER), instante de leitura de cada slot (time.time(), float64) e,
+    a partir de um offset alinhado em 4096, os frames uint8. O frame de sequência s fica
+    no slot s % slots e os válidos são os de sequência [start, count). O escritor grava
+    frame e instante antes de avançar count: um leitor externo relê count depois de copiar
+    um frame para saber se o slot foi sobrescrito no meio.
+    """
+    MAGIC = b'PNRRING1'
+    VERSION = 1
+    # magic, versão, altura, largura, canais (0 = frame 2D em tons de cinza), slots, start, count
+    HEADER = struct.Struct('<8sIIIIIQQ')
+    HEADER_SIZE = 64
+    PAGE = 4096
+    
+    def __init__(self, path, mm, shape, slots, readonly=False):
+        self.path = path
+        self.mm = mm
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.readonly = readonly
+        frame_bytes = int(np.prod(self.shape))
+        self.times = np.ndarray((slots,), dtype='<f8', buffer=mm, offset=self.HEADER_SIZE)
+        self.frames = np.ndarray((slots,) + self.shape, dtype=np.uint8, buffer=mm,
+                                 offset=self.frames_offset(slots))
+        self.size = self.frames_offset(slots) + slots * frame_bytes
+        # time.time() - time.monotonic(): converte os instantes gravados para o relógio do processo
+        self.clock_offset = time.time() - time.monotonic()
+        self.reattached = 0
+        self.timestamps = FrameRingTimestamps(self)
+        self.start, self.count = self.read_header()[6:8]
+    
+    @classmethod
+    def frames_offset(cls, slots):
+        return -(-(cls.HEADER_SIZE + slots * 8) // cls.PAGE) * cls.PAGE
+    
+    @staticmethod
+    def geometry(shape):
+        """(altura, largura, canais) do cabeçalho para o shape de um frame"""
+        if len(shape) == 2:
+            return shape[0], shape[1], 0
+        return shape[0], shape[1], shape[2]
+    
+    @staticmethod
+    def reserve(fd, size):
+        """Aloca o arquivo inteiro agora: um arquivo esparso no tmpfs cheio mata a captura
+        com SIGBUS na primeira escrita sem espaço; aqui falta de espaço vira OSError"""
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, size)
+        else:
+            os.ftruncate(fd, size)
+    
+    @classmethod
+    def create(cls, path, shape, slots, first_seq=0):
+        """Cria um anel vazio (troca o arquivo de forma atômica; quem ainda mapeia o antigo não quebra)"""
+        height, width, channels = cls.geometry(shape)
+        size = cls.frames_offset(slots) + slots * int(np.prod(shape))
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        free = shutil.disk_usage(directory).free
+        if free < size:
+            raise OSError(errno.ENOSPC, f"{size / 1024**2:.0f} MB necessários, {free / 1024**2:.0f} MB livres")
+        tmp_path = path + '.tmp'
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            cls.reserve(fd, size)
+            mm = mmap.mmap(fd, size)
+        except OSError:
+            os.close(fd)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        os.close(fd)
+        cls.HEADER.pack_into(mm, 0, cls.MAGIC, cls.VERSION, height, width, channels, slots, first_seq, first_seq)
+        os.replace(tmp_path, path)
+        return cls(path, mm, shape, slots)
+    
+    @classmethod
+    def attach(cls, path, max_age=None, readonly=False):
+        """Reabre um anel existente; None se não existir ou não for válido.
+
+        Com max_age, frames mais velhos que isso são descartados (o anel continua valendo
+        pela geometria). readonly é para processos auxiliares que só leem.
+        """
+        try:
+            fd = os.open(path, os.O_RDONLY if readonly else os.O_RDWR)
+        except OSError:
+            return None
+        try:
+            size = os.fstat(fd).st_size
+            if size < cls.HEADER_SIZE:
+                return None
+            if not readonly:
+                cls.reserve(fd, size)  # Anel esparso (versão anterior) também ganha o espaço todo
+            mm = mmap.mmap(fd, size, access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+        except (OSError, ValueError):
+            return None
+        finally:
+            os.close(fd)
+        magic, version, height, width, channels, slots, start, count = cls.HEADER.unpack_from(mm, 0)
+        shape = (height, width) if channels == 0 else (height, width, channels)
+        if (magic != cls.MAGIC or version != cls.VERSION or not slots or start > count
+                or size != cls.frames_offset(slots) + slots * int(np.prod(shape))):
+            mm.close()
+            return None
+        ring = cls(path, mm, shape, slots, readonly=readonly)
+        if not readonly:
+            if ring.count - ring.start > slots:
+                ring.start = ring.count - slots
+            if max_age is not None and ring and time.time() - ring.times[(ring.count - 1) % slots] > max_age:
+                ring.start = ring.count
+            ring.write_header()
+            ring.reattached = len(ring)
+        return ring
+    
+    def read_header(self):
+        return self.HEADER.unpack_from(self.mm, 0)
+    
+    def write_header(self):
+        struct.pack_into('<QQ', self.mm, self.HEADER.size - 16, self.start, self.count)
+    
+    def refresh(self):
+        """Leitores: relê start/count gravados pelo processo de captura"""
+        self.start, self.count = self.read_header()[6:8]
+        if self.count - self.start > self.slots:
+            self.start = self.count - self.slots
+    
+    def matches(self, shape, slots):
+        return self.shape == tuple(shape) and self.slots == slots and not self.readonly
+    
+    def __len__(self):
+        return self.count - self.start
+    
+    def append(self, frame, timestamp):
+        """Grava o frame lido no instante timestamp (time.monotonic)"""
+        slot = self.count % self.slots
+        self.frames[slot] = frame
+        self.times[slot] = timestamp + self.clock_offset
+        self.count += 1
+        if self.count - self.start > self.slots:
+            self.start = self.count - self.slots
+        self.write_header()
+    
+    def view(self, index):
+        """Frame na posição index (0 = mais antigo) sem cópia; vale até o slot ser reescrito"""
+        return self.frames[(self.start + index) % self.slots]
+    
+    def copy_seqs(self, first_seq, end_seq):
+        """Cópia dos frames de sequência [first_seq, end_seq) sem o buffer_lock.
+
+        A captura continua gravando durante a cópia; frames cujo slot ela alcançou nesse
+        meio tempo ficam de fora (sempre os do início).
+        """
+        frames = [self.frames[seq % self.slots].copy() for seq in range(first_seq, end_seq)]
+        # A captura grava o slot antes de avançar count: só a sequência count - slots pode estar pela metade
+        valid_from = max(self.count - self.slots + 1, first_seq)
+        return frames[valid_from - first_seq:]
+    
+    def summary(self):
+        return {
+            "path": self.path,
+            "slots": self.slots,
+            "frames": len(self),
+            "frame_shape": list(self.shape),
+            "size_mb": round(self.size / 1024**2, 1),
+            "reattached_frames": self.reattached
+        }
+
+class FrameRingTimestamps:
+    """Instantes do anel no relógio monotônico do processo, em ordem (serve ao bisect)"""
+    
+    def __init__(self, ring):
+        self.ring = ring
+    
+    def __len__(self):
+        return len(self.ring)
+    
+    def __getitem__(self, index):
+        ring = self.ring
+        if not 0 <= index < len(ring):
+            raise IndexError(index)
+        return float(ring.times[(ring.start + index) % ring.slots]) - ring.clock_offset
+
+def open_frame_ring(shape, slots):
+    """Reusa o anel atual se a geometria bate, senão cria outro; None se não der (usa deque).
+    Chamar com buffer_lock."""
+    global frame_buffer, frame_timestamps
+    if isinstance(frame_buffer, FrameRing) and frame_buffer.matches(shape, slots):
+        return frame_buffer
+    try:
+        ring = FrameRing.create(FRAME_RING_PATH, shape, slots, first_seq=frames_captured)
+    except (OSError, ValueError) as e:
+        logger.warning(f"⚠️ Anel de frames indisponível em {FRAME_RING_PATH} ({e}); usando buffer em memória")
+        return None
+    logger.info(f"💾 Anel de frames criado: {FRAME_RING_PATH} ({slots} frames "
+                f"{'x'.join(str(d) for d in shape)}, {ring.size / 1024**2:.0f} MB)")
+    frame_buffer = ring
+    frame_timestamps = ring.timestamps
+    return ring
+
+def attach_frame_ring():
+    """Na inicialização: reaproveita os frames deixados no anel pelo processo anterior"""
+    global frame_buffer, frame_timestamps, frames_captured
+    if not FRAME_RING_ENABLED:
+        return
+    ring = FrameRing.attach(FRAME_RING_PATH, max_age=BUFFER_SECONDS)
+    if ring is None:
+        return
+    with buffer_lock:
+        frame_buffer = ring
+        frame_timestamps = ring.timestamps
+        frames_captured = ring.count
+    if ring.reattached:
+        logger.info(f"♻️ Anel de frames reaproveitado: {ring.reattached} frames "
+                    f"({ring.timestamps[len(ring) - 1] - ring.timestamps[0]:.1f}s) de {FRAME_RING_PATH}")
+    else:
+        logger.info(f"💾 Anel de frames reaberto sem frames recentes: {FRAME_RING_PATH}")
+
+# === FUNÇÃO DE CAPTURA DE FRAMES ===
+def capture_frames():
+    global frame_buffer, frame_timestamps, frames_captured, detected_fps, frame_width, frame_height
+    
+    reconnect_count = 0
+    max_reconnects = 10
+    
+    while reconnect_count < max_reconnects:
+        try:
+            logger.info(f"🎥 Iniciando captura (tentativa {reconnect_count + 1})")
+            
+            cap = cv2.VideoCapture(VIDEO_SOURCE)
+            if not cap.isOpened():
+                logger.error(f"❌ Erro ao conectar na fonte de vídeo: {VIDEO_SOURCE}")
+                reconnect_count += 1
+                time.sleep(5)
+                continue
+
+            # APLICA OTIMIZAÇÕES PARA RASPBERRY PI
+            cap = optimize_camera_for_pi(cap)
+
+            # DETECÇÃO AUTOMÁTICA DAS PROPRIEDADES DA CÂMERA
+            detected_fps = cap.get(cv2.CAP_PROP_FPS) or FORCE_FPS
+            frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+            frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            
+            # Força 24 FPS em todas as plataformas para economia de CPU
+            detected_fps = FORCE_FPS  # 24 FPS sempre
+            
+            # Limita resolução se especificado
+            if IS_RASPBERRY_PI or IS_ARM:
+                frame_width = min(frame_width, MAX_WIDTH)
+                frame_height = min(frame_height, MAX_HEIGHT)
+
+            if detected_fps == 0 or detected_fps is None:
+                logger.warning("⚠️ Câmera não informou FPS. Usando valor forçado.")
+                detected_fps = FORCE_FPS
+
+            # INICIALIZAÇÃO DINÂMICA DO BUFFER COM BASE NO FPS REAL
+            buffer_size = int(BUFFER_SECONDS * detected_fps)
+            # O anel em mmap é aberto no primeiro frame, quando o formato real é conhecido;
+            # até lá (e durante reconexões) os frames que ele já tem continuam disponíveis
+            use_ring = FRAME_RING_ENABLED
+            if not use_ring:
+                with buffer_lock:
+                    frame_buffer = deque(maxlen=buffer_size)
+                    frame_timestamps = deque(maxlen=buffer_size)
+
+            logger.info(f"✅ Conectado à câmera: {frame_width}x{frame_height} @ {detected_fps:.2f} FPS. Buffer de {BUFFER_SECONDS}s.")
+            
+            # Reset contador de reconexões
+            reconnect_count = 0
+            consecutive_failures = 0
+            capture_health.reset_stream()
+            
+            read_latency = 0.0
+            fps_window_start = time.monotonic()
+            
+            while True:
+                try:
+                    read_started = time.monotonic()
+                    ret, frame = cap.read()
+                    read_finished = time.monotonic()
+                    # EWMA da latência de leitura alimenta o limitador de upload
+                    read_latency = 0.9 * read_latency + 0.1 * (read_finished - read_started)
+                    metrics.observe('capture_read_seconds', read_finished - read_started)
+                    capture_health.record_read(read_started, read_finished, ret)
+                    
+                    if not ret:
+                        metrics.inc('frames_dropped_total')
+                        consecutive_failures += 1
+                        upload_limiter.on_capture_trouble()
+                        logger.warning(f"⚠️ Falha na leitura do frame ({consecutive_failures})")
+                        
+                        if consecutive_failures > 10:
+                            logger.error("❌ Muitas falhas consecutivas, reconectando...")
+                            break
+                        
+                        time.sleep(0.1)
+                        continue
+                    
+                    # Reset contador de falhas
+                    consecutive_failures = 0
+                    
+                    with buffer_lock:
+                        lock_wait = time.monotonic() - read_finished
+                        if use_ring and open_frame_ring(frame.shape, buffer_size) is None:
+                            use_ring = False
+                            frame_buffer = deque(maxlen=buffer_size)
+                            frame_timestamps = deque(maxlen=buffer_size)
+                        if use_ring:
+                            frame_buffer.append(frame, read_finished)
+                        else:
+                            frame_buffer.append(frame)
+                            frame_timestamps.append(read_finished)
+                        frames_captured += 1
+                    metrics.observe('buffer_lock_wait_seconds', lock_wait, site='capture')
+                    metrics.inc('frames_captured_total')
+                    capture_health.record_stored(read_finished)
+                    
+                    # Avalia a saúde da captura uma vez por segundo
+                    if frames_captured % int(detected_fps) == 0:
+                        now = time.monotonic()
+                        metrics.set('capture_fps', round(int(detected_fps) / max(now - fps_window_start, 1e-6), 2))
+                        fps_window_start = now
+                        if read_latency > 2.0 / detected_fps:
+                            upload_limiter.on_capture_trouble()
+                        else:
+                            upload_limiter.on_capture_healthy()
+                    
+                    # Atualiza heartbeat periodicamente (com o buffer cheio o len() não muda mais,
+                    # então o contador de frames é que marca os 5 segundos)
+                    if frames_captured % int(detected_fps * 5) == 0:  # A cada 5 segundos
+                        update_heartbeat()
+                        
+                except KeyboardInterrupt:
+                    logger.info("🛑 Captura interrompida pelo usuário")
+                    cap.release()
+                    return
+                except Exception as e:
+                    logger.error(f"❌ Erro na captura: {e}")
+                    break
+            
+            cap.release()
+            
+        except Exception as e:
+            logger.error(f"❌ Erro na inicialização da captura: {e}")
+            
+        reconnect_count += 1
+        logger.info(f"🔄 Tentando reconectar em 5 segundos... ({reconnect_count}/{max_reconnects})")
+        time.sleep(5)
+    
+    logger.error(f"🚫 Máximo de tentativas de reconexão excedido ({max_reconnects})")
+    # Em caso de falha total, mantém o sistema rodando sem captura
+    while True:
+        time.sleep(30)
+        update_heartbeat()
+
+# === FUNÇÃO PARA DESCOBERTA AUTOMÁTICA NA REDE (mDNS) ===
+def setup_mdns():
+    """Configura descoberta automática na rede usando mDNS/Zeroconf"""
+    if not ENABLE_MDNS or not ZEROCONF_AVAILABLE:
+        return None
+        
+    try:
+        # Obtém IP local
+        hostname = socket.gethostname()
+        local_ip = socket.gethostbyname(hostname)
+        
+        # Configuração do serviço mDNS
+        desc = {
+            'version': '1.0',
+            'type': 'camera',
+            'model': 'PenAreia',
+            'platform': platform.system(),
+            'endpoints': '/trigger,/status'
+        }
+        
+        info = ServiceInfo(
+            "_http._tcp.local.",
+            f"{SERVICE_NAME}._http._tcp.local.",
+            addresses=[socket.inet_aton(local_ip)],
+            port=SERVER_PORT,
+            properties=desc,
+            server=f"{hostname}.local."
+        )
+        
+        zeroconf = Zeroconf()
+        zeroconf.register_service(info)
+        
+        logger.info(f"📶 Serviço mDNS registrado: {SERVICE_NAME}.local:{SERVER_PORT}")
+        logger.info(f"🌐 Disponível em: http://{local_ip}:{SERVER_PORT}")
+        
+        return zeroconf
+        
+    except Exception as e:
+        logger.warning(f"⚠️ Erro ao configurar mDNS: {e}")
+        return None
+
+# === FUNÇÃO PARA OBTER INFORMAÇÕES DO SISTEMA ===
+def get_system_info():
+    """Retorna informações do sistema para monitoramento"""
+    try:
+        if PSUTIL_AVAILABLE:
+            cpu_usage = psutil.cpu_percent(interval=1)
+            memory = psutil.virtual_memory()
+            disk = psutil.disk_usage('/') if (IS_RASPBERRY_PI or IS_ARM) else psutil.disk_usage('.')
+        else:
+            cpu_usage = 0
+            memory = type('obj', (object,), {'percent': 0, 'used': 0, 'total': 0})
+            disk = type('obj', (object,), {'percent': 0, 'used': 0, 'total': 0})
+        
+        return {
+            'cpu_usage': f"{cpu_usage:.1f}%",
+            'memory_usage': f"{memory.percent:.1f}%",
+            'disk_usage': f"{disk.percent:.1f}%",
+            'temperature': get_cpu_temperature()
+        }
+    except:
+        return {'cpu_usage': 'N/A', 'memory_usage': 'N/A', 'disk_usage': 'N/A', 'temperature': 'N/A'}
+
+def read_cpu_temperature():
+    """Temperatura da CPU em °C (float) ou None quando não há sensor"""
+    try:
+        with open('/sys/class/thermal/thermal_zone0/temp', 'r') as f:
+            return int(f.read()) / 1000.0
+    except:
+        return None
+
+def get_cpu_temperature():
+    """Obtém temperatura da CPU (Raspberry Pi)"""
+    if IS_RASPBERRY_PI:
+        temp = read_cpu_temperature()
+        if temp is not None:
+            return f"{temp:.1f}°C"
+    return 'N/A'
+
+# === FUNÇÃO PARA SALVAR O SNAPSHOT EM VÍDEO TEMPORÁRIO ===
+def write_temp_video(frames_to_save, temp_filename):
+    """Salva os frames do snapshot em um MP4 temporário com OpenCV"""
+    try:
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')  # Codec temporário
+        # Tamanho dos próprios frames: os reaproveitados do anel chegam antes da câmera reconectar
+        height, width = frames_to_save[0].shape[:2]
+        out = cv2.VideoWriter(temp_filename, fourcc, detected_fps, (width, height))
+        
+        if not out.isOpened():
+            logger.error("❌ Erro ao criar arquivo de vídeo temporário!")
+            return False, "Erro ao criar arquivo de vídeo temporário!"
+        
+        logger.info(f"💾 Salvando {len(frames_to_save)} frames...")
+        for frame in frames_to_save:
+            out.write(frame)
+            
+        out.release()
+        if not staging.record_write(temp_filename, len(frames_to_save)):
+            return False, "Vídeo temporário vazio (sem espaço?)"
+        clip_store.track(temp_filename, 'encoding')
+        logger.info(f"✅ Vídeo temporário salvo: {temp_filename}")
+        return True, None
+        
+    except Exception as e:
+        logger.error(f"❌ Erro ao salvar vídeo temporário: {e}")
+        return False, f"Erro ao salvar vídeo temporário: {str(e)}"
+
+# === FUNÇÃO PARA CONVERTER O VÍDEO TEMPORÁRIO ===
+def convert_temp_video(temp_filename, final_filename, num_frames):
+    """Converte o vídeo temporário escolhendo entre codificação paralela e sequencial"""
+    conversion_success = False
+    parallel_workers = choose_parallel_workers(num_frames)
+    encoder = 'parallel'
+    duration = num_frames / (detected_fps or FORCE_FPS)
+    
+    if parallel_workers > 1:
+        conversion_success, conversion_result = convert_video_parallel(
+            temp_filename, final_filename, num_frames, parallel_workers)
+        if not conversion_success:
+            logger.warning("⚠️ Conversão paralela falhou, usando conversão sequencial...")
+    
+    if not conversion_success:
+        logger.info("🔄 Convertendo vídeo com FFmpeg...")
+        encoder = 'ffmpeg_python'
+        conversion_success, conversion_result = convert_video_with_ffmpeg(temp_filename, final_filename, duration)
+    
+    if not conversion_success:
+        logger.warning("⚠️ Tentando conversão alternativa com subprocess...")
+        encoder = 'subprocess'
+        conversion_success, conversion_result = convert_video_subprocess(temp_filename, final_filename, duration)
+    
+    if conversion_success:
+        metrics.inc('encodes_total', encoder=encoder)
+    return conversion_success, conversion_result
+
+# === EMPACOTAMENTO: MP4 + POSTER + HLS EM UMA DECODIFICAÇÃO ===
+def packaging_enabled():
+    """Indica se o clipe deve sair com poster e/ou HLS além do MP4"""
+    return POSTER_ENABLED or bool(HLS_RENDITIONS)
+
+def rendition_width(height):
+    """Largura par proporcional ao frame capturado (mesma conta do scale=-2 do FFmpeg)"""
+    return max(int(round(frame_width * height / frame_height / 2)) * 2, 2)
+
+def encode_multi_output(input_path, output_path, num_frames, poster_path=None, hls_dir=None):
+    """Decodifica o vídeo temporário uma vez e gera MP4, poster JPEG e renditions HLS (filtro split)"""
+    fps = detected_fps or FORCE_FPS
+    gop = int(fps * 2)
+    heights = [h for h in HLS_RENDITIONS if h <= frame_height] if hls_dir else []
+    
+    branches = ['mp4'] + (['poster'] if poster_path else []) + [f'hls{h}' for h in heights]
+    graph = f"[0:v]split={len(branches)}" + ''.join(f'[{b}]' for b in branches)
+    if poster_path:
+        # Poster no meio do clipe
+        graph += f";[poster]select='eq(n,{max(num_frames // 2, 0)})'[poster_out]"
+    for h in heights:
+        graph += f";[hls{h}]scale=-2:{h}[hls{h}_out]"
+    # Nível do governador com resolução reduzida: só o MP4 é escalado
+    mp4_label = '[mp4]'
+    if output_size() != f'{frame_width}x{frame_height}':
+        graph += f";[mp4]scale={output_size().replace('x', ':')}[mp4_out]"
+        mp4_label = '[mp4_out]'
+    
+    x264_common = [
+        '-c:v', 'libx264',
+        '-preset', encode_preset(),
+        '-profile:v', 'baseline',
+        '-g', str(gop),
+        '-keyint_min', str(gop),
+        '-sc_threshold', '0',
+        '-threads', str(encode_threads()),
+        '-an'
+    ]
+    
+    cmd = [FFMPEG_CMD, '-y', '-hide_banner', '-loglevel', 'error', '-i', input_path,
+           '-filter_complex', graph,
+           '-map', mp4_label] + x264_common + [
+           '-crf', str(ENCODING_CRF),
+           *bitrate_cap_args(num_frames / fps),
+           '-pix_fmt', PIXEL_FORMAT,
+           '-level', '3.1',
+           '-tune', ENCODING_TUNE,
+           '-movflags', 'faststart',
+           output_path]
+    
+    if poster_path:
+        cmd += ['-map', '[poster_out]', '-frames:v', '1', '-q:v', '3', poster_path]
+    
+    if heights:
+        os.makedirs(hls_dir, exist_ok=True)
+    for h in heights:
+        cmd += ['-map', f'[hls{h}_out]'] + x264_common + [
+            '-crf', str(ENCODING_CRF),
+            '-pix_fmt', 'yuv420p',
+            '-f', 'hls',
+            '-hls_time', str(HLS_SEGMENT_SECONDS),
+            '-hls_playlist_type', 'vod',
+            '-hls_segment_filename', os.path.join(hls_dir, f'{h}p_%03d.ts'),
+            os.path.join(hls_dir, f'{h}p.m3u8')]
+    
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=180)
+        if result.returncode != 0:
+            return False, f"Codificação multi-saída falhou: {result.stderr.strip()[-300:]}"
+    except subprocess.TimeoutExpired:
+        return False, "Timeout na codificação multi-saída"
+    except Exception as e:
+        return False, f"Erro na codificação multi-saída: {e}"
+    
+    if heights:
+        write_hls_master_playlist(hls_dir, heights, num_frames / fps)
+    return True, f"MP4{' + poster' if poster_path else ''}{f' + HLS {heights}' if heights else ''}"
+
+def write_hls_master_playlist(hls_dir, heights, duration):
+    """Escreve o master.m3u8 com a banda medida de cada rendition"""
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+    for h in heights:
+        segment_bytes = sum(os.path.getsize(os.path.join(hls_dir, f))
+                            for f in os.listdir(hls_dir) if f.startswith(f'{h}p_') and f.endswith('.ts'))
+        bandwidth = int(segment_bytes * 8 / max(duration, 1))
+        lines.append(f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={rendition_width(h)}x{h}')
+        lines.append(f'{h}p.m3u8')
+    with open(os.path.join(hls_dir, 'master.m3u8'), 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def write_poster_from_frames(frames, poster_path):
+    """Grava o poster direto do frame em memória (caminhos que não decodificam o clipe)"""
+    try:
+        return cv2.imwrite(poster_path, frames[len(frames) // 2], [cv2.IMWRITE_JPEG_QUALITY, 85])
+    except Exception as e:
+        logger.warning(f"⚠️ Não foi possível gravar o poster: {e}")
+        return False
+
+def collect_packaged_assets(clip_name, poster_path, hls_dir):
+    """Lista (local, remoto) dos arquivos extras na ordem de upload e as URLs para o webhook"""
+    assets = []
+    urls = {}
+    
+    if hls_dir and os.path.isfile(os.path.join(hls_dir, 'master.m3u8')):
+        files = os.listdir(hls_dir)
+        # Segmentos antes das playlists e o master por último: nunca apontam para algo ausente
+        ordered = (sorted(f for f in files if f.endswith('.ts')) +
+                   sorted(f for f in files if f.endswith('.m3u8') and f != 'master.m3u8') +
+                   ['master.m3u8'])
+        for f in ordered:
+            assets.append((os.path.join(hls_dir, f), f'{clip_name}/hls/{f}'))
+        urls['hls'] = build_b2_url(f'{clip_name}/hls/master.m3u8')
+    
+    if poster_path and os.path.isfile(poster_path):
+        assets.append((poster_path, f'{clip_name}.jpg'))
+        urls['poster'] = build_b2_url(f'{clip_name}.jpg')
+    
+    return assets, urls
+
+def queue_packaged_assets(assets, clip_name):
+    """Enfileira poster e HLS antes do MP4 (mesma prioridade, ordem de chegada)"""
+    for local_path, remote_path in assets:
+        if not add_to_upload_queue(local_path, remote_path, priority=True,
+                                   kind='asset', clip_name=f'{clip_name}.mp4'):
+            return False
+    return True
+
+# === FILA DE CODIFICAÇÃO E AGRUPAMENTO DE TRIGGERS ===
+def submit_encode_job(frames, end_seq, timestamp):
+    """Cria um job de codificação ou junta o trigger a um job pendente com janela sobreposta
+    
+    Com DURABLE_JOBS só retorna depois que os frames novos do trigger estão em disco e o
+    job está registrado no banco.
+    """
+    start_seq = end_seq - len(frames)
+    trigger_info = {'timestamp': timestamp, 'start_seq': start_seq, 'end_seq': end_seq}
+    coalesce = TRIGGER_COALESCE in ('merge', 'trim')
+    max_frames = int(TRIGGER_COALESCE_MAX_SECONDS * (detected_fps or FORCE_FPS))
+    now = time.time()
+    job = None
+    # (sequência inicial, frames) que este trigger acrescenta ao job e ainda não estão em disco
+    parts = [(start_seq, frames)]
+    
+    with encode_jobs_lock:
+        if coalesce:
+            for candidate in encode_jobs:
+                overlaps = start_seq <= candidate['end_seq'] and end_seq >= candidate['start_seq']
+                union = max(end_seq, candidate['end_seq']) - min(start_seq, candidate['start_seq'])
+                if not overlaps or union > max_frames:
+                    continue
+                
+                # frames[i] tem sequência start_seq + i: só copia o que falta na união
+                parts = []
+                if end_seq > candidate['end_seq']:
+                    parts.append((candidate['end_seq'], frames[candidate['end_seq'] - start_seq:]))
+                    candidate['frames'].extend(parts[-1][1])
+                    candidate['end_seq'] = end_seq
+                if start_seq < candidate['start_seq']:
+                    parts.append((start_seq, frames[:candidate['start_seq'] - start_seq]))
+                    candidate['frames'][0:0] = parts[-1][1]
+                    candidate['start_seq'] = start_seq
+                
+                candidate['triggers'].append(trigger_info)
+                candidate['ready_at'] = max(candidate['ready_at'], now + TRIGGER_COALESCE_WAIT)
+                logger.info(f"🔗 Trigger agrupado no job {candidate['id']} "
+                            f"({len(candidate['triggers'])} triggers, {len(candidate['frames'])} frames)")
+                job = candidate
+                break
+        
+        merged = job is not None
+        if not merged:
+            job = {
+                'id': next(encode_job_ids),
+                'name': timestamp.strftime("Penareia_%d-%m-%Y_%H-%M-%S"),
+                'frames': list(frames),
+                'start_seq': start_seq,
+                'end_seq': end_seq,
+                'triggers': [trigger_info],
+                'ready_at': now + (TRIGGER_COALESCE_WAIT if coalesce else 0),
+                'done': threading.Event(),
+                'result': None,
+                'durable': DURABLE_ENCODE_JOBS,
+                'snapshots': [],
+                'writing': 0,
+                'attempts': 0
+            }
+            encode_jobs.append(job)
+        durable = job['durable']
+        if durable:
+            # O worker não pega o job enquanto houver snapshot sendo gravado
+            job['writing'] += 1
+    
+    if durable:
+        persist_trigger_snapshot(job, trigger_info, parts)
+    encode_job_event.set()
+    return job, merged
+
+def take_ready_encode_job():
+    """Retira o primeiro job pronto da fila; retorna (job, segundos até o próximo ficar pronto)"""
+    now = time.time()
+    with encode_jobs_lock:
+        for job in encode_jobs:
+            if job['ready_at'] <= now and not job['writing']:
+                encode_jobs.remove(job)
+                return job, 0
+        if encode_jobs:
+            return None, min(job['ready_at'] for job in encode_jobs) - now
+    return None, 5
+
+def attempt_encode_job(job):
+    """Codifica o job na thread atual (com encode_context.settings já escolhido)"""
+    if job.get('db_id'):
+        job['attempts'] += 1
+        save_encode_job(job, 'encoding')
+    try:
+        job['result'] = run_profiled(run_encode_job, job)
+        job['result'][0]['nivel_codificacao'] = encode_context.settings['level']
+    except Exception as e:
+        logger.error(f"❌ Erro no job de codificação {job['id']}: {e}")
+        job['result'] = ({"error": f"Erro na codificação: {e}"}, 500)
+    finally:
+        # Libera os frames: o job pode continuar referenciado pelo trigger que aguarda
+        job['frames'] = []
+        finish_encode_job(job)
+        job['done'].set()
+    
+    if job['result'][1] >= 400:
+        logger.error(f"❌ Job {job['id']} falhou: {job['result'][0].get('error')}")
+
+def encode_job_worker():
+    """Thread que codifica os jobs da fila em ordem de chegada"""
+    global encode_jobs_running
+    
+    while encode_thread_running:
+        encode_job_event.clear()
+        job, wait = take_ready_encode_job()
+        if not job:
+            encode_job_event.wait(timeout=max(min(wait, 5), 0.05))
+            continue
+        
+        encode_jobs_running += 1
+        # O governador decide preset/threads/resolução uma vez por job
+        encode_context.settings = choose_encode_settings()
+        try:
+            attempt_encode_job(job)
+        finally:
+            encode_jobs_running -= 1
+            encode_context.settings = None
+
+def encode_recovery_worker():
+    """Thread que codifica os jobs recuperados sem atrasar os triggers novos
+    
+    Só começa um job com a fila normal vazia, com uma thread de FFmpeg e nice 10 (no Linux
+    o nice vale para esta thread e para os FFmpeg que ela dispara).
+    """
+    global recovery_running
+    if hasattr(os, 'nice'):
+        try:
+            os.nice(10)
+        except OSError:
+            pass
+    
+    while encode_thread_running:
+        try:
+            job = recovered_jobs.get(timeout=5)
+        except Empty:
+            continue
+        while encode_thread_running and (encode_jobs or encode_jobs_running):
+            time.sleep(1)
+        
+        logger.info(f"♻️ Codificando job recuperado {job['id']} ({job['name']}, "
+                    f"tentativa {job['attempts'] + 1}/{ENCODE_JOB_MAX_ATTEMPTS})")
+        recovery_running = True
+        # Sem frames em memória não há proxy nem nível só-proxy: o clipe sai dos snapshots
+        encode_context.settings = dict(choose_encode_settings(), threads=1, proxy=False)
+        try:
+            attempt_encode_job(job)
+        finally:
+            recovery_running = False
+            encode_context.settings = None
+        if job['result'][1] < 400:
+            logger.info(f"✅ Job recuperado {job['id']} concluído")
+
+# === JOBS DE CODIFICAÇÃO DURÁVEIS ===
+# Os frames que cada trigger acrescenta ao job viram um MP4 em videos/temp (o mesmo
+# temporário do OpenCV, só que gravado antes da resposta em vez de no worker) e o job é
+# salvo na tabela encode_jobs. Na inicialização, recover_encode_jobs recoloca os
+# inacabados na fila de baixa prioridade. Com SNAPSHOTS_IN_RAM eles vão para o staging:
+# sobrevivem a um crash do processo, mas não a um desligamento.
+def snapshot_path(job, start_seq, num_frames):
+    filename = f"{job['name']}_snap_{start_seq}.mp4"
+    if DURABLE_SNAPSHOTS_IN_RAM:
+        return staging.path_for(filename, staging.estimate(num_frames) // 2)
+    return os.path.join('videos', 'temp', filename)
+
+def remove_snapshot(path):
+    """Apaga um snapshot (no staging ou em videos/temp) e libera a reserva"""
+    clip_store.remove(path)
+    staging.release(path)
+
+def persist_trigger_snapshot(job, trigger_info, parts):
+    """Grava em disco os frames novos do trigger e registra o job no banco"""
+    started = time.monotonic()
+    success = True
+    os.makedirs(os.path.join('videos', 'temp'), exist_ok=True)
+    for part_start, part_frames in parts:
+        path = snapshot_path(job, part_start, len(part_frames))
+        success, error = write_temp_video(part_frames, path)
+        if not success:
+            logger.warning(f"⚠️ Snapshot do job {job['id']} não gravado ({error}); o job segue só em memória")
+            remove_snapshot(path)
+            break
+        clip_store.pin(path)
+        with encode_jobs_lock:
+            job['snapshots'].append({'path': path, 'start_seq': part_start,
+                                     'end_seq': part_start + len(part_frames)})
+    
+    with encode_jobs_lock:
+        if success:
+            trigger_info['durable'] = True
+        else:
+            # O worker codifica dos frames em memória; os snapshots já gravados saem no fim do job
+            job['durable'] = False
+    if success:
+        save_encode_job(job, 'queued')
+    metrics.observe('stage_seconds', time.monotonic() - started, stage='snapshot_write')
+    with encode_jobs_lock:
+        job['writing'] -= 1
+
+def save_encode_job(job, stage):
+    """Cria ou atualiza o registro do job: só triggers e snapshots que já estão em disco"""
+    with job.setdefault('db_lock', threading.Lock()):
+        with encode_jobs_lock:
+            params = json.dumps({
+                'triggers': [{'timestamp': t['timestamp'].isoformat(), 'start_seq': t['start_seq'],
+                              'end_seq': t['end_seq']} for t in job['triggers'] if t.get('durable')],
+                'proxy_queued': job.get('proxy_queued', False),
+                'trim': job.get('trim', False)
+            })
+            snapshots = json.dumps(sorted(job['snapshots'], key=lambda s: s['start_seq']))
+        now = time.time()
+        try:
+            conn = sqlite3.connect(DB_PATH, timeout=10.0)
+            if job.get('db_id'):
+                conn.execute('''
+                UPDATE encode_jobs SET stage = ?, params = ?, snapshots = ?, attempts = ?, updated_at = ?
+                WHERE id = ?
+                ''', (stage, params, snapshots, job['attempts'], now, job['db_id']))
+            else:
+                cursor = conn.execute('''
+                INSERT INTO encode_jobs (name, stage, params, snapshots, attempts, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (job['name'], stage, params, snapshots, job['attempts'], now, now))
+                job['db_id'] = cursor.lastrowid
+            conn.commit()
+            conn.close()
+            return True
+        except Exception as e:
+            logger.error(f"❌ Erro ao salvar job de codificação {job['id']}: {e}")
+            return False
+
+def delete_encode_job(db_id, snapshots):
+    """Apaga o registro do job e os snapshots em disco"""
+    for snapshot in snapshots:
+        remove_snapshot(snapshot['path'])
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=10.0)
+        conn.execute('DELETE FROM encode_jobs WHERE id = ?', (db_id,))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.warning(f"⚠️ Erro ao apagar job de codificação {db_id}: {e}")
+
+def finish_encode_job(job):
+    """Fim de uma tentativa: apaga o job durável ou, se falhou, devolve para a recuperação"""
+    failed = job['result'][1] >= 400
+    if (failed and job.get('durable') and job.get('db_id') and job['snapshots']
+            and job['attempts'] < ENCODE_JOB_MAX_ATTEMPTS):
+        job['recovered'] = True
+        save_encode_job(job, 'failed')
+        recovered_jobs.put(job)
+        logger.warning(f"♻️ Job {job['id']} será tentado de novo com prioridade baixa "
+                       f"({job['attempts']}/{ENCODE_JOB_MAX_ATTEMPTS})")
+        return
+    if failed and job.get('db_id'):
+        logger.error(f"❌ Job {job['id']} ({job['name']}) descartado depois de {job['attempts']} tentativa(s)")
+    if job.get('db_id'):
+        delete_encode_job(job['db_id'], job['snapshots'])
+    else:
+        for snapshot in job.get('snapshots', []):
+            remove_snapshot(snapshot['path'])
+
+def join_job_snapshots(snapshots, output_path):
+    """Temporário do job a partir dos snapshots (um só é usado direto; vários, por concat)"""
+    paths = [s['path'] for s in sorted(snapshots, key=lambda s: s['start_seq'])]
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        return False, f"Snapshot ausente: {missing[0]}"
+    if paths == [output_path]:
+        return True, None
+    list_path = f'{output_path}.txt'
+    try:
+        concat_segments(paths, output_path, list_path=list_path)
+    except Exception as e:
+        return False, f"Falha ao juntar snapshots: {e}"
+    finally:
+        try:
+            os.remove(list_path)
+        except OSError:
+            pass
+    if not staging.record_write(output_path):
+        return False, "Junção dos snapshots vazia (sem espaço?)"
+    clip_store.track(output_path, 'encoding')
+    return True, None
+
+def recover_encode_jobs():
+    """Na inicialização: recoloca na fila de baixa prioridade os jobs que um crash interrompeu"""
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=10.0)
+        rows = conn.execute(
+            'SELECT id, name, params, snapshots, attempts FROM encode_jobs ORDER BY id').fetchall()
+        queued = {row[0] for row in conn.execute('SELECT remote_path FROM upload_queue')}
+        conn.close()
+    except Exception as e:
+        logger.error(f"❌ Erro ao carregar jobs de codificação: {e}")
+        return 0
+    
+    recovered = 0
+    for db_id, name, params, snapshots, attempts in rows:
+        params = json.loads(params)
+        snapshots = json.loads(snapshots)
+        triggers = [dict(t, timestamp=datetime.fromisoformat(t['timestamp']), durable=True)
+                    for t in params['triggers']]
+        # Clipes que o job entrega (modo trim: um por trigger) para saber quais já chegaram à fila
+        # de upload; só os triggers que faltam são recodificados
+        trim = params.get('trim') or (TRIGGER_COALESCE == 'trim' and len(triggers) > 1)
+        if trim:
+            clip_names = assign_trimmed_clip_names({'triggers': triggers}, check_disk=False)
+            delivered = [t for t, clip in zip(triggers, clip_names) if f'{clip}.mp4' in queued]
+        else:
+            delivered = triggers if f'{name}.mp4' in queued else []
+        triggers = [t for t in triggers if t not in delivered]
+        present = sorted((s for s in snapshots if os.path.exists(s['path'])), key=lambda s: s['start_seq'])
+        
+        jobs = []
+        if not triggers:
+            logger.info(f"♻️ Job {name} já estava na fila de upload; removendo os snapshots")
+        elif attempts >= ENCODE_JOB_MAX_ATTEMPTS:
+            logger.error(f"❌ Job {name} descartado depois de {attempts} tentativa(s)")
+        else:
+            # Snapshots contíguos formam um trecho; um que faltou (crash no meio da gravação)
+            # separa o job em clipes independentes, cada um com os triggers que cobre inteiros
+            runs = []
+            for snapshot in present:
+                if runs and runs[-1][-1]['end_seq'] == snapshot['start_seq']:
+                    runs[-1].append(snapshot)
+                else:
+                    runs.append([snapshot])
+            for run in runs:
+                start_seq, end_seq = run[0]['start_seq'], run[-1]['end_seq']
+                run_triggers = [t for t in triggers if start_seq <= t['start_seq'] and t['end_seq'] <= end_seq]
+                if not run_triggers:
+                    continue
+                jobs.append({
+                    'id': next(encode_job_ids),
+                    # O primeiro trecho continua no registro original; os demais ganham um novo
+                    'db_id': None if jobs else db_id,
+                    'name': f'{name}_{len(jobs) + 1}' if jobs else name,
+                    'frames': [],
+                    'start_seq': start_seq,
+                    'end_seq': end_seq,
+                    'triggers': run_triggers,
+                    'ready_at': 0,
+                    'done': threading.Event(),
+                    'result': None,
+                    'durable': True,
+                    'recovered': True,
+                    'proxy_queued': params.get('proxy_queued', False),
+                    'trim': trim,
+                    'snapshots': run,
+                    'writing': 0,
+                    'attempts': attempts
+                })
+            if not jobs:
+                logger.warning(f"⚠️ Job {name} sem snapshot que cubra um trigger inteiro; descartado")
+            elif delivered:
+                logger.info(f"♻️ Job {name}: {len(delivered)} clipe(s) já na fila de upload, "
+                            f"recuperando os outros {len(triggers)}")
+        
+        if not jobs:
+            delete_encode_job(db_id, snapshots)
+            continue
+        kept = {s['path'] for job in jobs for s in job['snapshots']}
+        for snapshot in snapshots:
+            if snapshot['path'] not in kept:
+                remove_snapshot(snapshot['path'])
+        for job in jobs:
+            for snapshot in job['snapshots']:
+                clip_store.pin(snapshot['path'])
+                if staging.is_staged(snapshot['path']):
+                    staging.adopt(snapshot['path'])
+            save_encode_job(job, 'queued')
+            recovered_jobs.put(job)
+        recovered += len(jobs)
+    
+    if recovered:
+        logger.info(f"♻️ {recovered} job(s) de codificação recuperado(s) do banco, "
+                    f"codificando com prioridade baixa")
+    return recovered
+
+def get_encode_queue_status():
+    """Resumo da fila de codificação para o /status"""
+    with encode_jobs_lock:
+        pending = len(encode_jobs)
+        pending_triggers = sum(len(job['triggers']) for job in encode_jobs)
+    return {
+        "policy": TRIGGER_COALESCE,
+        "pending_jobs": pending,
+        "pending_triggers": pending_triggers,
+        "running": encode_jobs_running,
+        "durable": DURABLE_ENCODE_JOBS,
+        "recovery_pending": recovered_jobs.qsize(),
+        "recovery_running": recovery_running
+    }
+
+def trigger_offsets(job):
+    """Retorna (início, duração) exatos em segundos de cada trigger dentro do clipe do job"""
+    fps = detected_fps or FORCE_FPS
+    return [((t['start_seq'] - job['start_seq']) / fps, (t['end_seq'] - t['start_seq']) / fps)
+            for t in job['triggers']]
+
+def build_webhook_entries(job):
+    """Monta uma entrada de webhook por trigger com início e duração dentro do clipe agrupado"""
+    return [{
+        'data_hora': t['timestamp'].strftime('%Y-%m-%d %H:%M:%S'),
+        'inicio': round(start, 2),
+        'duracao': round(duration, 2)
+    } for t, (start, duration) in zip(job['triggers'], trigger_offsets(job))]
+
+def encode_for_trim(input_path, output_path, cut_times, duration=None):
+    """Codifica a união forçando keyframes nos pontos de corte, para recortes exatos sem recodificar
+
+    `duration` é a do maior recorte: cada um sobe como um clipe próprio.
+    """
+    fps = detected_fps or FORCE_FPS
+    cmd = [
+        FFMPEG_CMD, '-y', '-i', input_path,
+        '-c:v', 'libx264',
+        '-preset', encode_preset(),
+        '-crf', str(ENCODING_CRF),
+        *bitrate_cap_args(duration),
+        '-pix_fmt', PIXEL_FORMAT,
+        '-profile:v', 'baseline',
+        '-level', '3.1',
+        '-s', output_size(),
+        '-g', str(int(fps * 2)),
+        '-sc_threshold', '0',
+        # Um keyframe é forçado no primeiro frame com pts >= tempo: margem evita pular para o frame seguinte
+        '-force_key_frames', ','.join(f'{max(t - 0.001, 0):.3f}' for t in sorted(set(cut_times))),
+        '-threads', str(encode_threads()),
+        '-an',
+        '-movflags', 'faststart',
+        output_path
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
+        if result.returncode != 0:
+            return False, f"Codificação para recorte falhou: {result.stderr[-300:]}"
+        return True, "Codificação para recorte bem-sucedida"
+    except subprocess.TimeoutExpired:
+        return False, "Timeout na codificação para recorte"
+    except Exception as e:
+        return False, f"Erro na codificação para recorte: {e}"
+
+# === CLIPE PROXY ===
+def encode_proxy_clip(frames, output_path):
+    """Codifica uma versão pequena do clipe (PROXY_HEIGHT, CRF alto) a partir dos frames reduzidos"""
+    fps = detected_fps or FORCE_FPS
+    height, width = frames[0].shape[:2]
+    proxy_height = min(PROXY_HEIGHT, height)
+    # Largura par, exigida pelo yuv420p
+    proxy_width = max(int(round(width * proxy_height / height / 2)) * 2, 2)
+    
+    cmd = [
+        FFMPEG_CMD,
+        '-hide_banner', '-loglevel', 'error',
+        '-f', 'rawvideo',
+        '-pix_fmt', 'bgr24',
+        '-s', f'{proxy_width}x{proxy_height}',
+        '-r', str(fps),
+        '-i', '-',
+        '-an',
+        '-c:v', 'libx264',
+        '-preset', PROXY_PRESET,
+        '-crf', str(PROXY_CRF),
+        '-pix_fmt', 'yuv420p',
+        '-profile:v', 'baseline',
+        '-level', '3.0',
+        '-g', str(int(fps * 2)),
+        '-movflags', 'faststart',
+        '-y', output_path
+    ]
+    
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        for frame in frames:
+            # Reduz antes do pipe: menos bytes copiados e o FFmpeg não precisa escalar
+            small = cv2.resize(frame, (proxy_width, proxy_height), interpolation=cv2.INTER_AREA)
+            proc.stdin.write(small.data)
+        proc.stdin.close()
+        stderr = proc.stderr.read().decode('utf-8', errors='replace')
+        proc.wait(timeout=60)
+    except Exception as e:
+        proc.kill()
+        proc.wait()
+        return False, f"Erro no proxy: {e}"
+    
+    if proc.returncode != 0:
+        return False, f"Proxy falhou: {stderr.strip()[-300:]}"
+    return True, "Proxy gerado"
+
+def queue_proxy_clip(job, webhook_entries):
+    """Gera o proxy do job e o coloca na frente da queue; retorna True se enfileirado"""
+    started = time.time()
+    proxy_path = f"videos/final/{job['name']}_proxy.mp4"
+    success, message = encode_proxy_clip(job['frames'], proxy_path)
+    if not success:
+        logger.warning(f"⚠️ {message}, seguindo só com o clipe final")
+        return False
+    
+    # O webhook anuncia o proxy com o nome do clipe final: o segundo webhook troca a URL
+    if len(job['triggers']) > 1 and job.get('clip_names'):
+        # trim: cada trigger terá seu arquivo; o proxy da união vale para todos com o offset
+        entries = [dict(entry, arquivo=f'{name}.mp4', versao='proxy')
+                   for entry, name in zip(webhook_entries, job['clip_names'])]
+    elif webhook_entries:
+        entries = [dict(entry, arquivo=f"{job['name']}.mp4", versao='proxy') for entry in webhook_entries]
+    else:
+        entries = [{
+            'data_hora': job['triggers'][0]['timestamp'].strftime('%Y-%m-%d %H:%M:%S'),
+            'arquivo': f"{job['name']}.mp4",
+            'versao': 'proxy'
+        }]
+    
+    queued = add_to_upload_queue(proxy_path, f"{job['name']}_proxy.mp4", priority=UPLOAD_PRIORITY_PROXY,
+                                 webhook_entries=entries, kind='proxy', clip_name=f"{job['name']}.mp4")
+    if queued:
+        logger.info(f"⚡ Proxy enfileirado em {time.time() - started:.1f}s: {job['name']}_proxy.mp4")
+    return queued
+
+def trim_clip(input_path, output_path, start, duration):
+    """Recorta um trecho do clipe por cópia de stream (sem recodificar)"""
+    cmd = [
+        FFMPEG_CMD, '-y',
+        # Com cópia de stream o corte começa no keyframe <= -ss: margem garante o keyframe do ponto de corte
+        '-ss', f'{start + 0.001:.3f}',
+        '-i', input_path,
+        '-t', f'{duration:.3f}',
+        '-c', 'copy',
+        '-avoid_negative_ts', 'make_zero',
+        '-movflags', 'faststart',
+        output_path
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+        if result.returncode != 0:
+            return False, f"Recorte falhou: {result.stderr[-300:]}"
+        return True, "Recorte bem-sucedido"
+    except Exception as e:
+        return False, f"Erro no recorte: {e}"
+
+def assign_trimmed_clip_names(job, check_disk=True):
+    """Escolhe o nome do clipe recortado de cada trigger, sem colidir com arquivos existentes"""
+    names = []
+    for trigger_info in job['triggers']:
+        base = trigger_info['timestamp'].strftime("Penareia_%d-%m-%Y_%H-%M-%S")
+        name = base
+        # Dois triggers no mesmo segundo não podem sobrescrever o mesmo arquivo
+        suffix = 1
+        while name in names or (check_disk and os.path.exists(f'videos/final/{name}.mp4')):
+            suffix += 1
+            name = f"{base}_{suffix}"
+        names.append(name)
+    return names
+
+def deliver_trimmed_clips(job, union_path, webhook_entries):
+    """Recorta da união um clipe por trigger e enfileira cada um com seu próprio webhook"""
+    arquivos = []
+    errors = []
+    
+    for name, entry, (start, duration) in zip(job['clip_names'], webhook_entries, trigger_offsets(job)):
+        output_path = f'videos/final/{name}.mp4'
+        
+        success, message = trim_clip(union_path, output_path, start, duration)
+        if not success:
+            errors.append(message)
+            continue
+        
+        # O clipe recortado começa no trigger: só data_hora (e a versão, se houve proxy) vão ao webhook
+        clip_entry = {k: v for k, v in entry.items() if k in ('data_hora', 'versao')}
+        if add_to_upload_queue(output_path, f'{name}.mp4', priority=True,
+                               webhook_entries=[clip_entry]):
+            arquivos.append(f'{name}.mp4')
+        else:
+            errors.append(f"Falha ao adicionar {name}.mp4 à queue")
+    
+    staging.release(union_path)
+    try:
+        os.remove(union_path)
+    except:
+        pass
+    
+    if not arquivos:
+        return {"error": f"Falha ao recortar os clipes: {'; '.join(errors)}"}, 500
+    
+    logger.info(f"✂️ {len(arquivos)} clipes recortados do job {job['id']}")
+    return {
+        "success": True,
+        "message": f"{len(arquivos)} clipes recortados e adicionados à queue de upload!",
+        "arquivos": arquivos,
+        "conversao": "FFmpeg H.264 (recorte por cópia)",
+        "status": "Na queue de upload",
+        "erros": errors
+    }, 200
+
+# === TRIGGER UDP DE BAIXA LATÊNCIA ===
+# Datagrama ASCII: "PNR1 <tipo> <device_id> <contador> <millis_envio> <millis_aperto> <hmac>"
+# tipo T = trigger, P = ping de relógio (millis_aperto = millis_envio); hmac = HMAC-SHA256
+# (32 primeiros hex) do texto antes dele. O device_id inclui um nonce de boot do ESP32.
+UDP_PROTOCOL = 'PNR1'
+UDP_CLOCK_SAMPLES = 32
+# Salto de offset acima disso indica relógio reiniciado (millis() volta a zero)
+UDP_CLOCK_RESET_SECONDS = 2.0
+# Trigger só vale com um ping aceito há menos que isso (o ESP32 pinga a cada 5 s): depois
+# de um restart um trigger capturado e reenviado sozinho não corta clipe
+UDP_PING_FRESHNESS_SECONDS = 30
+
+def sign_udp_message(text):
+    """Assina uma mensagem do protocolo UDP com o segredo compartilhado"""
+    return hmac.new(TRIGGER_UDP_SECRET.encode(), text.encode(), hashlib.sha256).hexdigest()[:32]
+
+def parse_udp_message(data):
+    """Valida formato e assinatura de um datagrama; retorna dict ou None"""
+    try:
+        text = data.decode('ascii').strip()
+        body, signature = text.rsplit(' ', 1)
+        protocol, kind, device_id, counter, sent_ms, press_ms = body.split(' ')
+        if protocol != UDP_PROTOCOL or kind not in ('T', 'P'):
+            return None
+        if not hmac.compare_digest(signature, sign_udp_message(body)):
+            return None
+        return {'kind': kind, 'device_id': device_id, 'counter': int(counter),
+                'sent_ms': int(sent_ms), 'press_ms': int(press_ms)}
+    except (UnicodeDecodeError, ValueError):
+        return None
+
+def load_device_counter(device_id):
+    """Último contador aceito do dispositivo em execuções anteriores (-1 se nunca visto)"""
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=10.0)
+        row = conn.execute('SELECT last_counter FROM udp_devices WHERE device_id = ?', (device_id,)).fetchone()
+        conn.close()
+        return row[0] if row else -1
+    except Exception as e:
+        logger.warning(f"⚠️ Erro ao ler contador UDP de {device_id}: {e}")
+        return -1
+
+def save_device_counter(device_id, counter):
+    """Persiste o contador do trigger aceito (os pings não gravam: poupa o cartão SD)"""
+    try:
+        conn = sqlite3.connect(DB_PATH, timeout=10.0)
+        conn.execute('INSERT OR REPLACE INTO udp_devices (device_id, last_counter, updated_at) VALUES (?, ?, ?)',
+                     (device_id, counter, time.time()))
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.warning(f"⚠️ Erro ao salvar contador UDP de {device_id}: {e}")
+
+def update_device_clock(device_id, counter, sent_ms, recv_time, kind='P'):
+    """Atualiza o offset do relógio do dispositivo; retorna (offset, repetido) ou (None, False) se replay
+
+    Cada datagrama dá uma amostra recv_time - instante_de_envio = offset + atraso da rede.
+    O mínimo das amostras recentes é a que teve menos atraso (filtro de mínimo, como no NTP).
+    """
+    sample = recv_time - sent_ms / 1000.0
+    with device_clocks_lock:
+        clock = device_clocks.get(device_id)
+        if clock is None:
+            # Dispositivo novo na memória (restart, ou parado há mais de 1h): o contador vem do banco
+            last_counter = load_device_counter(device_id)
+            clock = {'samples': deque(maxlen=UDP_CLOCK_SAMPLES), 'offset': sample,
+                     'last_counter': last_counter, 'last_ping': None, 'restored': last_counter >= 0}
+            device_clocks[device_id] = clock
+        
+        # Contador menor que o último é replay; igual é reenvio da mesma mensagem (mas o
+        # contador salvo por uma execução anterior já foi processado: igual a ele também é replay)
+        if counter < clock['last_counter'] or (counter == clock['last_counter'] and clock['restored']):
+            return None, False
+        clock['restored'] = False
+        repeated = counter == clock['last_counter']
+        clock['last_counter'] = counter
+        clock['last_seen'] = recv_time
+        if kind == 'P' and not repeated:
+            clock['last_ping'] = recv_time
+        
+        if not repeated:
+            # Salto grande de offset: millis() deu a volta, as amostras antigas não valem mais
+            if abs(sample - clock['offset']) > UDP_CLOCK_RESET_SECONDS:
+                clock['samples'].clear()
+            clock['samples'].append(sample)
+            clock['offset'] = min(clock['samples'])
+        
+        # Esquece dispositivos parados há mais de 1h (cada boot do ESP32 usa um device_id novo)
+        for old_id in [d for d, c in device_clocks.items() if recv_time - c['last_seen'] > 3600]:
+            del device_clocks[old_id]
+        
+        return clock['offset'], repeated
 
-# === FUNÇÃO LEGADA MANTIDA PARA COMPATIBILIDADE ===
-def upload_to_b2(local_file_path, remote_file_name):
-    """Função legada - agora usa o sistema de queue"""
-    return add_to_upload_queue(local_file_path, remote_file_name, priority=True)
+def device_clock_is_fresh(device_id, recv_time):
+    """O offset do dispositivo vem de um ping aceito há pouco (não só do próprio trigger)"""
+    with device_clocks_lock:
+        clock = device_clocks.get(device_id)
+        return bool(clock and clock['last_ping'] is not None
+                    and recv_time - clock['last_ping'] <= UDP_PING_FRESHNESS_SECONDS)
 
-# === FUNÇÃO DE CAPTURA DE FRAMES ===
-def capture_frames():
-    global frame_buffer, detected_fps, frame_width, frame_height
+def run_udp_trigger(run, key, press_time):
+    """Processa um trigger UDP fora da thread do listener"""
+    metrics.inc('triggers_total', source='udp')
+    try:
+        response = run_profiled(process_trigger, press_time)
+    except Exception as e:
+        logger.error(f"❌ Erro no trigger UDP: {e}")
+        response = ({"error": f"Erro interno no trigger: {e}"}, 500)
+    finish_trigger_run(run, key, response)
     
-    reconnect_count = 0
-    max_reconnects = 10
+    if response[1] >= 400:
+        logger.error(f"❌ Trigger UDP falhou: {response[0].get('error')}")
+
+def udp_trigger_listener():
+    """Recebe triggers e pings UDP; responde ACK na hora e corta o clipe no instante do aperto"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((SERVER_HOST, TRIGGER_UDP_PORT))
+    logger.info(f"📡 Trigger UDP escutando na porta {TRIGGER_UDP_PORT}")
     
-    while reconnect_count < max_reconnects:
+    while True:
         try:
-            logger.info(f"🎥 Iniciando captura (tentativa {reconnect_count + 1})")
+            data, addr = sock.recvfrom(256)
+            recv_time = time.monotonic()
             
-            cap = cv2.VideoCapture(VIDEO_SOURCE)
-            if not cap.isOpened():
-                logger.error(f"❌ Erro ao conectar na fonte de vídeo: {VIDEO_SOURCE}")
-                reconnect_count += 1
-                time.sleep(5)
+            message = parse_udp_message(data)
+            if not message:
+                logger.warning(f"⚠️ Datagrama UDP inválido de {addr[0]}")
                 continue
-
-            # APLICA OTIMIZAÇÕES PARA RASPBERRY PI
-            cap = optimize_camera_for_pi(cap)
-
-            # DETECÇÃO AUTOMÁTICA DAS PROPRIEDADES DA CÂMERA
-            detected_fps = cap.get(cv2.CAP_PROP_FPS) or FORCE_FPS
-            frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-            frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            
-            # Força 24 FPS em todas as plataformas para economia de CPU
-            detected_fps = FORCE_FPS  # 24 FPS sempre
             
-            # Limita resolução se especificado
-            if IS_RASPBERRY_PI or IS_ARM:
-                frame_width = min(frame_width, MAX_WIDTH)
-                frame_height = min(frame_height, MAX_HEIGHT)
-
-            if detected_fps == 0 or detected_fps is None:
-                logger.warning("⚠️ Câmera não informou FPS. Usando valor forçado.")
-                detected_fps = FORCE_FPS
-
-            # INICIALIZAÇÃO DINÂMICA DO BUFFER COM BASE NO FPS REAL
-            buffer_size = int(BUFFER_SECONDS * detected_fps)
-            frame_buffer = deque(maxlen=buffer_size)
-
-            logger.info(f"✅ Conectado à câmera: {frame_width}x{frame_height} @ {detected_fps:.2f} FPS. Buffer de {BUFFER_SECONDS}s.")
-            
-            # Reset contador de reconexões
-            reconnect_count = 0
-            consecutive_failures = 0
+            offset, repeated = update_device_clock(
+                message['device_id'], message['counter'], message['sent_ms'], recv_time, message['kind'])
+            if offset is None:
+                logger.warning(f"⚠️ Datagrama UDP repetido (replay) de {message['device_id']}")
+                continue
+            if message['kind'] != 'T':
+                continue
+            if not device_clock_is_fresh(message['device_id'], recv_time):
+                # Sem ACK o ESP32 cai no POST /trigger
+                logger.warning(f"⚠️ Trigger UDP de {message['device_id']} sem ping recente; ignorado")
+                continue
             
-            while True:
-                try:
-                    ret, frame = cap.read()
-                    if not ret:
-                        consecutive_failures += 1
-                        logger.warning(f"⚠️ Falha na leitura do frame ({consecutive_failures})")
-                        
-                        if consecutive_failures > 10:
-                            logger.error("❌ Muitas falhas consecutivas, reconectando...")
-                            break
-                        
-                        time.sleep(0.1)
-                        continue
-                    
-                    # Reset contador de falhas
-                    consecutive_failures = 0
-                    
-                    with buffer_lock:
-                        frame_buffer.append(frame)
-                    
-                    # Atualiza heartbeat periodicamente
-                    if len(frame_buffer) % (detected_fps * 5) == 0:  # A cada 5 segundos
-                        update_heartbeat()
-                        
-                except KeyboardInterrupt:
-                    logger.info("🛑 Captura interrompida pelo usuário")
-                    cap.release()
-                    return
-                except Exception as e:
-                    logger.error(f"❌ Erro na captura: {e}")
-                    break
+            # ACK antes de qualquer processamento: o dispositivo para de reenviar
+            ack = f"{UDP_PROTOCOL} A {message['device_id']} {message['counter']}"
+            sock.sendto(f"{ack} {sign_udp_message(ack)}".encode('ascii'), addr)
+            if not repeated:
+                save_device_counter(message['device_id'], message['counter'])
             
-            cap.release()
+            # Reenvios do mesmo aperto caem na idempotência do /trigger
+            key = f"udp:{message['device_id']}:{message['counter']}"
+            run, reason = claim_trigger_run(key)
+            if reason:
+                logger.info(f"🔁 Trigger UDP duplicado ({reason}): {key}")
+                continue
             
+            press_time = message['press_ms'] / 1000.0 + offset
+            logger.info(f"📡 Trigger UDP de {message['device_id']} "
+                        f"(aperto há {(recv_time - press_time) * 1000:.0f} ms)")
+            threading.Thread(target=run_udp_trigger, args=(run, key, press_time), daemon=True).start()
         except Exception as e:
-            logger.error(f"❌ Erro na inicialização da captura: {e}")
-            
-        reconnect_count += 1
-        logger.info(f"🔄 Tentando reconectar em 5 segundos... ({reconnect_count}/{max_reconnects})")
-        time.sleep(5)
-    
-    logger.error(f"🚫 Máximo de tentativas de reconexão excedido ({max_reconnects})")
-    # Em caso de falha total, mantém o sistema rodando sem captura
-    while True:
-        time.sleep(30)
-        update_heartbeat()
+            logger.error(f"❌ Erro no listener UDP: {e}")
+            time.sleep(1)
 
-# === FUNÇÃO PARA DESCOBERTA AUTOMÁTICA NA REDE (mDNS) ===
-def setup_mdns():
-    """Configura descoberta automática na rede usando mDNS/Zeroconf"""
-    if not ENABLE_MDNS or not ZEROCONF_AVAILABLE:
-        return None
-        
-    try:
-        # Obtém IP local
-        hostname = socket.gethostname()
-        local_ip = socket.gethostbyname(hostname)
-        
-        # Configuração do serviço mDNS
-        desc = {
-            'version': '1.0',
-            'type': 'camera',
-            'model': 'PenAreia',
-            'platform': platform.system(),
-            'endpoints': '/trigger,/status'
+def get_device_clocks_status():
+    """Offsets estimados dos dispositivos UDP para o /status"""
+    now = time.monotonic()
+    with device_clocks_lock:
+        return {
+            device_id: {
+                "offset_ms": round(clock['offset'] * 1000, 1),
+                "samples": len(clock['samples']),
+                "last_seen_s": round(now - clock['last_seen'], 1)
+            } for device_id, clock in device_clocks.items()
         }
-        
-        info = ServiceInfo(
-            "_http._tcp.local.",
-            f"{SERVICE_NAME}._http._tcp.local.",
-            addresses=[socket.inet_aton(local_ip)],
-            port=SERVER_PORT,
-            properties=desc,
-            server=f"{hostname}.local."
-        )
-        
-        zeroconf = Zeroconf()
-        zeroconf.register_service(info)
-        
-        print(f"📶 Serviço mDNS registrado: {SERVICE_NAME}.local:{SERVER_PORT}")
-        print(f"🌐 Disponível em: http://{local_ip}:{SERVER_PORT}")
-        
-        return zeroconf
-        
-    except Exception as e:
-        print(f"⚠️ Erro ao configurar mDNS: {e}")
+
+# === IDEMPOTÊNCIA E DEBOUNCE DO TRIGGER ===
+def get_trigger_idempotency_key():
+    """Lê a chave de idempotência do header ou do corpo JSON, separada por dispositivo"""
+    key = request.headers.get('Idempotency-Key')
+    if not key:
+        body = request.get_json(silent=True) or {}
+        key = body.get('press_id') or body.get('idempotency_key')
+    if not key:
         return None
+    return f"{request.remote_addr}:{key}"
 
-# === FUNÇÃO PARA OBTER INFORMAÇÕES DO SISTEMA ===
-def get_system_info():
-    """Retorna informações do sistema para monitoramento"""
-    try:
-        if PSUTIL_AVAILABLE:
-            cpu_usage = psutil.cpu_percent(interval=1)
-            memory = psutil.virtual_memory()
-            disk = psutil.disk_usage('/') if (IS_RASPBERRY_PI or IS_ARM) else psutil.disk_usage('.')
-        else:
-            cpu_usage = 0
-            memory = type('obj', (object,), {'percent': 0, 'used': 0, 'total': 0})
-            disk = type('obj', (object,), {'percent': 0, 'used': 0, 'total': 0})
+def claim_trigger_run(key):
+    """Retorna (execução, motivo); motivo None significa que esta requisição deve processar o trigger"""
+    global last_trigger_run
+    now = time.time()
+    
+    with trigger_runs_lock:
+        # Remove chaves expiradas
+        for old_key in [k for k, run in trigger_runs.items()
+                        if run['done'].is_set() and now - run['started'] > TRIGGER_IDEMPOTENCY_TTL]:
+            del trigger_runs[old_key]
         
-        return {
-            'cpu_usage': f"{cpu_usage:.1f}%",
-            'memory_usage': f"{memory.percent:.1f}%",
-            'disk_usage': f"{disk.percent:.1f}%",
-            'temperature': get_cpu_temperature()
-        }
-    except:
-        return {'cpu_usage': 'N/A', 'memory_usage': 'N/A', 'disk_usage': 'N/A', 'temperature': 'N/A'}
+        if key and key in trigger_runs:
+            return trigger_runs[key], 'idempotency_key'
+        
+        # Debounce: junta triggers quase simultâneos ao que já está rodando (ou acabou de rodar)
+        run = last_trigger_run
+        if run and now - run['started'] < TRIGGER_DEBOUNCE_SECONDS and run['status'] != 'failed':
+            if key:
+                trigger_runs[key] = run
+            return run, 'debounce'
+        
+        run = {'started': now, 'done': threading.Event(), 'status': 'running', 'response': None}
+        if key:
+            trigger_runs[key] = run
+        last_trigger_run = run
+        return run, None
 
-def get_cpu_temperature():
-    """Obtém temperatura da CPU (Raspberry Pi)"""
-    try:
-        if IS_RASPBERRY_PI:
-            with open('/sys/class/thermal/thermal_zone0/temp', 'r') as f:
-                temp = int(f.read()) / 1000.0
-                return f"{temp:.1f}°C"
-    except:
-        pass
-    return 'N/A'
+def finish_trigger_run(run, key, response):
+    """Guarda a resposta do trigger e libera as requisições duplicadas que aguardam"""
+    status_code = response[1]
+    with trigger_runs_lock:
+        run['response'] = response
+        run['status'] = 'done' if status_code < 400 else 'failed'
+        # Falhas não ficam registradas: uma nova tentativa com a mesma chave processa de novo
+        if run['status'] == 'failed' and key and trigger_runs.get(key) is run:
+            del trigger_runs[key]
+    run['done'].set()
 
 # === ENDPOINT DE TRIGGER COM UPLOAD E WEBHOOK ===
 @app.route('/trigger', methods=['POST'])
 def trigger():
-    print("🎥 Trigger RECEBIDO! Salvando vídeo...")
+    key = get_trigger_idempotency_key()
+    run, reason = claim_trigger_run(key)
     
-    # Verifica espaço em disco antes de gravar
-    if not check_disk_space(min_gb=1):
-        logger.error("🚨 Espaço em disco insuficiente!")
-        # Tenta limpeza emergencial
-        cleanup_old_videos(max_age_hours=1, force=False)
-        if not check_disk_space(min_gb=0.5):
+    if reason:
+        logger.info(f"🔁 Trigger duplicado ({reason}), aguardando o trigger em andamento")
+        if not run['done'].wait(timeout=TRIGGER_DUPLICATE_WAIT):
             return {
-                "error": "Espaço em disco insuficiente",
-                "message": "Limpe arquivos antigos ou aumente o espaço disponível"
-            }, 507  # HTTP 507 Insufficient Storage
+                "success": True,
+                "message": "Trigger já em processamento",
+                "status": "Em processamento",
+                "duplicado": True
+            }, 202
+        
+        body, status_code = run['response']
+        return dict(body, duplicado=True, motivo=reason), status_code
+    
+    metrics.inc('triggers_total', source='http')
+    try:
+        response = run_profiled(process_trigger)
+    except Exception as e:
+        logger.error(f"❌ Erro no trigger: {e}")
+        response = ({"error": f"Erro interno no trigger: {e}"}, 500)
+    
+    finish_trigger_run(run, key, response)
+    return response
+
+def process_trigger(press_time=None):
+    """Salva o clipe do buffer, converte e enfileira o upload; retorna (resposta, status)
+
+    press_time (time.monotonic) corta o clipe no instante do aperto em vez do momento atual.
+    """
+    logger.info("🎥 Trigger RECEBIDO! Salvando vídeo...")
+    
+    # Espaço em disco pelos contadores do índice local (sem syscall; despeja só se faltar)
+    if not clip_store.ensure_room():
+        logger.error("🚨 Espaço em disco insuficiente!")
+        return {
+            "error": "Espaço em disco insuficiente",
+            "message": "Menos de MIN_FREE_GB livres e só restam uploads pendentes no disco"
+        }, 507  # HTTP 507 Insufficient Storage
     
     frames_to_save = []
     
+    lock_requested = time.monotonic()
     with buffer_lock:
+        snapshot_started = time.monotonic()
         if not frame_buffer:
-            print("❌ Nenhum frame disponível no buffer!")
+            logger.error("❌ Nenhum frame disponível no buffer!")
             return {"error": "Nenhum frame disponível no buffer!"}, 500
         
         num_frames = int(SAVE_SECONDS * detected_fps)
-        frames_to_save = list(frame_buffer)[-num_frames:]
+        end_index = len(frame_buffer)
+        if press_time is not None and frame_timestamps:
+            # Último frame lido até o aperto; aperto anterior ao buffer ainda gera o clipe mais antigo
+            end_index = max(bisect.bisect_right(frame_timestamps, press_time), min(num_frames, end_index))
+        start_index = max(end_index - num_frames, 0)
+        snapshot_end_seq = frames_captured - (len(frame_buffer) - end_index)
+        ring = frame_buffer if isinstance(frame_buffer, FrameRing) else None
+        if ring is None:
+            frames_to_save = list(itertools.islice(frame_buffer, start_index, end_index))
+    metrics.observe('buffer_lock_wait_seconds', snapshot_started - lock_requested, site='trigger')
+    if ring is not None:
+        # O anel é copiado fora do lock para a captura não esperar a cópia dos frames
+        frames_to_save = ring.copy_seqs(snapshot_end_seq - (end_index - start_index), snapshot_end_seq)
+    metrics.observe('stage_seconds', time.monotonic() - snapshot_started, stage='snapshot')
 
     if not frames_to_save:
-        print("❌ Frames para salvar estão vazios!")
+        logger.error("❌ Frames para salvar estão vazios!")
         return {"error": "Frames para salvar estão vazios!"}, 500
     
+    
+    job, merged = submit_encode_job(frames_to_save, snapshot_end_seq, datetime.now())
+    
+    # Sem agrupamento o trigger responde só depois da codificação, como sempre
+    if TRIGGER_COALESCE not in ('merge', 'trim'):
+        job['done'].wait()
+        return job['result']
+    
+    return {
+        "success": True,
+        "message": "Trigger agrupado com clipe pendente!" if merged else "Vídeo na fila de codificação!",
+        "arquivo": f"{job['name']}.mp4",
+        "status": "Na fila de codificação",
+        "agrupado": merged
+    }, 200
+
+def run_encode_job(job):
+    """Codifica o clipe de um job (um ou mais triggers) e enfileira o upload; retorna (resposta, status)"""
     # Cria as pastas necessárias
     for folder in ['videos', 'videos/temp', 'videos/final']:
         if not os.path.exists(folder):
             os.makedirs(folder)
-            print(f"📁 Pasta '{folder}' criada.")
-
-    # SALVA O VÍDEO TEMPORÁRIO COM OPENCV
-    try:
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')  # Codec temporário
-        now = datetime.now()
-        date_time_str = now.strftime("Penareia_%d-%m-%Y_%H-%M-%S")
+            logger.info(f"📁 Pasta '{folder}' criada.")
+    
+    date_time_str = job['name']
+    # Job recuperado do banco não tem frames em memória: o temporário sai dos snapshots
+    frames_to_save = job['frames']
+    num_frames = job['end_seq'] - job['start_seq']
+    snapshots = job['snapshots'] if job.get('durable') else None
+    triggers = job['triggers']
+    settings = current_encode_settings()
+    if settings['level'] > 0:
+        logger.info(f"🌡️ Job {job['id']} no nível {settings['level']}: preset {settings['preset']}, "
+                    f"{settings['threads']} thread(s), {output_size()}{' (só proxy)' if settings['proxy'] else ''}")
+    # No modo trim a união é só intermediária: cada trigger vira um recorte próprio
+    # (no nível só-proxy a união é entregue como um clipe agrupado)
+    # (job recuperado com parte dos clipes já na fila continua recortando, mesmo com um trigger)
+    trim = ((TRIGGER_COALESCE == 'trim' and len(triggers) > 1) or job.get('trim')) and not settings['proxy']
+    webhook_entries = build_webhook_entries(job) if len(triggers) > 1 or trim else None
+    
+    # Intermediários vão para o staging em RAM quando couberem
+    expected_temp = staging.estimate(num_frames)
+    if snapshots and len(snapshots) == 1:
+        temp_filename = snapshots[0]['path']  # O snapshot já é o temporário
+    else:
+        temp_filename = staging.path_for(f'{date_time_str}_temp.mp4', expected_temp)  # Arquivo temporário
+    final_filename = f'videos/final/{date_time_str}.mp4'     # Arquivo final
+    remote_filename = f'{date_time_str}.mp4'                 # Nome no B2
+    if trim:
+        final_filename = staging.path_for(f'{date_time_str}_uniao.mp4', expected_temp // 2)
+        job['clip_names'] = assign_trimmed_clip_names(job)
+    
+    # CLIPE PROXY: BAIXA RESOLUÇÃO, ENVIADO E ANUNCIADO ANTES DO CLIPE FINAL
+    # (recuperado: só anuncia a versão final se o proxy saiu antes do crash)
+    if PROXY_CLIP_ENABLED and not settings['proxy'] and (
+            job.get('proxy_queued') or (frames_to_save and queue_proxy_clip(job, webhook_entries))):
+        if not job.get('proxy_queued'):
+            job['proxy_queued'] = True
+            if job.get('db_id'):
+                save_encode_job(job, 'encoding')
+        first_time = triggers[0]['timestamp'].strftime('%Y-%m-%d %H:%M:%S')
+        webhook_entries = [dict(entry, versao='final')
+                           for entry in (webhook_entries or [{'data_hora': first_time}])]
+    
+    # Poster e HLS saem da mesma decodificação do MP4 (não se aplica ao modo trim)
+    packaging = packaging_enabled() and not trim
+    poster_filename = f'videos/final/{date_time_str}.jpg' if packaging and POSTER_ENABLED else None
+    hls_dir = f'videos/final/{date_time_str}_hls' if packaging and HLS_RENDITIONS else None
+    
+    # TENTA MONTAR O CLIPE A PARTIR DO CACHE DE SEGMENTOS PRÉ-CODIFICADOS
+    conversion_success = False
+    streamed_upload = None
+    encoder = None   # Caminho que gerou o clipe (métrica encodes_total)
+    transcode_started = time.monotonic()
+    if SEGMENT_CACHE_ENABLED and not trim and frames_to_save:
+        conversion_success, conversion_result = assemble_from_segment_cache(
+            frames_to_save, job['end_seq'], final_filename)
+        if conversion_success:
+            encoder = 'segment_cache'
+            # Sem decodificação aqui: o poster sai do frame em memória e o HLS fica de fora
+            if poster_filename and not write_poster_from_frames(frames_to_save, poster_filename):
+                poster_filename = None
+            hls_dir = None
+        else:
+            logger.warning(f"⚠️ {conversion_result}, usando codificação completa...")
+    
+    # NÍVEL SÓ-PROXY DO GOVERNADOR: O CLIPE SAI DIRETO DOS FRAMES EM BAIXA RESOLUÇÃO
+    if settings['proxy'] and not conversion_success and frames_to_save:
+        conversion_success, conversion_result = encode_proxy_clip(frames_to_save, final_filename)
+        if conversion_success:
+            encoder = 'proxy_only'
+            if poster_filename and not write_poster_from_frames(frames_to_save, poster_filename):
+                poster_filename = None
+            hls_dir = None
+        else:
+            logger.warning(f"⚠️ {conversion_result}, usando codificação completa...")
+    
+    if not conversion_success:
+        # SALVA O VÍDEO TEMPORÁRIO COM OPENCV
+        write_started = time.monotonic()
+        temp_success, temp_error = join_job_snapshots(snapshots, temp_filename) if snapshots else (False, None)
+        if not temp_success and snapshots and frames_to_save:
+            logger.warning(f"⚠️ {temp_error}, gravando o temporário dos frames em memória...")
+        if not temp_success and frames_to_save:
+            temp_success, temp_error = write_temp_video(frames_to_save, temp_filename)
+        if not temp_success and frames_to_save and staging.is_staged(temp_filename):
+            # tmpfs encheu no meio da escrita: repete no disco
+            logger.warning(f"⚠️ Falha no staging em RAM ({temp_error}), gravando em disco...")
+            staging.release(temp_filename)
+            try:
+                os.remove(temp_filename)
+            except OSError:
+                pass
+            temp_filename = os.path.join('videos', 'temp', os.path.basename(temp_filename))
+            temp_success, temp_error = write_temp_video(frames_to_save, temp_filename)
+        if not temp_success:
+            staging.release(temp_filename)
+            return {"error": temp_error}, 500
+        transcode_started = time.monotonic()
+        metrics.observe('stage_seconds', transcode_started - write_started, stage='temp_write')
         
-        temp_filename = f'videos/temp/{date_time_str}_temp.mp4'  # Arquivo temporário
-        final_filename = f'videos/final/{date_time_str}.mp4'     # Arquivo final
-        remote_filename = f'{date_time_str}.mp4'                 # Nome no B2
+        # MP4 + POSTER + HLS EM UMA ÚNICA DECODIFICAÇÃO
+        if packaging:
+            conversion_success, conversion_result = encode_multi_output(
+                temp_filename, final_filename, num_frames, poster_filename, hls_dir)
+            if conversion_success:
+                encoder = 'multi_output'
+            else:
+                logger.warning(f"⚠️ {conversion_result}, usando conversão normal sem poster/HLS...")
+                poster_filename = hls_dir = None
         
-        out = cv2.VideoWriter(temp_filename, fourcc, detected_fps, (frame_width, frame_height))
+        # CODIFICA EM MP4 FRAGMENTADO ENVIANDO AS PARTES AO B2 DURANTE A CODIFICAÇÃO
+        if STREAMING_UPLOAD_ENABLED and not trim and not conversion_success:
+            conversion_success, streamed_upload, conversion_result = encode_with_streaming_upload(
+                temp_filename, final_filename, remote_filename, num_frames / (detected_fps or FORCE_FPS))
+            if conversion_success:
+                encoder = 'streaming'
+            else:
+                logger.warning(f"⚠️ {conversion_result}, usando conversão normal...")
         
-        if not out.isOpened():
-            print("❌ Erro ao criar arquivo de vídeo temporário!")
-            return {"error": "Erro ao criar arquivo de vídeo temporário!"}, 500
+        # CODIFICA A UNIÃO COM KEYFRAMES NOS PONTOS DE CORTE
+        if trim:
+            offsets = trigger_offsets(job)
+            conversion_success, conversion_result = encode_for_trim(
+                temp_filename, final_filename, [start for start, _ in offsets],
+                max(duration for _, duration in offsets))
+            if conversion_success:
+                encoder = 'trim'
+            else:
+                logger.warning(f"⚠️ {conversion_result}, usando conversão normal...")
         
-        print(f"💾 Salvando {len(frames_to_save)} frames...")
-        for frame in frames_to_save:
-            out.write(frame)
-            
-        out.release()
-        print(f"✅ Vídeo temporário salvo: {temp_filename}")
+        # CONVERTE VÍDEO COM FFMPEG PARA COMPATIBILIDADE COM NAVEGADORES
+        if not conversion_success:
+            conversion_success, conversion_result = convert_temp_video(
+                temp_filename, final_filename, num_frames)
         
-    except Exception as e:
-        print(f"❌ Erro ao salvar vídeo temporário: {e}")
-        return {"error": f"Erro ao salvar vídeo temporário: {str(e)}"}, 500
+        if not conversion_success:
+            logger.error(f"❌ Falha na conversão: {conversion_result}")
+            return {"error": f"Falha na conversão do vídeo: {conversion_result}"}, 500
+        
+        # Remove arquivo temporário após conversão bem-sucedida (snapshots saem com o job)
+        if temp_filename not in [s['path'] for s in snapshots or []]:
+            staging.release(temp_filename)
+            if clip_store.remove(temp_filename) or not os.path.exists(temp_filename):
+                logger.info(f"🗑️ Arquivo temporário removido: {temp_filename}")
+            else:
+                logger.warning(f"⚠️ Não foi possível remover arquivo temporário: {temp_filename}")
     
-    # CONVERTE VÍDEO COM FFMPEG PARA COMPATIBILIDADE COM NAVEGADORES
-    print("🔄 Convertendo vídeo com FFmpeg...")
-    conversion_success, conversion_result = convert_video_with_ffmpeg(temp_filename, final_filename)
+    metrics.observe('stage_seconds', time.monotonic() - transcode_started, stage='transcode')
+    if encoder:
+        metrics.inc('encodes_total', encoder=encoder)
     
-    if not conversion_success:
-        print("⚠️ Tentando conversão alternativa com subprocess...")
-        conversion_success, conversion_result = convert_video_subprocess(temp_filename, final_filename)
+    # RECORTA UM CLIPE POR TRIGGER A PARTIR DA UNIÃO
+    if trim:
+        staging.record_write(final_filename)
+        return deliver_trimmed_clips(job, final_filename, webhook_entries)
     
-    if not conversion_success:
-        print(f"❌ Falha na conversão: {conversion_result}")
-        return {"error": f"Falha na conversão do vídeo: {conversion_result}"}, 500
+    # POSTER E HLS ENTRAM NA QUEUE ANTES DO MP4; AS URLS VÃO NO WEBHOOK DO MP4
+    assets, asset_urls = collect_packaged_assets(date_time_str, poster_filename, hls_dir)
+    if assets and queue_packaged_assets(assets, date_time_str):
+        first_time = triggers[0]['timestamp'].strftime('%Y-%m-%d %H:%M:%S')
+        webhook_entries = [dict(entry, **asset_urls)
+                           for entry in (webhook_entries or [{'data_hora': first_time}])]
     
-    # Remove arquivo temporário após conversão bem-sucedida
-    try:
-        os.remove(temp_filename)
-        print(f"🗑️ Arquivo temporário removido: {temp_filename}")
-    except:
-        print(f"⚠️ Não foi possível remover arquivo temporário: {temp_filename}")
+    # UPLOAD JÁ CONCLUÍDO EM STREAMING: SÓ REGISTRA E AVISA O WEBHOOK
+    if streamed_upload:
+        register_streamed_upload(final_filename, remote_filename, streamed_upload['url'],
+                                 streamed_upload['file_hash'], streamed_upload['file_sha1'],
+                                 webhook_entries)
+        
+        return {
+            "success": True,
+            "message": "Vídeo salvo e enviado ao B2 durante a codificação!",
+            "arquivo": remote_filename,
+            "conversao": "FFmpeg H.264 (MP4 fragmentado)",
+            "status": "Upload concluído",
+            "url": streamed_upload['url']
+        }, 200
     
     # ADICIONA À QUEUE DE UPLOAD
     logger.info("📋 Adicionando vídeo à queue de upload...")
-    queue_success = add_to_upload_queue(final_filename, remote_filename, priority=True)
+    queue_success = add_to_upload_queue(final_filename, remote_filename, priority=True,
+                                        webhook_entries=webhook_entries)
     
     if queue_success:
         logger.info("✅ Vídeo adicionado à queue com sucesso!")
@@ -1214,7 +5449,8 @@ def trigger():
             "message": "Vídeo salvo e adicionado à queue de upload!",
             "arquivo": remote_filename,
             "conversao": "FFmpeg H.264",
-            "status": "Na queue de upload"
+            "status": "Na queue de upload",
+            "triggers": len(triggers)
         }, 200
     else:
         logger.error("❌ Falha ao adicionar à queue")
@@ -1555,6 +5791,34 @@ def status():
         "b2_bucket": B2_BUCKET_NAME,
         "ffmpeg_available": ffmpeg_available,
         "video_format": "H.264 + AAC (Web Compatible)",
+        "segment_cache": get_segment_cache_status(),
+        "upload_rate_limit": upload_limiter.get_status(),
+        "upload_queue": {
+            "pending": get_upload_backlog(),
+            "window": upload_queue.qsize(),
+            "window_size": UPLOAD_PREFETCH
+        },
+        "circuit_breakers": {
+            breaker.name: breaker.get_status()
+            for breaker in (b2_auth_breaker, b2_upload_breaker, webhook_breaker)
+        },
+        "capture_health": capture_health.summary(),
+        "encode_queue": get_encode_queue_status(),
+        "encode_governor": get_governor_status(),
+        "logging": get_logging_status(),
+        "local_storage": clip_store.summary(),
+        "staging": staging.summary(),
+        "frame_ring": frame_buffer.summary() if isinstance(frame_buffer, FrameRing) else None,
+        "bitrate_cap": get_bitrate_cap_status(),
+        "udp_trigger": {
+            "port": TRIGGER_UDP_PORT,
+            "devices": get_device_clocks_status()
+        },
+        "parallel_encoding": {
+            "mode": PARALLEL_ENCODING,
+            "cpu_count": CPU_COUNT,
+            "last_run": last_parallel_encode
+        },
         "platform": {
             "system": platform.system(),
             "machine": platform.machine(),
@@ -1566,13 +5830,160 @@ def status():
         "service_name": SERVICE_NAME if ENABLE_MDNS else None
     }
 
+@app.route('/debug/capture', methods=['GET'])
+def debug_capture():
+    """Saúde da captura em janelas de 1, 5 e 15 minutos"""
+    return capture_health.get_debug()
+
+# === PROFILING SOB DEMANDA (CPROFILE, TRACEMALLOC E PILHAS DAS THREADS) ===
+def require_debug_token(view):
+    """Exige DEBUG_TOKEN no header X-Debug-Token (ou ?token=); sem token configurado, 404"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not DEBUG_TOKEN:
+            return {"error": "Endpoints de depuração desativados"}, 404
+        token = request.headers.get('X-Debug-Token') or request.args.get('token', '')
+        if not hmac.compare_digest(token.encode(), DEBUG_TOKEN.encode()):
+            return {"error": "Token de depuração inválido"}, 401
+        return view(*args, **kwargs)
+    return wrapper
+
+def debug_text(text):
+    """Resposta text/plain cortada em DEBUG_MAX_OUTPUT_KB"""
+    limit = DEBUG_MAX_OUTPUT_KB * 1024
+    if len(text) > limit:
+        text = text[:limit] + f"\n... saída cortada em {DEBUG_MAX_OUTPUT_KB} KB\n"
+    return text, 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
+def debug_int_arg(name, default, maximum):
+    try:
+        return min(max(int(request.args.get(name, default)), 1), maximum)
+    except ValueError:
+        return default
+
+def run_profiled(func, *args):
+    """Executa func sob cProfile quando há uma sessão de profiling ativa"""
+    session = profile_session
+    if session is None:
+        return func(*args)
+    
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Python 3.12+: só um cProfile ativo por vez no processo
+        return func(*args)
+    try:
+        return func(*args)
+    finally:
+        profiler.disable()
+        with profile_lock:
+            session['profilers'].append(profiler)
+
+@app.route('/debug/profile', methods=['GET', 'POST'])
+@require_debug_token
+def debug_profile():
+    """Perfila por N segundos os triggers e jobs de codificação que terminarem na janela"""
+    global profile_session
+    seconds = debug_int_arg('seconds', 30, PROFILE_MAX_SECONDS)
+    limit = debug_int_arg('limit', 40, 200)
+    sort = request.args.get('sort', 'cumulative')
+    if sort not in ('cumulative', 'tottime', 'ncalls'):
+        sort = 'cumulative'
+    
+    with profile_lock:
+        if profile_session is not None:
+            return {"error": "Já existe um profiling em andamento"}, 409
+        session = profile_session = {'profilers': []}
+    
+    logger.info(f"🔬 Profiling por {seconds}s")
+    try:
+        time.sleep(seconds)
+    finally:
+        with profile_lock:
+            profile_session = None
+            profilers = list(session['profilers'])
+    
+    if not profilers:
+        return debug_text(f"Nenhum trigger ou job de codificação terminou em {seconds}s\n")
+    
+    output = io.StringIO()
+    stats = pstats.Stats(profilers[0], stream=output)
+    for profiler in profilers[1:]:
+        stats.add(profiler)
+    output.write(f"{len(profilers)} execução(ões) perfilada(s) em {seconds}s\n")
+    stats.sort_stats(sort).print_stats(limit)
+    return debug_text(output.getvalue())
+
+@app.route('/debug/memory', methods=['GET', 'POST'])
+@require_debug_token
+def debug_memory():
+    """tracemalloc: action=start|snapshot|diff|stop; snapshot guarda a referência do diff"""
+    global tracemalloc_baseline
+    action = request.args.get('action', 'snapshot')
+    limit = debug_int_arg('limit', 25, 100)
+    
+    if action == 'start':
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(debug_int_arg('frames', 10, 25))
+        tracemalloc_baseline = None
+        return debug_text("tracemalloc ativo\n")
+    
+    if action == 'stop':
+        tracemalloc_baseline = None
+        tracemalloc.stop()
+        return debug_text("tracemalloc parado\n")
+    
+    if not tracemalloc.is_tracing():
+        return {"error": "tracemalloc não está ativo (use action=start)"}, 409
+    
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+    lines = [f"Memória rastreada: {current / 1024 / 1024:.1f} MB (pico {peak / 1024 / 1024:.1f} MB)"]
+    
+    if action == 'diff':
+        if tracemalloc_baseline is None:
+            return {"error": "Sem snapshot de referência (use action=snapshot antes)"}, 409
+        lines.append("Maiores diferenças desde o snapshot de referência:")
+        lines += [str(stat) for stat in snapshot.compare_to(tracemalloc_baseline, 'lineno')[:limit]]
+    else:
+        lines.append("Maiores alocações (o snapshot vira a referência do próximo diff):")
+        lines += [str(stat) for stat in snapshot.statistics('lineno')[:limit]]
+        tracemalloc_baseline = snapshot
+    
+    return debug_text('\n'.join(lines) + '\n')
+
+@app.route('/debug/threads', methods=['GET'])
+@require_debug_token
+def debug_threads():
+    """Pilha atual de todas as threads (captura, upload, watchdog, webhook, Flask)"""
+    max_frames = debug_int_arg('frames', 30, 100)
+    threads = {thread.ident: thread for thread in threading.enumerate()}
+    sections = []
+    for ident, frame in sys._current_frames().items():
+        thread = threads.get(ident)
+        name = thread.name if thread else 'desconhecida'
+        daemon = ' daemon' if thread and thread.daemon else ''
+        stack = ''.join(traceback.format_stack(frame)[-max_frames:])
+        sections.append(f"--- Thread {name} ({ident}{daemon}) ---\n{stack}")
+    return debug_text('\n'.join(sections))
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Métricas no formato texto do Prometheus"""
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 def signal_handler(signum, frame):
     """Handler para sinais do sistema"""
-    global upload_thread_running, watchdog_enabled
+    global upload_thread_running, watchdog_enabled, segment_cache_running
     
     logger.info(f"🛑 Sinal {signum} recebido, encerrando gracefully...")
     upload_thread_running = False
     watchdog_enabled = False
+    segment_cache_running = False
     sys.exit(0)
 
 if __name__ == '__main__':
@@ -1593,32 +6004,19 @@ if __name__ == '__main__':
     logger.info(f"   • Resolução máxima: {MAX_WIDTH}x{MAX_HEIGHT}")
     logger.info(f"   • Webhook: {WEBHOOK_URL}")
     logger.info(f"   • Bucket B2: {B2_BUCKET_NAME}")
+    if B2_REALM != 'production':
+        logger.info(f"   • Realm B2: {B2_REALM} (não é o Backblaze de produção)")
     
-    # Reconfigura logging com path correto da plataforma
-    try:
-        for handler in logger.handlers[:]:
-            handler.close()
-            logger.removeHandler(handler)
-        
-        log_dir = os.path.dirname(LOG_PATH)
-        if log_dir and not os.path.exists(log_dir):
-            os.makedirs(log_dir, exist_ok=True)
-        
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler(LOG_PATH, encoding='utf-8'),
-                logging.StreamHandler(sys.stdout)
-            ],
-            force=True
-        )
-        logger.info(f"📝 Log reconfigurado: {LOG_PATH}")
-    except Exception as e:
-        logger.warning(f"⚠️ Não foi possível reconfigurar logging: {e}")
     
     # Inicializa banco de dados
     init_database()
+    # Antes do índice local: fixa os snapshots para não expirarem na carga
+    recover_encode_jobs()
+    clip_store.load()
+    staging.clear()
+    attach_frame_ring()
+    # Primeira amostra da CPU: cada leitura do governador cobre o intervalo desde a anterior
+    read_cpu_load()
     
     # Verifica se FFmpeg está disponível e atualiza o path global
     ffmpeg_available, detected_ffmpeg = check_ffmpeg()
@@ -1643,6 +6041,24 @@ if __name__ == '__main__':
     upload_thread.start()
     logger.info("📤 Thread de upload iniciada")
     
+    # Entrega os webhooks pendentes (inclusive os que sobraram da execução anterior)
+    webhook_thread = threading.Thread(target=webhook_worker, daemon=True)
+    webhook_thread.start()
+    
+    # Inicia threads de codificação dos triggers
+    for _ in range(ENCODE_WORKERS):
+        threading.Thread(target=encode_job_worker, daemon=True).start()
+    threading.Thread(target=encode_recovery_worker, daemon=True).start()
+    logger.info(f"🎞️ Codificação: {ENCODE_WORKERS} thread(s), agrupamento de triggers: {TRIGGER_COALESCE}"
+                f"{', jobs duráveis' if DURABLE_ENCODE_JOBS else ''}")
+    
+    # Inicia listener UDP de triggers (opcional)
+    if TRIGGER_UDP_PORT:
+        if TRIGGER_UDP_SECRET:
+            threading.Thread(target=udp_trigger_listener, daemon=True).start()
+        else:
+            logger.warning("⚠️ UDP_PORT configurado sem UDP_SECRET: trigger UDP desativado")
+    
     # Inicia watchdog
     watchdog_thread = threading.Thread(target=watchdog_monitor, daemon=True)
     watchdog_thread.start()
@@ -1653,6 +6069,12 @@ if __name__ == '__main__':
     capture_thread.start()
     logger.info("🎥 Thread de captura iniciada")
     
+    # Inicia cache de segmentos pré-codificados (opcional)
+    if SEGMENT_CACHE_ENABLED:
+        segment_cache_thread = threading.Thread(target=segment_cache_worker, daemon=True)
+        segment_cache_thread.start()
+        logger.info("🧩 Thread do cache de segmentos iniciada")
+    
     # Aguarda inicialização
     time.sleep(5 if (IS_RASPBERRY_PI or IS_ARM) else 3)
     
@@ -1689,6 +6111,7 @@ if __name__ == '__main__':
         logger.info("🧹 Limpando recursos...")
         upload_thread_running = False
         watchdog_enabled = False
+        segment_cache_running = False
         
         if zeroconf_service:
             try:
@@ -0,0 +1,714 @@
+#!/usr/bin/env python3
+"""
+Emulador local do Backblaze B2 e do webhook do PenAreia
+Implementa os endpoints que o b2sdk usa (autorização, bucket, upload simples, large files
+em partes, HEAD por nome) e o POST do webhook, com latência, banda de upload limitada e
+falhas injetadas. Serve para testes de carga e soak sem tocar no bucket de produção.
+
+Exemplos:
+    python b2_emulator.py                                         # http://127.0.0.1:8600
+    python b2_emulator.py --latency-ms 80 --bandwidth-kbps 2000 --fail-rate 0.05
+    python b2_emulator.py --store /tmp/b2 --token-ttl 300 --drop-rate 0.02
+
+Para o app usar o emulador (config.ini):
+    [BACKBLAZE_B2]
+    REALM = http://127.0.0.1:8600
+    [WEBHOOK]
+    URL = http://127.0.0.1:8600/webhook
+
+Durante um teste os parâmetros podem ser trocados sem reiniciar:
+    curl -X POST -d '{"fail_rate": 0.5}' http://127.0.0.1:8600/_emulator/config
+    curl http://127.0.0.1:8600/_emulator/stats
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import secrets
+import socket
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlparse
+
+CHUNK_SIZE = 64 * 1024
+RECOMMENDED_PART_SIZE = 100 * 1024 * 1024
+MINIMUM_PART_SIZE = 5 * 1024 * 1024
+
+# Parâmetros que o POST /_emulator/config pode alterar em tempo de execução
+TUNABLE = ('latency_ms', 'jitter_ms', 'bandwidth_kbps', 'fail_rate', 'drop_rate', 'api_fail_rate',
+           'token_ttl', 'webhook_latency_ms', 'webhook_fail_rate')
+
+class EmulatorError(Exception):
+    """Erro no formato JSON do B2 ({status, code, message})"""
+
+    def __init__(self, status, code, message):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.message = message
+
+# === UPLINK COMPARTILHADO ===
+class Uplink:
+    """Banda de upload única: envios simultâneos dividem os mesmos kbit/s (0 = sem limite)"""
+
+    def __init__(self, kbps):
+        self.kbps = kbps
+        self.lock = threading.Lock()
+        self.free_at = 0.0
+
+    def consume(self, byte_count):
+        if not self.kbps:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.free_at)
+            self.free_at = start + byte_count * 8 / (self.kbps * 1000)
+            wait = self.free_at - now
+        time.sleep(wait)
+
+# === ESTADO DO EMULADOR ===
+class Emulator:
+    """Buckets, arquivos e large files em memória (conteúdo só com --store)"""
+
+    def __init__(self, args):
+        self.args = args
+        self.uplink = Uplink(args.bandwidth_kbps)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.account_id = 'penareia-emulador'
+        self.tokens = {}
+        self.buckets = {}
+        self.files = {}
+        self.names = {}
+        self.large_files = {}
+        self.next_id = 0
+        self.stats = Counter()
+        self.requests = Counter()
+        self.webhooks = deque(maxlen=50)
+
+    # --- Utilitários ---
+    def new_id(self, prefix):
+        with self.lock:
+            self.next_id += 1
+            return f'{prefix}_{self.next_id:012d}'
+
+    def issue_token(self):
+        token = secrets.token_hex(16)
+        with self.lock:
+            self.tokens[token] = time.time() + self.args.token_ttl if self.args.token_ttl else None
+        return token
+
+    def check_token(self, token):
+        with self.lock:
+            if token not in self.tokens:
+                raise EmulatorError(401, 'bad_auth_token', 'Token desconhecido')
+            expires_at = self.tokens[token]
+            if expires_at is not None and time.time() > expires_at:
+                del self.tokens[token]
+                self.stats['injected_expired_token'] += 1
+                raise EmulatorError(401, 'expired_auth_token', 'Token expirado (--token-ttl)')
+
+    def chance(self, rate):
+        return rate > 0 and random.random() < rate
+
+    def delay(self, base_ms):
+        total = base_ms + random.uniform(0, self.args.jitter_ms)
+        if total > 0:
+            time.sleep(total / 1000)
+
+    def bucket_for(self, bucket_name):
+        with self.lock:
+            if bucket_name not in self.buckets:
+                self.buckets[bucket_name] = f'emu{len(self.buckets) + 1:020d}'
+            return self.buckets[bucket_name]
+
+    def bucket_name_for(self, bucket_id):
+        with self.lock:
+            for name, id_ in self.buckets.items():
+                if id_ == bucket_id:
+                    return name
+        raise EmulatorError(400, 'bad_bucket_id', f'Bucket inexistente: {bucket_id}')
+
+    def bucket_dict(self, bucket_name):
+        return {
+            'accountId': self.account_id,
+            'bucketName': bucket_name,
+            'bucketId': self.bucket_for(bucket_name),
+            'bucketType': 'allPublic',
+            'bucketInfo': {},
+            'corsRules': [],
+            'lifecycleRules': [],
+            'options': [],
+            'revision': 1,
+            'defaultServerSideEncryption': {'isClientAuthorizedToRead': True, 'value': {'mode': 'none'}},
+            'fileLockConfiguration': {
+                'isClientAuthorizedToRead': True,
+                'value': {'defaultRetention': {'mode': None, 'period': None}, 'isFileLockEnabled': False}
+            },
+            'replicationConfiguration': {'isClientAuthorizedToRead': True, 'value': None}
+        }
+
+    def file_dict(self, record):
+        return {
+            'accountId': self.account_id,
+            'bucketId': record['bucket_id'],
+            'fileId': record['file_id'],
+            'fileName': record['name'],
+            'contentLength': record['size'],
+            'contentType': record['content_type'],
+            'contentSha1': record['sha1'],
+            'fileInfo': record['info'],
+            'action': record['action'],
+            'uploadTimestamp': record['timestamp'],
+            'fileRetention': {'isClientAuthorizedToRead': False, 'value': None},
+            'legalHold': {'isClientAuthorizedToRead': False, 'value': None},
+            'serverSideEncryption': {'mode': 'none'},
+            'replicationStatus': None
+        }
+
+    def store_path(self, *parts):
+        """Caminho dentro de --store, recusando nomes que escapem do diretório"""
+        path = os.path.normpath(os.path.join(self.args.store, *parts))
+        if not path.startswith(os.path.normpath(self.args.store) + os.sep):
+            raise EmulatorError(400, 'bad_request', 'Nome de arquivo inválido')
+        return path
+
+    # --- Corpo dos uploads ---
+    def receive_body(self, handler, content_length, destination=None):
+        """Lê o corpo no ritmo do uplink calculando o SHA1; None = conexão derrubada de propósito"""
+        drop_at = content_length // 2 if self.chance(self.args.drop_rate) else None
+        sha1 = hashlib.sha1()
+        remaining = content_length
+        received = 0
+        out = open(destination, 'wb') if destination else None
+        try:
+            while remaining > 0:
+                chunk = handler.rfile.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise EmulatorError(400, 'bad_request', 'Corpo menor que o Content-Length')
+                self.uplink.consume(len(chunk))
+                sha1.update(chunk)
+                if out:
+                    out.write(chunk)
+                remaining -= len(chunk)
+                received += len(chunk)
+                if drop_at is not None and received >= drop_at:
+                    self.stats['injected_drop'] += 1
+                    return None
+        finally:
+            if out:
+                out.close()
+            with self.lock:
+                self.stats['bytes_received'] += received
+        return sha1.hexdigest()
+
+    def verify_sha1(self, declared, actual, content_length):
+        if declared == 'do_not_verify':
+            return actual
+        if declared == 'hex_digits_at_end':
+            # SHA1 nos últimos 40 bytes do corpo: aceito sem conferir
+            return 'unverified:' + actual
+        if declared and declared != actual:
+            raise EmulatorError(400, 'bad_request', f'SHA1 não confere: {declared} != {actual}')
+        return actual
+
+    # --- Endpoints da API ---
+    def authorize_account(self, handler):
+        header = handler.headers.get('Authorization', '')
+        try:
+            key_id, _, key = base64.b64decode(header.split(' ', 1)[1]).decode().partition(':')
+        except Exception:
+            raise EmulatorError(401, 'bad_auth_token', 'Authorization Basic ausente')
+        if self.args.key_id and (key_id != self.args.key_id or key != self.args.key):
+            raise EmulatorError(401, 'unauthorized', 'Credenciais inválidas')
+
+        base = handler.base_url()
+        storage = {
+            'apiUrl': base,
+            'downloadUrl': base,
+            's3ApiUrl': base,
+            'recommendedPartSize': RECOMMENDED_PART_SIZE,
+            'absoluteMinimumPartSize': MINIMUM_PART_SIZE,
+            'capabilities': ['listBuckets', 'listFiles', 'readFiles', 'writeFiles', 'deleteFiles'],
+            'namePrefix': None,
+            'bucketId': None,
+            'bucketName': None,
+            'allowed': {
+                'buckets': None,
+                'capabilities': ['listBuckets', 'listFiles', 'readFiles', 'writeFiles', 'deleteFiles'],
+                'namePrefix': None
+            }
+        }
+        # Formato v3/v4 (apiInfo) e campos da v2 no topo, para b2sdk novo e antigo
+        return {
+            'accountId': self.account_id,
+            'authorizationToken': self.issue_token(),
+            'apiInfo': {'storageApi': storage},
+            'apiUrl': base,
+            'downloadUrl': base,
+            's3ApiUrl': base,
+            'recommendedPartSize': RECOMMENDED_PART_SIZE,
+            'absoluteMinimumPartSize': MINIMUM_PART_SIZE,
+            'allowed': {'bucketId': None, 'bucketName': None, 'namePrefix': None,
+                        'capabilities': storage['capabilities']}
+        }
+
+    def list_buckets(self, params):
+        name = params.get('bucketName')
+        if name:
+            return {'buckets': [self.bucket_dict(name)]}
+        with self.lock:
+            names = list(self.buckets)
+        return {'buckets': [self.bucket_dict(n) for n in names]}
+
+    def get_upload_url(self, handler, params):
+        bucket_id = params['bucketId']
+        self.bucket_name_for(bucket_id)
+        return {'bucketId': bucket_id, 'uploadUrl': f'{handler.base_url()}/_upload/{bucket_id}',
+                'authorizationToken': self.issue_token()}
+
+    def get_upload_part_url(self, handler, params):
+        file_id = params['fileId']
+        if file_id not in self.large_files:
+            raise EmulatorError(400, 'bad_request', f'Large file inexistente: {file_id}')
+        return {'fileId': file_id, 'uploadUrl': f'{handler.base_url()}/_upload_part/{file_id}',
+                'authorizationToken': self.issue_token()}
+
+    def start_large_file(self, params):
+        bucket_id = params['bucketId']
+        self.bucket_name_for(bucket_id)
+        file_id = self.new_id('4_zlarge')
+        record = {'file_id': file_id, 'bucket_id': bucket_id, 'name': params['fileName'],
+                  'content_type': params.get('contentType') or 'b2/x-auto',
+                  'info': params.get('fileInfo') or {}, 'size': 0, 'sha1': 'none',
+                  'action': 'start', 'timestamp': int(time.time() * 1000), 'parts': {}}
+        with self.lock:
+            self.large_files[file_id] = record
+        return self.file_dict(record)
+
+    def list_parts(self, params):
+        record = self.large_file(params['fileId'])
+        start = params.get('startPartNumber') or 1
+        limit = params.get('maxPartCount') or 1000
+        numbers = sorted(n for n in record['parts'] if n >= start)
+        parts = [{'fileId': record['file_id'], 'partNumber': n, 'contentLength': record['parts'][n][1],
+                  'contentSha1': record['parts'][n][0], 'uploadTimestamp': record['timestamp']}
+                 for n in numbers[:limit]]
+        return {'parts': parts, 'nextPartNumber': numbers[limit] if len(numbers) > limit else None}
+
+    def finish_large_file(self, params):
+        record = self.large_file(params['fileId'])
+        sha1s = params.get('partSha1Array') or []
+        parts = record['parts']
+        if sorted(parts) != list(range(1, len(sha1s) + 1)):
+            raise EmulatorError(400, 'bad_request', f'Partes recebidas {sorted(parts)} != {len(sha1s)} declaradas')
+        for number, sha1 in enumerate(sha1s, 1):
+            if parts[number][0] != sha1:
+                raise EmulatorError(400, 'bad_request', f'SHA1 da parte {number} não confere')
+        if self.args.store:
+            bucket_name = self.bucket_name_for(record['bucket_id'])
+            destination = self.store_path(bucket_name, record['name'])
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            with open(destination, 'wb') as out:
+                for number in range(1, len(sha1s) + 1):
+                    part_path = self.store_path('.parts', record['file_id'], str(number))
+                    with open(part_path, 'rb') as part:
+                        while True:
+                            chunk = part.read(CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            out.write(chunk)
+                    os.remove(part_path)
+        record.update(size=sum(size for _, size in parts.values()), action='upload')
+        with self.lock:
+            self.large_files.pop(record['file_id'], None)
+            self.add_file(record)
+            self.stats['large_files_finished'] += 1
+        self.log(f"📦 Large file concluído: {record['name']} ({len(sha1s)} partes, {record['size']} bytes)")
+        return self.file_dict(record)
+
+    def cancel_large_file(self, params):
+        with self.lock:
+            record = self.large_files.pop(params['fileId'], None)
+            self.stats['large_files_canceled'] += 1
+        if not record:
+            raise EmulatorError(400, 'bad_request', f"Large file inexistente: {params['fileId']}")
+        return {'fileId': record['file_id'], 'fileName': record['name'],
+                'accountId': self.account_id, 'bucketId': record['bucket_id']}
+
+    def list_unfinished_large_files(self, params):
+        prefix = params.get('namePrefix') or ''
+        with self.lock:
+            records = [r for r in self.large_files.values()
+                       if r['bucket_id'] == params['bucketId'] and r['name'].startswith(prefix)]
+        return {'files': [self.file_dict(r) for r in records], 'nextFileId': None}
+
+    def list_file_names(self, params):
+        prefix = params.get('prefix') or ''
+        start = params.get('startFileName') or ''
+        limit = params.get('maxFileCount') or 100
+        with self.lock:
+            records = sorted((r for (bucket_id, name), r in self.names.items()
+                              if bucket_id == params['bucketId'] and name.startswith(prefix) and name >= start),
+                             key=lambda r: r['name'])
+        return {'files': [self.file_dict(r) for r in records[:limit]],
+                'nextFileName': records[limit]['name'] if len(records) > limit else None}
+
+    def get_file_info(self, params):
+        with self.lock:
+            record = self.files.get(params['fileId'])
+        if not record:
+            raise EmulatorError(404, 'not_found', f"Arquivo inexistente: {params['fileId']}")
+        return self.file_dict(record)
+
+    def large_file(self, file_id):
+        with self.lock:
+            record = self.large_files.get(file_id)
+        if not record:
+            raise EmulatorError(400, 'bad_request', f'Large file inexistente: {file_id}')
+        return record
+
+    def add_file(self, record):
+        """Registra um arquivo concluído (chamar com self.lock)"""
+        self.files[record['file_id']] = record
+        self.names[(record['bucket_id'], record['name'])] = record
+        self.stats['files_uploaded'] += 1
+
+    # --- Uploads ---
+    def upload_file(self, handler, bucket_id):
+        bucket_name = self.bucket_name_for(bucket_id)
+        name = unquote(handler.headers.get('X-Bz-File-Name', ''))
+        if not name:
+            raise EmulatorError(400, 'bad_request', 'X-Bz-File-Name ausente')
+        content_length = int(handler.headers.get('Content-Length', 0))
+        destination = None
+        if self.args.store:
+            destination = self.store_path(bucket_name, name)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+        actual = self.receive_body(handler, content_length, destination)
+        if actual is None:
+            return None
+        if self.chance(self.args.fail_rate):
+            self.stats['injected_upload_503'] += 1
+            raise EmulatorError(503, 'service_unavailable', 'Falha injetada (--fail-rate)')
+        declared = handler.headers.get('X-Bz-Content-Sha1')
+        sha1 = self.verify_sha1(declared, actual, content_length)
+        if declared == 'hex_digits_at_end':
+            content_length -= 40
+
+        info = {key[len('x-bz-info-'):]: unquote(value) for key, value in handler.headers.items()
+                if key.lower().startswith('x-bz-info-')}
+        record = {'file_id': self.new_id('4_zfile'), 'bucket_id': bucket_id, 'name': name,
+                  'content_type': handler.headers.get('Content-Type') or 'b2/x-auto', 'info': info,
+                  'size': content_length, 'sha1': sha1, 'action': 'upload',
+                  'timestamp': int(time.time() * 1000)}
+        with self.lock:
+            self.add_file(record)
+        self.log(f"⬆️ Upload: {name} ({content_length} bytes)")
+        return self.file_dict(record)
+
+    def upload_part(self, handler, file_id):
+        record = self.large_file(file_id)
+        part_number = int(handler.headers.get('X-Bz-Part-Number', 0))
+        if not 1 <= part_number <= 10000:
+            raise EmulatorError(400, 'bad_request', f'X-Bz-Part-Number inválido: {part_number}')
+        content_length = int(handler.headers.get('Content-Length', 0))
+        destination = None
+        if self.args.store:
+            destination = self.store_path('.parts', file_id, str(part_number))
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+        actual = self.receive_body(handler, content_length, destination)
+        if actual is None:
+            return None
+        if self.chance(self.args.fail_rate):
+            self.stats['injected_part_503'] += 1
+            raise EmulatorError(503, 'service_unavailable', 'Falha injetada (--fail-rate)')
+        sha1 = self.verify_sha1(handler.headers.get('X-Bz-Content-Sha1'), actual, content_length)
+
+        with self.lock:
+            record['parts'][part_number] = (sha1, content_length)
+            self.stats['parts_uploaded'] += 1
+        return {'fileId': file_id, 'partNumber': part_number, 'contentLength': content_length,
+                'contentSha1': sha1, 'uploadTimestamp': int(time.time() * 1000)}
+
+    # --- Webhook ---
+    def webhook(self, handler):
+        length = int(handler.headers.get('Content-Length', 0))
+        body = handler.rfile.read(length).decode('utf-8', errors='replace') if length else ''
+        self.delay(self.args.webhook_latency_ms)
+        if self.chance(self.args.webhook_fail_rate):
+            self.stats['injected_webhook_500'] += 1
+            return 500, {'success': False, 'message': 'Falha injetada (--webhook-fail-rate)'}
+        fields = {key: values[-1] for key, values in parse_qs(body).items()}
+        if not fields and body.strip().startswith('{'):
+            fields = json.loads(body)
+        with self.lock:
+            self.stats['webhooks'] += 1
+            self.webhooks.append({'received_at': datetime.now().isoformat(), **fields})
+        self.log(f"🔔 Webhook: {fields.get('arquivo', '?')} {fields.get('versao', '')}".rstrip())
+        return 200, {'success': True, 'id': self.stats['webhooks']}
+
+    # --- Controle ---
+    def get_stats(self, include_files=False):
+        with self.lock:
+            open_large = len(self.large_files)
+            result = {
+                'uptime_seconds': round(time.time() - self.started, 1),
+                'config': {name: getattr(self.args, name) for name in TUNABLE},
+                'counters': dict(self.stats),
+                'requests': dict(self.requests),
+                'files': len(self.files),
+                'large_files_open': open_large,
+                'last_webhooks': list(self.webhooks)
+            }
+            if include_files:
+                result['file_sizes'] = {r['name']: r['size'] for r in self.names.values()}
+        return result
+
+    def update_config(self, changes):
+        unknown = sorted(set(changes) - set(TUNABLE))
+        if unknown:
+            raise EmulatorError(400, 'bad_request', f'Parâmetros desconhecidos: {unknown}')
+        for name, value in changes.items():
+            setattr(self.args, name, value)
+        self.uplink.kbps = self.args.bandwidth_kbps
+        self.log(f"🔧 Configuração alterada: {changes}")
+        return {name: getattr(self.args, name) for name in TUNABLE}
+
+    def log(self, message):
+        if not self.args.quiet:
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] {message}", flush=True)
+
+# === SERVIDOR HTTP ===
+API_ENDPOINTS = {
+    'b2_list_buckets', 'b2_get_upload_url', 'b2_get_upload_part_url', 'b2_start_large_file',
+    'b2_list_parts', 'b2_finish_large_file', 'b2_cancel_large_file', 'b2_list_unfinished_large_files',
+    'b2_list_file_names', 'b2_get_file_info'
+}
+
+class EmulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'PenAreiaB2Emulator/1.0'
+
+    @property
+    def emulator(self):
+        return self.server.emulator
+
+    def base_url(self):
+        return f"http://{self.headers.get('Host') or '%s:%d' % self.server.server_address[:2]}"
+
+    def log_message(self, format, *args):
+        if self.emulator.args.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, payload, head_only=False):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head_only:
+            self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            raise EmulatorError(400, 'bad_request', 'JSON inválido')
+
+    def discard_body(self):
+        # Erro antes de ler o corpo: descarta para não corromper a conexão keep-alive
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining > 0:
+            chunk = self.rfile.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_HEAD(self):
+        self.dispatch('HEAD')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        emulator = self.emulator
+        path = urlparse(self.path).path
+        body_read = False
+        try:
+            if path.startswith('/_emulator/'):
+                body_read = True
+                if path == '/_emulator/stats':
+                    query = parse_qs(urlparse(self.path).query)
+                    return self.send_json(200, emulator.get_stats(include_files='files' in query))
+                if path == '/_emulator/config' and method == 'POST':
+                    return self.send_json(200, emulator.update_config(self.read_json()))
+                raise EmulatorError(404, 'not_found', path)
+
+            if path == emulator.args.webhook_path and method == 'POST':
+                body_read = True
+                emulator.requests['webhook'] += 1
+                return self.send_json(*emulator.webhook(self))
+
+            emulator.delay(emulator.args.latency_ms)
+
+            if path.startswith('/b2api/'):
+                endpoint = path.rsplit('/', 1)[-1]
+                emulator.requests[endpoint] += 1
+                if endpoint == 'b2_authorize_account':
+                    self.discard_body()
+                    body_read = True
+                    return self.send_json(200, emulator.authorize_account(self))
+                if endpoint not in API_ENDPOINTS:
+                    raise EmulatorError(404, 'not_found', f'Endpoint não emulado: {endpoint}')
+                params = self.read_json() if method == 'POST' else {
+                    key: values[-1] for key, values in parse_qs(urlparse(self.path).query).items()}
+                body_read = True
+                emulator.check_token(self.headers.get('Authorization'))
+                if emulator.chance(emulator.args.api_fail_rate):
+                    emulator.stats['injected_api_503'] += 1
+                    raise EmulatorError(503, 'service_unavailable', 'Falha injetada (--api-fail-rate)')
+                handlers = {
+                    'b2_list_buckets': lambda: emulator.list_buckets(params),
+                    'b2_get_upload_url': lambda: emulator.get_upload_url(self, params),
+                    'b2_get_upload_part_url': lambda: emulator.get_upload_part_url(self, params),
+                    'b2_start_large_file': lambda: emulator.start_large_file(params),
+                    'b2_list_parts': lambda: emulator.list_parts(params),
+                    'b2_finish_large_file': lambda: emulator.finish_large_file(params),
+                    'b2_cancel_large_file': lambda: emulator.cancel_large_file(params),
+                    'b2_list_unfinished_large_files': lambda: emulator.list_unfinished_large_files(params),
+                    'b2_list_file_names': lambda: emulator.list_file_names(params),
+                    'b2_get_file_info': lambda: emulator.get_file_info(params),
+                }
+                return self.send_json(200, handlers[endpoint]())
+
+            if path.startswith(('/_upload/', '/_upload_part/')) and method == 'POST':
+                kind, target = path.strip('/').split('/', 1)
+                emulator.requests[kind.lstrip('_')] += 1
+                emulator.check_token(self.headers.get('Authorization'))
+                body_read = True
+                if kind == '_upload':
+                    result = emulator.upload_file(self, target)
+                else:
+                    result = emulator.upload_part(self, target)
+                if result is None:
+                    # Queda de conexão no meio do corpo (--drop-rate)
+                    self.close_connection = True
+                    try:
+                        self.connection.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                    return
+                return self.send_json(200, result)
+
+            if path.startswith('/file/') and method in ('GET', 'HEAD'):
+                emulator.requests['download'] += 1
+                body_read = True
+                return self.serve_file(path, head_only=method == 'HEAD')
+
+            raise EmulatorError(404, 'not_found', path)
+        except EmulatorError as e:
+            if not body_read:
+                self.discard_body()
+            self.send_json(e.status, {'status': e.status, 'code': e.code, 'message': e.message},
+                           head_only=method == 'HEAD')
+        except (KeyError, TypeError, ValueError) as e:
+            if not body_read:
+                self.discard_body()
+            self.send_json(400, {'status': 400, 'code': 'bad_request', 'message': f'Parâmetro inválido: {e}'},
+                           head_only=method == 'HEAD')
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def serve_file(self, path, head_only):
+        emulator = self.emulator
+        bucket_name, _, name = path[len('/file/'):].partition('/')
+        name = unquote(name)
+        with emulator.lock:
+            bucket_id = emulator.buckets.get(bucket_name)
+            record = emulator.names.get((bucket_id, name))
+        if not record:
+            raise EmulatorError(404, 'not_found', f'Arquivo inexistente: {name}')
+
+        content_path = emulator.store_path(bucket_name, name) if emulator.args.store else None
+        if not head_only and not (content_path and os.path.exists(content_path)):
+            raise EmulatorError(404, 'not_found', 'Conteúdo não guardado (rode com --store)')
+
+        self.send_response(200)
+        self.send_header('Content-Type', record['content_type'])
+        self.send_header('Content-Length', str(record['size']))
+        self.send_header('x-bz-file-id', record['file_id'])
+        self.send_header('x-bz-file-name', quote(record['name']))
+        self.send_header('x-bz-content-sha1', record['sha1'])
+        self.send_header('x-bz-upload-timestamp', str(record['timestamp']))
+        for key, value in record['info'].items():
+            self.send_header(f'x-bz-info-{key}', quote(str(value)))
+        self.end_headers()
+        if not head_only:
+            with open(content_path, 'rb') as f:
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+
+def main():
+    parser = argparse.ArgumentParser(description='Emulador local do Backblaze B2 e do webhook do PenAreia')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8600)
+    parser.add_argument('--key-id', help='Exige este KEY_ID (padrão: aceita qualquer credencial)')
+    parser.add_argument('--key', help='APPLICATION_KEY exigida junto com --key-id')
+    parser.add_argument('--store', help='Guarda o conteúdo dos uploads neste diretório (padrão: só metadados)')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Latência fixa em toda requisição do B2')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='Latência extra aleatória (0..jitter)')
+    parser.add_argument('--bandwidth-kbps', type=int, default=0,
+                        help='Banda de upload compartilhada em kbit/s (0 = sem limite)')
+    parser.add_argument('--fail-rate', type=float, default=0, help='Fração de uploads/partes respondidos com 503')
+    parser.add_argument('--drop-rate', type=float, default=0,
+                        help='Fração de uploads/partes com a conexão derrubada no meio do corpo')
+    parser.add_argument('--api-fail-rate', type=float, default=0,
+                        help='Fração de chamadas da API (exceto autorização) respondidas com 503')
+    parser.add_argument('--token-ttl', type=float, default=0,
+                        help='Validade dos tokens em segundos (força reautorização; 0 = não expira)')
+    parser.add_argument('--webhook-path', default='/webhook')
+    parser.add_argument('--webhook-latency-ms', type=float, default=0)
+    parser.add_argument('--webhook-fail-rate', type=float, default=0, help='Fração de webhooks respondidos com 500')
+    parser.add_argument('--quiet', action='store_true', help='Não imprime cada upload e webhook')
+    parser.add_argument('--verbose', action='store_true', help='Imprime cada requisição HTTP')
+    args = parser.parse_args()
+
+    if args.store:
+        args.store = os.path.abspath(args.store)
+        os.makedirs(args.store, exist_ok=True)
+
+    server = ThreadingHTTPServer((args.host, args.port), EmulatorHandler)
+    server.daemon_threads = True
+    server.emulator = Emulator(args)
+    base = f'http://{args.host}:{args.port}'
+    print(f"🧪 Emulador B2/webhook em {base}")
+    print(f"   • REALM = {base}")
+    print(f"   • Webhook: {base}{args.webhook_path}")
+    print(f"   • Latência {args.latency_ms}ms (+{args.jitter_ms}), banda {args.bandwidth_kbps or '∞'} kbit/s, "
+          f"falhas {args.fail_rate:.0%} 503 / {args.drop_rate:.0%} quedas / {args.api_fail_rate:.0%} API")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n🛑 Emulador encerrado.")
+        print(json.dumps(server.emulator.get_stats(), indent=2, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,625 @@
+#!/usr/bin/env python3
+"""
+Benchmark offline do PenAreia
+Repete os MP4s de videos/ como uma câmera sintética, dispara triggers pelo cliente de
+teste do Flask e envia os clipes para um B2 local em memória. Mede latência por etapa
+(percentis), pico de RSS, CPU por clipe e bytes escritos; salva o resultado em JSON para
+comparar versões e hardware (PC x Raspberry Pi).
+
+Com --b2-url o upload e o webhook passam pelo b2sdk e pelo requests reais contra o
+b2_emulator.py; com --duration/--rate vira um teste de soak que dispara triggers em ritmo
+constante por horas e amostra RSS, threads e filas para achar vazamentos e o teto de vazão.
+
+Exemplos:
+    python benchmark.py                                  # 3 triggers espaçados, 640x360 @ 24 FPS
+    python benchmark.py --pattern overlap --set TRIGGER_COALESCE=trim
+    python benchmark.py --width 1280 --height 720 --compare benchmarks/anterior.json
+    python benchmark.py --b2-url http://127.0.0.1:8600 --duration 14400 --rate 2   # soak de 4h
+"""
+
+import argparse
+import ast
+import glob
+import hashlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.request
+from contextlib import redirect_stdout
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Padrões de trigger: instantes (s) após o aquecimento
+TRIGGER_PATTERNS = {
+    'single': [0],
+    'spaced': [0, 35, 70],              # Clipes independentes
+    'overlap': [0, 8, 45, 50],          # Pares com janelas sobrepostas (agrupamento)
+    'burst': [0, 1, 2, 3, 4],           # Botão apertado várias vezes seguidas
+}
+
+# === CÂMERA SINTÉTICA ===
+class SyntheticCamera:
+    """Substitui o cv2.VideoCapture: repete os clipes em tempo real na resolução e FPS pedidos"""
+
+    def __init__(self, cv2, video_capture, clips, width, height, fps):
+        self.cv2 = cv2
+        self.video_capture = video_capture
+        self.clips = clips
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.clip_index = 0
+        self.cap = None
+        self.next_frame_at = None
+
+    def isOpened(self):
+        return True
+
+    def get(self, prop):
+        return {
+            self.cv2.CAP_PROP_FPS: self.fps,
+            self.cv2.CAP_PROP_FRAME_WIDTH: self.width,
+            self.cv2.CAP_PROP_FRAME_HEIGHT: self.height,
+        }.get(prop, 0)
+
+    def set(self, prop, value):
+        return False
+
+    def read(self):
+        # Ritmo da câmera: um frame a cada 1/fps; atraso grande recomeça o relógio (sem rajada)
+        now = time.monotonic()
+        if self.next_frame_at is None or now - self.next_frame_at > 1:
+            self.next_frame_at = now
+        elif self.next_frame_at > now:
+            time.sleep(self.next_frame_at - now)
+        self.next_frame_at += 1.0 / self.fps
+
+        for _ in range(len(self.clips) + 1):
+            if self.cap is None:
+                self.cap = self.video_capture(self.clips[self.clip_index])
+                self.clip_index = (self.clip_index + 1) % len(self.clips)
+            ok, frame = self.cap.read()
+            if ok:
+                if frame.shape[1] != self.width or frame.shape[0] != self.height:
+                    frame = self.cv2.resize(frame, (self.width, self.height))
+                return True, frame
+            self.cap.release()
+            self.cap = None
+        return False, None
+
+    def release(self):
+        pass
+
+# === B2 E WEBHOOK LOCAIS ===
+class LocalB2Session:
+    """API de large files do b2sdk guardando só tamanho e SHA1 das partes"""
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.files = {}
+
+    def start_large_file(self, bucket_id, file_name, content_type, file_info):
+        file_id = f'large_{len(self.files)}'
+        self.files[file_id] = {'name': file_name, 'parts': {}}
+        return {'fileId': file_id}
+
+    def upload_part(self, file_id, part_number, content_length, sha1, stream):
+        data = stream.read()
+        self.bucket.simulate_transfer(len(data))
+        self.files[file_id]['parts'][part_number] = (hashlib.sha1(data).hexdigest(), len(data))
+        return {}
+
+    def finish_large_file(self, file_id, part_sha1s):
+        info = self.files[file_id]
+        self.bucket.uploaded[info['name']] = sum(size for _, size in info['parts'].values())
+        return {}
+
+    def cancel_large_file(self, file_id):
+        self.files.pop(file_id, None)
+
+    def list_parts(self, file_id, start_part_number, max_part_count):
+        parts = self.files.get(file_id, {}).get('parts', {})
+        return {
+            'parts': [{'partNumber': n, 'contentSha1': sha1, 'contentLength': size}
+                      for n, (sha1, size) in sorted(parts.items())],
+            'nextPartNumber': None
+        }
+
+class LocalB2Bucket:
+    """Bucket B2 em memória com uplink simulado (kbit/s, 0 = sem limite)"""
+
+    def __init__(self, uplink_kbps, file_not_present):
+        self.id_ = 'benchmark'
+        self.uplink_kbps = uplink_kbps
+        self.file_not_present = file_not_present
+        self.uploaded = {}
+        self.api = types.SimpleNamespace(session=LocalB2Session(self))
+
+    def simulate_transfer(self, byte_count):
+        if self.uplink_kbps:
+            time.sleep(byte_count * 8 / (self.uplink_kbps * 1000))
+
+    def upload_local_file(self, local_file, file_name, **kwargs):
+        size = os.path.getsize(local_file)
+        self.simulate_transfer(size)
+        self.uploaded[file_name] = size
+        # Como o b2sdk: o progresso chega pelo listener (limitador de banda e amostra do uplink)
+        if kwargs.get('progress_listener'):
+            kwargs['progress_listener'].bytes_completed(size)
+
+    def get_file_info_by_name(self, file_name):
+        raise self.file_not_present(file_name)
+
+    def ls(self, *args, **kwargs):
+        return iter(())
+
+# === COLETA ===
+def percentiles(values):
+    """p50/p90/p95/p99/max (nearest-rank) em milissegundos"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+    return {
+        'count': len(ordered),
+        'p50_ms': round(pick(0.50) * 1000, 2),
+        'p90_ms': round(pick(0.90) * 1000, 2),
+        'p95_ms': round(pick(0.95) * 1000, 2),
+        'p99_ms': round(pick(0.99) * 1000, 2),
+        'max_ms': round(ordered[-1] * 1000, 2)
+    }
+
+def read_proc_io():
+    """Bytes escritos pelo processo (Linux); None em outras plataformas"""
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return {'wchar': int(fields['wchar']), 'write_bytes': int(fields['write_bytes'])}
+    except (OSError, KeyError, ValueError):
+        return None
+
+def disk_write_bytes():
+    """Bytes escritos em disco no sistema todo (inclui o FFmpeg), se o psutil existir"""
+    try:
+        import psutil
+        return psutil.disk_io_counters().write_bytes
+    except Exception:
+        return None
+
+def current_rss_mb():
+    """RSS atual do processo (Linux); None em outras plataformas"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return round(pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024), 1)
+    except (OSError, ValueError, IndexError):
+        return None
+
+def open_fds():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+def growth_per_hour(timeline, key):
+    """Inclinação (por hora) da segunda metade da série: descarta o aquecimento de caches"""
+    points = [(sample['t'], sample[key]) for sample in timeline[len(timeline) // 2:] if sample.get(key) is not None]
+    if len(points) < 3 or points[-1][0] == points[0][0]:
+        return None
+    mean_t = sum(t for t, _ in points) / len(points)
+    mean_v = sum(v for _, v in points) / len(points)
+    slope = (sum((t - mean_t) * (v - mean_v) for t, v in points)
+             / sum((t - mean_t) ** 2 for t, _ in points))
+    return round(slope * 3600, 2)
+
+def emulator_stats(url, files=False):
+    with urllib.request.urlopen(f"{url}/_emulator/stats{'?files=1' if files else ''}", timeout=10) as response:
+        return json.load(response)
+
+def peak_rss_mb():
+    """Pico de RSS do processo (o dos filhos não serve: o fork herda o RSS do Python antes do exec)"""
+    if not resource:
+        return None
+    # ru_maxrss vem em KB no Linux e em bytes no macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1)
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=BASE_DIR,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+def parse_override(text):
+    name, _, value = text.partition('=')
+    try:
+        return name.strip(), ast.literal_eval(value.strip())
+    except (ValueError, SyntaxError):
+        return name.strip(), value.strip()
+
+# === EXECUÇÃO ===
+def run_benchmark(args):
+    os.chdir(BASE_DIR)
+    clips = sorted(glob.glob(os.path.join(BASE_DIR, 'videos', '*.mp4')))
+    if not clips:
+        print("❌ Nenhum MP4 em videos/ para usar como câmera sintética")
+        sys.exit(1)
+
+    quiet = io.StringIO() if not args.verbose else None
+    with redirect_stdout(quiet or sys.stdout):
+        import app
+    import logging
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        app.logger.setLevel(logging.WARNING)
+
+    # Diretório de trabalho isolado: banco, videos/ e cache de segmentos
+    work_dir = tempfile.mkdtemp(prefix='penareia_bench_')
+    os.chdir(work_dir)
+    app.DB_PATH = os.path.join(work_dir, 'queue.db')
+    app.SEGMENT_CACHE_DIR = os.path.join(work_dir, 'segment_cache')
+
+    # Câmera sintética no lugar do cv2.VideoCapture
+    real_video_capture = app.cv2.VideoCapture
+    app.cv2.VideoCapture = lambda source: SyntheticCamera(
+        app.cv2, real_video_capture, clips, args.width, args.height, args.fps)
+    app.VIDEO_SOURCE = 'sintetica'
+    app.FORCE_FPS = args.fps
+    app.MAX_WIDTH, app.MAX_HEIGHT = args.width, args.height
+
+    webhooks = []
+    webhooks_lock = threading.Lock()
+    def record_webhook(arquivo, extra):
+        with webhooks_lock:
+            webhooks.append({'arquivo': arquivo, 'versao': (extra or {}).get('versao'),
+                             'received': time.monotonic()})
+
+    if args.b2_url:
+        # b2sdk e requests reais contra o emulador; credenciais do config.ini não saem da máquina
+        try:
+            emulator_stats(args.b2_url)
+        except OSError as e:
+            print(f"❌ Emulador não responde em {args.b2_url}: {e}")
+            sys.exit(1)
+        bucket = None
+        app.B2_REALM = args.b2_url
+        app.B2_KEY_ID = app.B2_APPLICATION_KEY = 'benchmark'
+        app.B2_DOWNLOAD_URL = app.b2_download_url = args.b2_url
+        app.WEBHOOK_URL = f'{args.b2_url}/webhook'
+        target = app.urlparse(args.b2_url)
+        for breaker in (app.b2_auth_breaker, app.b2_upload_breaker, app.webhook_breaker):
+            breaker.probe = app.tcp_probe(target.hostname, target.port or 80)
+        real_send_to_webhook = app.send_to_webhook
+        def send_and_record(arquivo, url, data_hora, extra=None):
+            ok, response = real_send_to_webhook(arquivo, url, data_hora, extra)
+            if ok:
+                record_webhook(arquivo, extra)
+            return ok, response
+        app.send_to_webhook = send_and_record
+    else:
+        bucket = LocalB2Bucket(args.uplink_kbps, app.FileNotPresent)
+        app.init_b2 = lambda: bucket
+        def send_local(arquivo, url, data_hora, extra=None):
+            record_webhook(arquivo, extra)
+            return True, 'ok'
+        app.send_to_webhook = send_local
+
+    for override in args.set:
+        name, value = parse_override(override)
+        if not hasattr(app, name):
+            print(f"❌ --set {name}: variável inexistente em app.py")
+            sys.exit(1)
+        setattr(app, name, value)
+
+    # Amostras brutas de todas as métricas (o /metrics só guarda buckets)
+    samples = {}
+    samples_lock = threading.Lock()
+    registry_observe = app.metrics.observe
+    def observe(name, value, **labels):
+        key = name + ''.join(f'.{v}' for _, v in sorted(labels.items()))
+        with samples_lock:
+            samples.setdefault(key, []).append(value)
+        registry_observe(name, value, **labels)
+    app.metrics.observe = observe
+
+    app.init_database()
+    app.staging.clear()
+    ffmpeg_available, detected_ffmpeg = app.check_ffmpeg()
+    if not ffmpeg_available:
+        print("❌ FFmpeg não encontrado")
+        sys.exit(1)
+    app.FFMPEG_CMD = detected_ffmpeg
+
+    pattern = f"soak {args.rate}/min por {args.duration:.0f}s" if args.duration else f"'{args.pattern}' x{args.repeat}"
+    print(f"🏁 Benchmark: {len(clips)} clipe(s) de origem, {args.width}x{args.height} @ {args.fps} FPS, "
+          f"padrão {pattern}, SAVE_SECONDS={app.SAVE_SECONDS}"
+          + (f", B2 {args.b2_url}" if args.b2_url else ""))
+
+    threads = [threading.Thread(target=app.capture_frames, daemon=True),
+               threading.Thread(target=app.process_upload_queue, daemon=True),
+               threading.Thread(target=app.webhook_worker, daemon=True)]
+    threads += [threading.Thread(target=app.encode_job_worker, daemon=True) for _ in range(app.ENCODE_WORKERS)]
+    if app.SEGMENT_CACHE_ENABLED:
+        threads.append(threading.Thread(target=app.segment_cache_worker, daemon=True))
+    with redirect_stdout(quiet or sys.stdout):
+        for thread in threads:
+            thread.start()
+
+        # Aquecimento: buffer com pelo menos um clipe completo
+        needed = int(app.SAVE_SECONDS * args.fps)
+        deadline = time.monotonic() + needed / args.fps + 30
+        while (not app.frame_buffer or len(app.frame_buffer) < needed) and time.monotonic() < deadline:
+            time.sleep(0.2)
+        time.sleep(args.warmup)
+
+    print(f"🔥 Aquecimento concluído ({len(app.frame_buffer or [])} frames no buffer)")
+
+    times_before = os.times()
+    io_before = read_proc_io()
+    disk_before = disk_write_bytes()
+    started = time.monotonic()
+
+    # Amostragem periódica para o soak: RSS crescendo com a fila estável indica vazamento
+    timeline = []
+    finished = threading.Event()
+    def sample():
+        while True:
+            timeline.append({
+                't': round(time.monotonic() - started, 1),
+                'rss_mb': current_rss_mb(),
+                'threads': threading.active_count(),
+                'fds': open_fds(),
+                'upload_backlog': app.get_upload_backlog(),
+                'encode_queue': len(app.encode_jobs),
+                'encode_running': app.encode_jobs_running,
+                'uploads': len(samples.get('stage_seconds.upload', [])),
+                'webhooks': len(webhooks)
+            })
+            if finished.wait(args.sample_interval):
+                return
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+
+    # Dispara os triggers do padrão, cada um na sua thread (no modo off o /trigger espera a codificação)
+    if args.duration:
+        interval = 60.0 / args.rate
+        schedule = [index * interval for index in range(max(int(args.duration / interval), 1))]
+    else:
+        offsets = TRIGGER_PATTERNS[args.pattern]
+        cycle = max(offsets) + args.cycle_gap
+        schedule = [repeat * cycle + offset for repeat in range(args.repeat) for offset in offsets]
+    triggers = []
+    def fire(index):
+        fired = time.monotonic()
+        response = app.app.test_client().post('/trigger', headers={'Idempotency-Key': f'bench-{index}'})
+        body = response.get_json(silent=True) or {}
+        triggers[index].update({'status': response.status_code, 'arquivo': body.get('arquivo'),
+                                'response_s': time.monotonic() - fired,
+                                'duplicate': bool(body.get('duplicado')),
+                                'encode_level': body.get('nivel_codificacao')})
+
+    trigger_threads = []
+    with redirect_stdout(quiet or sys.stdout):
+        for index, at in enumerate(schedule):
+            delay = started + at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            triggers.append({'at': at, 'fired': time.monotonic()})
+            thread = threading.Thread(target=fire, args=(index,), daemon=True)
+            thread.start()
+            trigger_threads.append(thread)
+
+        # Fim: triggers respondidos, filas de codificação e upload vazias
+        deadline = time.monotonic() + args.timeout
+        while time.monotonic() < deadline:
+            idle = (all(not t.is_alive() for t in trigger_threads) and not app.encode_jobs
+                    and not app.encode_jobs_running and app.get_upload_backlog() == 0)
+            if idle:
+                break
+            time.sleep(0.5)
+        else:
+            print(f"⚠️ Timeout de {args.timeout}s: resultados parciais")
+        time.sleep(1)  # Webhooks assíncronos
+
+    elapsed = time.monotonic() - started
+    finished.set()
+    sampler.join()
+    times_after = os.times()
+    io_after = read_proc_io()
+    disk_after = disk_write_bytes()
+
+    # Latência ponta a ponta: trigger -> primeiro webhook e webhook final do clipe
+    # (triggers absorvidos pelo debounce reaproveitam o clipe de outro e ficam de fora)
+    for trigger in triggers:
+        if trigger.get('duplicate'):
+            continue
+        name = trigger.get('arquivo')
+        hooks = [hook for hook in webhooks if name and hook['arquivo'] == name]
+        if hooks:
+            trigger['first_webhook_s'] = min(hook['received'] for hook in hooks) - trigger['fired']
+            finals = [hook['received'] for hook in hooks if hook['versao'] != 'proxy']
+            if finals:
+                trigger['final_webhook_s'] = min(finals) - trigger['fired']
+
+    uploaded = bucket.uploaded if bucket else emulator_stats(args.b2_url, files=True)['file_sizes']
+    clips_uploaded = [name for name in uploaded if name.endswith('.mp4')]
+    self_cpu = (times_after.user - times_before.user) + (times_after.system - times_before.system)
+    children_cpu = ((times_after.children_user - times_before.children_user)
+                    + (times_after.children_system - times_before.children_system))
+
+    result = {
+        'timestamp': datetime.now().isoformat(),
+        'version': git_version(),
+        'host': {
+            'hostname': platform.node(),
+            'system': platform.system(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version()
+        },
+        'params': {
+            'width': args.width, 'height': args.height, 'fps': args.fps,
+            'pattern': 'soak' if args.duration else args.pattern, 'repeat': args.repeat,
+            'uplink_kbps': args.uplink_kbps, 'b2_url': args.b2_url,
+            'duration': args.duration, 'rate_per_min': args.rate if args.duration else None,
+            'save_seconds': app.SAVE_SECONDS, 'coalesce': app.TRIGGER_COALESCE,
+            'overrides': args.set
+        },
+        'elapsed_seconds': round(elapsed, 2),
+        'triggers': len(triggers),
+        'triggers_ok': sum(1 for t in triggers if t.get('status') == 200),
+        'triggers_debounced': sum(1 for t in triggers if t.get('duplicate')),
+        'clips_uploaded': len(clips_uploaded),
+        'stages': {key: percentiles(values) for key, values in sorted(samples.items())},
+        'end_to_end': {
+            'trigger_response': percentiles([t['response_s'] for t in triggers if 'response_s' in t]),
+            'first_webhook': percentiles([t['first_webhook_s'] for t in triggers if 'first_webhook_s' in t]),
+            'final_webhook': percentiles([t['final_webhook_s'] for t in triggers if 'final_webhook_s' in t])
+        },
+        'cpu': {
+            'process_seconds': round(self_cpu, 2),
+            'ffmpeg_seconds': round(children_cpu, 2),
+            'seconds_per_clip': round((self_cpu + children_cpu) / max(len(clips_uploaded), 1), 2),
+            'note': 'inclui a decodificação da câmera sintética, como a do RTSP em produção'
+        },
+        'memory': {'peak_rss_mb': peak_rss_mb()},
+        'bytes': {
+            'uploaded': sum(uploaded.values()),
+            'process_wchar': io_after['wchar'] - io_before['wchar'] if io_before and io_after else None,
+            'process_disk_writes': (io_after['write_bytes'] - io_before['write_bytes']
+                                    if io_before and io_after else None),
+            'system_disk_writes': disk_after - disk_before if disk_before is not None and disk_after is not None else None,
+            'by_tier': dict(app.staging.bytes_written)
+        },
+        'capture': app.capture_health.window(max(int(elapsed), 60)),
+        'soak': {
+            'rss_mb_start': timeline[0]['rss_mb'],
+            'rss_mb_end': timeline[-1]['rss_mb'],
+            'rss_mb_per_hour': growth_per_hour(timeline, 'rss_mb'),
+            'threads_per_hour': growth_per_hour(timeline, 'threads'),
+            'fds_per_hour': growth_per_hour(timeline, 'fds'),
+            'upload_backlog_max': max(sample['upload_backlog'] for sample in timeline),
+            'upload_backlog_per_hour': growth_per_hour(timeline, 'upload_backlog'),
+            'emulator': emulator_stats(args.b2_url)['counters'] if args.b2_url else None
+        },
+        'timeline': timeline,
+        'trigger_details': [{k: (round(v, 3) if isinstance(v, float) else v) for k, v in t.items() if k != 'fired'}
+                            for t in triggers]
+    }
+
+    os.chdir(BASE_DIR)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return result
+
+# === RELATÓRIO ===
+def print_report(result, previous=None):
+    print("\n" + "=" * 72)
+    print(f"📊 BENCHMARK PENAREIA - {result['host']['hostname']} ({result['host']['machine']}) "
+          f"versão {result['version']}")
+    print("=" * 72)
+    print(f"Triggers: {result['triggers_ok']}/{result['triggers']} ok "
+          f"({result['triggers_debounced']} absorvido(s) pelo debounce) | clipes enviados: "
+          f"{result['clips_uploaded']} | duração: {result['elapsed_seconds']}s")
+
+    def row(label, stats, old=None):
+        if not stats:
+            return
+        line = f"  {label:<34} p50 {stats['p50_ms']:>9.1f}  p95 {stats['p95_ms']:>9.1f}  max {stats['max_ms']:>9.1f} ms"
+        if old:
+            delta = (stats['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100 if old['p95_ms'] else 0
+            line += f"  (p95 {delta:+.0f}%)"
+        print(line)
+
+    old_stages = (previous or {}).get('stages', {})
+    old_e2e = (previous or {}).get('end_to_end', {})
+    print("\n⏱️ Etapas:")
+    for key, stats in result['stages'].items():
+        row(key, stats, old_stages.get(key))
+    print("\n🎯 Ponta a ponta:")
+    for key, stats in result['end_to_end'].items():
+        row(key, stats, old_e2e.get(key))
+
+    cpu, memory, written = result['cpu'], result['memory'], result['bytes']
+    print(f"\n🧠 CPU: {cpu['seconds_per_clip']}s por clipe (processo {cpu['process_seconds']}s, "
+          f"FFmpeg {cpu['ffmpeg_seconds']}s)")
+    print(f"💾 Pico de RSS: {memory['peak_rss_mb']} MB")
+    print(f"📝 Bytes: enviados {written['uploaded']}, escritos pelo processo {written['process_disk_writes']}, "
+          f"disco do sistema {written['system_disk_writes']}")
+    if written.get('by_tier'):
+        print(f"💨 Por camada: tmpfs {written['by_tier']['tmpfs']}, disco {written['by_tier']['disk']}")
+    capture = result['capture']
+    print(f"🎥 Captura: {capture['fps']} FPS, {capture['failed']} falha(s), diagnóstico {capture['diagnosis']}")
+    soak = result.get('soak')
+    if soak and result['params'].get('duration'):
+        print(f"🧪 Soak: RSS {soak['rss_mb_start']} -> {soak['rss_mb_end']} MB "
+              f"({soak['rss_mb_per_hour']} MB/h na segunda metade), threads {soak['threads_per_hour']}/h, "
+              f"fds {soak['fds_per_hour']}/h")
+        print(f"📤 Fila de upload: máximo {soak['upload_backlog_max']}, tendência "
+              f"{soak['upload_backlog_per_hour']}/h (crescendo = acima do teto de vazão)")
+        if soak['emulator']:
+            print(f"🧰 Emulador: {soak['emulator']}")
+    if previous:
+        print(f"\n🔁 Comparado com {previous.get('version')} ({previous.get('timestamp')})")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark offline do PenAreia com câmera sintética')
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=360)
+    parser.add_argument('--fps', type=int, default=24)
+    parser.add_argument('--pattern', choices=sorted(TRIGGER_PATTERNS), default='spaced')
+    parser.add_argument('--repeat', type=int, default=1, help='Repetições do padrão de triggers')
+    parser.add_argument('--cycle-gap', type=float, default=35, help='Segundos entre repetições do padrão')
+    parser.add_argument('--warmup', type=float, default=2, help='Segundos extras após encher o buffer')
+    parser.add_argument('--uplink-kbps', type=int, default=0, help='Uplink simulado do B2 local (0 = ilimitado)')
+    parser.add_argument('--b2-url', help='URL do b2_emulator.py: usa b2sdk e webhook reais em vez do B2 em memória')
+    parser.add_argument('--duration', type=float, default=0,
+                        help='Soak: segundos disparando triggers em ritmo constante (substitui --pattern)')
+    parser.add_argument('--rate', type=float, default=1, help='Soak: triggers por minuto')
+    parser.add_argument('--sample-interval', type=float, default=30,
+                        help='Segundos entre amostras de RSS, threads e filas')
+    parser.add_argument('--timeout', type=float, default=600, help='Tempo máximo esperando as filas esvaziarem')
+    parser.add_argument('--set', action='append', default=[], metavar='NOME=VALOR',
+                        help='Sobrescreve uma variável de app.py, ex.: TRIGGER_COALESCE=trim')
+    parser.add_argument('--output', help='Arquivo JSON (padrão: benchmarks/<host>_<data>.json)')
+    parser.add_argument('--compare', help='JSON de uma execução anterior para comparar')
+    parser.add_argument('--verbose', action='store_true', help='Mostra os logs do app')
+    args = parser.parse_args()
+
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)
+
+    result = run_benchmark(args)
+    print_report(result, previous)
+
+    output = args.output or os.path.join(
+        BASE_DIR, 'benchmarks', f"{platform.node()}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    print(f"\n💾 Resultado salvo em {output}")
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n🛑 Benchmark interrompido.")
+    # As threads do app são daemon e ficam em loops infinitos
+    sys.stdout.flush()
+    os._exit(0)
@@ -7,6 +7,7 @@
  * - Reset de configurações (botão pressionado por 10s)
  * - Estados do LED: rápido=sem WiFi, 3x lento=conectado, fixo=pronto, apagado=cooldown
  * - Cooldown de 20 segundos entre triggers
+ * - Trigger UDP assinado (opcional) com o instante exato do aperto
  *
  * Hardware:
  * - ESP32-C6
@@ -24,6 +25,8 @@
 #include <HTTPClient.h>
 #include <ArduinoJson.h>
 #include <Preferences.h>
+#include <WiFiUdp.h>
+#include "mbedtls/md.h"
 
 // =============================================================================
 // CONFIGURAÇÕES HARDWARE
@@ -42,6 +45,13 @@ const unsigned long TRIGGER_COOLDOWN = 20000;      // 20 segundos cooldown
 const unsigned long WIFI_TIMEOUT = 30000;          // 30 segundos timeout WiFi
 const unsigned long SERVER_CHECK_INTERVAL = 30000; // 30s entre verificações
 
+// Trigger UDP: mesmos UDP_PORT e UDP_SECRET da seção [TRIGGER] do config.ini (0 = só HTTP)
+const int UDP_TRIGGER_PORT = 0;
+const char *UDP_SECRET = "";
+const unsigned long UDP_PING_INTERVAL = 5000; // Pings mantêm a estimativa de relógio no servidor
+const unsigned long UDP_ACK_TIMEOUT = 150;    // ms esperando ACK antes de reenviar
+const int UDP_MAX_ATTEMPTS = 3;
+
 // =============================================================================
 // ESTADOS DO SISTEMA
 // =============================================================================
@@ -85,6 +95,12 @@ unsigned long lastTrigger = 0;
 unsigned long lastServerCheck = 0;
 unsigned long buttonPressStart = 0;
 unsigned long lastLedUpdate = 0;
+unsigned long pressCounter = 0;
+
+WiFiUDP udp;
+String udpDeviceId = "";
+unsigned long udpCounter = 0;
+unsigned long lastUdpPing = 0;
 
 bool buttonState = HIGH;
 bool lastButtonState = HIGH;
@@ -111,6 +127,11 @@ void setup()
     // Inicializa preferências
     preferences.begin("penareia", false);
 
+    // Id do dispositivo para o UDP: MAC + nonce de boot (millis() e contador recomeçam a cada boot)
+    udpDeviceId = String((uint32_t)ESP.getEfuseMac(), HEX) + "-" + String(esp_random() & 0xFFFF, HEX);
+    if (UDP_TRIGGER_PORT != 0)
+        udp.begin(UDP_TRIGGER_PORT); // Porta local para receber os ACKs
+
     // Carrega configurações salvas
     loadSettings();
 
@@ -157,10 +178,12 @@ void loop()
 
     case STATE_READY:
         checkServerPeriodically();
+        sendUdpPingPeriodically();
         break;
 
     case STATE_COOLDOWN:
         checkCooldown();
+        sendUdpPingPeriodically();
         break;
 
     case STATE_ERROR:
@@ -269,9 +292,9 @@ void handleTrigger()
         return;
     }
 
-    // Envia trigger
+    // Envia trigger com o instante em que o botão foi apertado (não o de soltar)
     lastTrigger = currentTime;
-    sendTrigger();
+    sendTrigger(buttonPressStart);
 }
 
 // =============================================================================
@@ -538,10 +561,85 @@ void handleError()
     }
 }
 
+// =============================================================================
+// TRIGGER UDP
+// =============================================================================
+String udpSign(const String &text)
+{
+    // HMAC-SHA256 truncado em 16 bytes (32 hex), igual ao sign_udp_message() do servidor
+    unsigned char digest[32];
+    mbedtls_md_context_t ctx;
+    mbedtls_md_init(&ctx);
+    mbedtls_md_setup(&ctx, mbedtls_md_info_from_type(MBEDTLS_MD_SHA256), 1);
+    mbedtls_md_hmac_starts(&ctx, (const unsigned char *)UDP_SECRET, strlen(UDP_SECRET));
+    mbedtls_md_hmac_update(&ctx, (const unsigned char *)text.c_str(), text.length());
+    mbedtls_md_hmac_finish(&ctx, digest);
+    mbedtls_md_free(&ctx);
+
+    char hex[33];
+    for (int i = 0; i < 16; i++)
+        sprintf(hex + i * 2, "%02x", digest[i]);
+    hex[32] = 0;
+    return String(hex);
+}
+
+void udpSend(char kind, unsigned long counter, unsigned long pressMs)
+{
+    String body = String("PNR1 ") + kind + " " + udpDeviceId + " " + String(counter) + " " +
+                  String(millis()) + " " + String(pressMs);
+    String message = body + " " + udpSign(body);
+
+    udp.beginPacket(serverIP.c_str(), UDP_TRIGGER_PORT);
+    udp.print(message);
+    udp.endPacket();
+}
+
+void sendUdpPingPeriodically()
+{
+    if (UDP_TRIGGER_PORT == 0 || !serverFound || millis() - lastUdpPing < UDP_PING_INTERVAL)
+        return;
+
+    lastUdpPing = millis();
+    udpSend('P', ++udpCounter, millis());
+}
+
+bool sendUdpTrigger(unsigned long pressMs)
+{
+    if (UDP_TRIGGER_PORT == 0)
+        return false;
+
+    // Reenvios usam o mesmo contador: o servidor trata como o mesmo aperto
+    unsigned long counter = ++udpCounter;
+    String expectedAck = "PNR1 A " + udpDeviceId + " " + String(counter) + " ";
+
+    for (int attempt = 0; attempt < UDP_MAX_ATTEMPTS; attempt++)
+    {
+        udpSend('T', counter, pressMs);
+
+        unsigned long sentAt = millis();
+        while (millis() - sentAt < UDP_ACK_TIMEOUT)
+        {
+            int size = udp.parsePacket();
+            if (size > 0)
+            {
+                char buffer[128];
+                int len = udp.read(buffer, sizeof(buffer) - 1);
+                buffer[max(len, 0)] = 0;
+                if (String(buffer).startsWith(expectedAck))
+                    return true;
+            }
+            delay(1);
+        }
+    }
+
+    Serial.println("⚠️ Sem ACK do trigger UDP, usando HTTP...");
+    return false;
+}
+
 // =============================================================================
 // ENVIO DE TRIGGER
 // =============================================================================
-void sendTrigger()
+void sendTrigger(unsigned long pressMs)
 {
     if (!serverFound)
     {
@@ -552,18 +650,53 @@ void sendTrigger()
     currentState = STATE_COOLDOWN;
     currentLedPattern = LED_OFF;
 
+    if (sendUdpTrigger(pressMs))
+    {
+        Serial.println("✅ Trigger UDP confirmado!");
+
+        // Pisca LED 3x para confirmar
+        for (int i = 0; i < 3; i++)
+        {
+            digitalWrite(LED_PIN, HIGH);
+            delay(200);
+            digitalWrite(LED_PIN, LOW);
+            delay(200);
+        }
+        return;
+    }
+
     HTTPClient http;
     String url = "http://" + serverIP + ":" + String(serverPort) + "/trigger";
 
     Serial.println("🎬 Enviando trigger...");
 
+    // Id único do aperto: reenviado igual na nova tentativa para o servidor não gravar o clipe duas vezes
+    String pressId = String((uint32_t)ESP.getEfuseMac(), HEX) + "-" + String(++pressCounter) + "-" + String(millis());
+    String body = "{\"press_id\":\"" + pressId + "\"}";
+
     http.begin(url);
     http.addHeader("Content-Type", "application/json");
+    http.addHeader("Idempotency-Key", pressId);
     http.setTimeout(30000);
 
-    int httpCode = http.POST("{}");
+    int httpCode = http.POST(body);
 
-    if (httpCode == HTTP_CODE_OK)
+    if (httpCode == -1)
+    {
+        Serial.println("🔁 Sem resposta, reenviando o mesmo trigger...");
+        http.end();
+        http.begin(url);
+        http.addHeader("Content-Type", "application/json");
+        http.addHeader("Idempotency-Key", pressId);
+        http.setTimeout(30000);
+        httpCode = http.POST(body);
+    }
+
+    if (httpCode == HTTP_CODE_ACCEPTED)
+    {
+        Serial.println("✅ Trigger já em processamento no servidor");
+    }
+    else if (httpCode == HTTP_CODE_OK)
     {
         String response = http.getString();
 
@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# O app lê config.ini relativo ao diretório atual na importação
+_cwd = os.getcwd()
+os.chdir(ROOT)
+import app as app_module
+os.chdir(_cwd)
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """app.py com banco e videos/ num diretório temporário"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(app_module, 'DB_PATH', str(tmp_path / 'queue.db'))
+    monkeypatch.setattr(app_module, 'detected_fps', 10)
+    os.makedirs(os.path.join('videos', 'temp'))
+    app_module.init_database()
+    while not app_module.recovered_jobs.empty():
+        app_module.recovered_jobs.get_nowait()
+    yield app_module
+    while not app_module.recovered_jobs.empty():
+        app_module.recovered_jobs.get_nowait()
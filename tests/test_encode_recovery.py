@@ -0,0 +1,154 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+JOB_NAME = 'Penareia_01-02-2026_10-00-00'
+T0 = datetime(2026, 2, 1, 10, 0, 0)
+
+
+def write_snapshot(app, start_seq, end_seq):
+    """Snapshot em videos/temp como o persist_trigger_snapshot grava"""
+    path = os.path.join('videos', 'temp', f'{JOB_NAME}_snap_{start_seq}.mp4')
+    frames = [np.full((32, 48, 3), seq % 255, dtype=np.uint8) for seq in range(start_seq, end_seq)]
+    success, error = app.write_temp_video(frames, path)
+    assert success, error
+    return {'path': path, 'start_seq': start_seq, 'end_seq': end_seq}
+
+
+def trigger(offset_seconds, start_seq, end_seq):
+    return {'timestamp': (T0 + timedelta(seconds=offset_seconds)).isoformat(),
+            'start_seq': start_seq, 'end_seq': end_seq}
+
+
+def insert_job(app, triggers, snapshots, attempts=0, trim=False):
+    conn = sqlite3.connect(app.DB_PATH)
+    cursor = conn.execute('''
+    INSERT INTO encode_jobs (name, stage, params, snapshots, attempts, created_at, updated_at)
+    VALUES (?, 'queued', ?, ?, ?, ?, ?)
+    ''', (JOB_NAME, json.dumps({'triggers': triggers, 'proxy_queued': False, 'trim': trim}),
+          json.dumps(snapshots), attempts, time.time(), time.time()))
+    conn.commit()
+    conn.close()
+    return cursor.lastrowid
+
+
+def queue_upload(app, filename):
+    conn = sqlite3.connect(app.DB_PATH)
+    conn.execute('''
+    INSERT INTO upload_queue (filename, local_path, remote_path, timestamp, file_hash, status)
+    VALUES (?, ?, ?, ?, 'hash', 'pending')
+    ''', (filename, os.path.join('videos', 'final', filename), filename, T0.isoformat()))
+    conn.commit()
+    conn.close()
+
+
+def job_rows(app):
+    conn = sqlite3.connect(app.DB_PATH)
+    rows = conn.execute('SELECT id, name, stage, params, snapshots, attempts FROM encode_jobs ORDER BY id').fetchall()
+    conn.close()
+    return rows
+
+
+def drain_recovered(app):
+    jobs = []
+    while not app.recovered_jobs.empty():
+        jobs.append(app.recovered_jobs.get_nowait())
+    return jobs
+
+
+def test_missing_snapshot_splits_job_into_runs(app, monkeypatch):
+    monkeypatch.setattr(app, 'TRIGGER_COALESCE', 'off')
+    snapshots = [write_snapshot(app, 0, 20), write_snapshot(app, 20, 40),
+                 write_snapshot(app, 40, 60), write_snapshot(app, 60, 80)]
+    # Crash no meio da gravação: o segundo snapshot nunca chegou ao disco
+    os.remove(snapshots[1]['path'])
+    db_id = insert_job(app, [trigger(0, 0, 15), trigger(2, 10, 50), trigger(5, 45, 75)], snapshots)
+
+    assert app.recover_encode_jobs() == 2
+
+    first, second = drain_recovered(app)
+    assert (first['db_id'], first['name']) == (db_id, JOB_NAME)
+    assert (first['start_seq'], first['end_seq']) == (0, 20)
+    assert [t['start_seq'] for t in first['triggers']] == [0]
+    assert second['name'] == f'{JOB_NAME}_2'
+    assert second['db_id'] not in (None, db_id)
+    assert (second['start_seq'], second['end_seq']) == (40, 80)
+    assert [t['start_seq'] for t in second['triggers']] == [45]
+    # O trigger que atravessa o buraco não tem como ser recuperado
+    assert len(job_rows(app)) == 2
+
+
+def test_trim_job_recovers_only_clips_not_yet_queued(app):
+    snapshots = [write_snapshot(app, 0, 40)]
+    triggers = [trigger(0, 0, 20), trigger(3, 15, 40)]
+    insert_job(app, triggers, snapshots, trim=True)
+    first_clip = T0.strftime('Penareia_%d-%m-%Y_%H-%M-%S')
+    queue_upload(app, f'{first_clip}.mp4')
+
+    assert app.recover_encode_jobs() == 1
+
+    (job,) = drain_recovered(app)
+    assert job['trim'] is True
+    assert [t['start_seq'] for t in job['triggers']] == [15]
+    assert json.loads(job_rows(app)[0][3])['triggers'] == [trigger(3, 15, 40)]
+    assert os.path.exists(snapshots[0]['path'])
+
+
+def test_job_with_every_clip_queued_is_removed(app):
+    snapshots = [write_snapshot(app, 0, 40)]
+    insert_job(app, [trigger(0, 0, 20), trigger(3, 15, 40)], snapshots, trim=True)
+    for offset in (0, 3):
+        queue_upload(app, (T0 + timedelta(seconds=offset)).strftime('Penareia_%d-%m-%Y_%H-%M-%S.mp4'))
+
+    assert app.recover_encode_jobs() == 0
+    assert drain_recovered(app) == []
+    assert job_rows(app) == []
+    assert not os.path.exists(snapshots[0]['path'])
+
+
+def test_job_at_attempt_limit_is_discarded(app):
+    snapshots = [write_snapshot(app, 0, 20)]
+    insert_job(app, [trigger(0, 0, 20)], snapshots, attempts=app.ENCODE_JOB_MAX_ATTEMPTS)
+
+    assert app.recover_encode_jobs() == 0
+    assert job_rows(app) == []
+    assert not os.path.exists(snapshots[0]['path'])
+
+
+def durable_job(app, snapshots, attempts, status):
+    return {'id': 1, 'name': JOB_NAME, 'db_id': insert_job(app, [trigger(0, 0, 20)], snapshots, attempts),
+            'triggers': [dict(trigger(0, 0, 20), timestamp=T0, durable=True)], 'snapshots': snapshots,
+            'durable': True, 'attempts': attempts, 'result': ({}, status), 'db_lock': threading.Lock()}
+
+
+def test_failed_job_returns_to_recovery_until_attempt_limit(app):
+    snapshots = [write_snapshot(app, 0, 20)]
+    job = durable_job(app, snapshots, 1, 500)
+
+    app.finish_encode_job(job)
+
+    assert drain_recovered(app) == [job]
+    (row,) = job_rows(app)
+    assert (row[2], row[5]) == ('failed', 1)
+    assert os.path.exists(snapshots[0]['path'])
+
+    job['attempts'] = app.ENCODE_JOB_MAX_ATTEMPTS
+    app.finish_encode_job(job)
+
+    assert drain_recovered(app) == []
+    assert job_rows(app) == []
+    assert not os.path.exists(snapshots[0]['path'])
+
+
+def test_successful_job_is_deleted(app):
+    snapshots = [write_snapshot(app, 0, 20)]
+    app.finish_encode_job(durable_job(app, snapshots, 1, 200))
+
+    assert drain_recovered(app) == []
+    assert job_rows(app) == []
+    assert not os.path.exists(snapshots[0]['path'])
@@ -0,0 +1,100 @@
+import errno
+import os
+import shutil
+import time
+from collections import namedtuple
+
+import numpy as np
+import pytest
+
+SHAPE = (24, 32, 3)
+SLOTS = 8
+
+
+def frame(seq):
+    return np.full(SHAPE, seq % 255, dtype=np.uint8)
+
+
+def filled_ring(app, path, count):
+    ring = app.FrameRing.create(str(path), SHAPE, SLOTS)
+    for seq in range(count):
+        ring.append(frame(seq), time.monotonic())
+    return ring
+
+
+def test_create_reserves_whole_file(app, tmp_path):
+    ring = app.FrameRing.create(str(tmp_path / 'ring'), SHAPE, SLOTS)
+
+    assert len(ring) == 0
+    assert os.path.getsize(ring.path) == ring.size
+    assert not os.path.exists(ring.path + '.tmp')
+    assert os.stat(ring.path).st_blocks * 512 >= ring.size
+
+
+def test_append_keeps_only_last_slots(app, tmp_path):
+    ring = filled_ring(app, tmp_path / 'ring', SLOTS + 3)
+
+    assert (ring.start, ring.count, len(ring)) == (3, SLOTS + 3, SLOTS)
+    assert ring.view(0)[0, 0, 0] == 3
+    assert ring.view(len(ring) - 1)[0, 0, 0] == SLOTS + 2
+
+
+def test_attach_reopens_frames_after_restart(app, tmp_path):
+    ring = filled_ring(app, tmp_path / 'ring', 5)
+    ring.mm.close()
+
+    attached = app.FrameRing.attach(str(tmp_path / 'ring'), max_age=60)
+
+    assert attached.reattached == 5
+    assert (attached.start, attached.count) == (0, 5)
+    assert [int(attached.view(i)[0, 0, 0]) for i in range(5)] == [0, 1, 2, 3, 4]
+
+
+def test_attach_drops_frames_older_than_max_age(app, tmp_path):
+    ring = filled_ring(app, tmp_path / 'ring', 5)
+    ring.times[:] -= 120
+    ring.mm.close()
+
+    attached = app.FrameRing.attach(str(tmp_path / 'ring'), max_age=60)
+
+    assert attached.reattached == 0
+    assert len(attached) == 0 and attached.count == 5
+
+
+def test_attach_rejects_invalid_file(app, tmp_path):
+    path = tmp_path / 'ring'
+    path.write_bytes(b'x' * 8192)
+
+    assert app.FrameRing.attach(str(path)) is None
+    assert app.FrameRing.attach(str(tmp_path / 'missing')) is None
+
+
+def test_copy_seqs_returns_requested_range(app, tmp_path):
+    ring = filled_ring(app, tmp_path / 'ring', 6)
+
+    frames = ring.copy_seqs(2, 5)
+
+    assert [int(f[0, 0, 0]) for f in frames] == [2, 3, 4]
+    ring.append(frame(99), time.monotonic())
+    assert frames[0][0, 0, 0] == 2  # Cópia, não view do slot
+
+
+def test_copy_seqs_drops_overwritten_head(app, tmp_path):
+    ring = filled_ring(app, tmp_path / 'ring', SLOTS + 4)
+
+    frames = ring.copy_seqs(0, SLOTS + 4)
+
+    # Só sobram as sequências que a captura não pode estar reescrevendo
+    assert [int(f[0, 0, 0]) for f in frames] == list(range(5, SLOTS + 4))
+
+
+def test_create_without_space_raises_enospc(app, tmp_path, monkeypatch):
+    usage = namedtuple('usage', 'total used free')
+    monkeypatch.setattr(shutil, 'disk_usage', lambda path: usage(1 << 20, 1 << 20, 1024))
+
+    with pytest.raises(OSError) as info:
+        app.FrameRing.create(str(tmp_path / 'ring'), SHAPE, SLOTS)
+
+    assert info.value.errno == errno.ENOSPC
+    assert not os.path.exists(tmp_path / 'ring')
+    assert not os.path.exists(tmp_path / 'ring.tmp')